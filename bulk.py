@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+""" bulk.py
+
+Bulk import and export of conferences and sessions.
+
+An import reads a CSV or JSONL file uploaded to the blobstore, in batches
+of IMPORT_BATCH_ROWS rows, each batch in its own task on the bulk queue.
+Rows are checked with the same rules as createConference/createSession
+(ConferenceApi._conferenceDataFromForm and _sessionDataFromForm), keys
+come from allocate_ids ranges and entities are written with put_multi.
+A BulkImportJob entity records the byte offset of the next row, so an
+import carries on from its last checkpoint after a failure; the keys of
+a batch are saved before the batch is written, so a retried batch
+rewrites the same entities instead of duplicating them. A row that
+cannot be read or converted is recorded in the errors of the job and
+skipped; a batch that keeps failing marks the job "failed" once the bulk
+queue gives up retrying it (see failImport()).
+
+An export streams one kind, page by page with query cursors, as CSV or
+JSONL; a response stops after EXPORT_MAX_ROWS rows and hands out the
+cursor to continue from.
+
+Columns are the ConferenceForm/SessionForm field names; in CSV files the
+topics of a conference are separated by ";". Conference rows need an
+organizerUserId, session rows a websafeConferenceKey.
+
+"""
+
+import csv
+import json
+import logging
+import StringIO
+
+import endpoints
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+import counters
+import ical
+from models import BulkImportJob
+from models import Conference
+from models import Profile
+from models import Session
+from models import SessionType
+
+BULK_QUEUE = "bulk"
+IMPORT_BATCH_ROWS = 200
+PUT_BATCH = 100
+MAX_ERRORS = 100
+EXPORT_PAGE_ROWS = 500
+EXPORT_MAX_ROWS = 20000
+# task_retry_limit of the bulk queue (queue.yaml)
+IMPORT_TASK_RETRIES = 5
+
+KINDS = {"Conference": Conference, "Session": Session}
+FORMATS = ("csv", "jsonl")
+
+CONFERENCE_COLUMNS = ["websafeKey", "name", "description", "organizerUserId",
+                      "topics", "city", "startDate", "endDate",
+                      "maxAttendees", "seatsAvailable"]
+SESSION_COLUMNS = ["websafeKey", "websafeConferenceKey", "name", "highlights",
+                   "speaker", "typeOfSession", "date", "startTime",
+                   "duration"]
+INTEGER_COLUMNS = ("maxAttendees", "seatsAvailable", "duration", "month")
+
+
+
+def startImport(kind, fileFormat, blob_key):
+  """ Create the BulkImportJob of an uploaded file and start it. """
+  if kind not in KINDS:
+    raise ValueError("Unknown kind: %s" % kind)
+  if fileFormat not in FORMATS:
+    raise ValueError("Unknown format: %s" % fileFormat)
+  job = BulkImportJob(kind=kind, fileFormat=fileFormat, blobKey=blob_key)
+  if fileFormat == "csv":
+    # the header row names the columns; rows start after it
+    reader = blobstore.BlobReader(blob_key)
+    header = reader.readline()
+    job.columns = [column.strip() for column in next(csv.reader([header]))]
+    job.offset = len(header)
+  job.put()
+  _enqueue(job)
+  return job
+
+
+
+def _enqueue(job):
+  """ Add the task for the next batch; named after the job and offset so
+      that a batch is never run twice concurrently.
+  """
+  try:
+    taskqueue.add(name="bulk-import-%d-%d" % (job.key.id(), job.offset),
+                  url="/tasks/bulk_import",
+                  params={"job": job.key.id()},
+                  queue_name=BULK_QUEUE)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+
+def _readRows(job):
+  """ Yield (raw row, byte offset after the row) from the job offset; a
+      raw row is a list of CSV values, a JSONL line or the csv.Error of an
+      unreadable CSV row. They are parsed by _parseRow().
+  """
+  reader = blobstore.BlobReader(job.blobKey, position=job.offset)
+  consumed = [job.offset]
+
+  def lines():
+    for line in reader:
+      consumed[0] += len(line)
+      yield line
+
+  if job.fileFormat == "csv":
+    rows = csv.reader(lines())
+    while True:
+      try:
+        values = next(rows)
+      except StopIteration:
+        return
+      except csv.Error as e:
+        yield e, consumed[0]
+        continue
+      if any(values):
+        yield values, consumed[0]
+  else:
+    for line in lines():
+      if line.strip():
+        yield line, consumed[0]
+
+
+
+def _parseRow(job, raw):
+  """ Return the row dict of a raw row read by _readRows(). """
+  if isinstance(raw, csv.Error):
+    raise ValueError("bad CSV row: %s" % raw)
+  if job.fileFormat == "csv":
+    return dict(zip(job.columns, [value.decode("utf-8") for value in raw]))
+  row = json.loads(raw)
+  if not isinstance(row, dict):
+    raise ValueError("not a JSON object")
+  return row
+
+
+
+def _formFields(row):
+  """ Convert the values of an import row into form field values. """
+  data = {}
+  for column, value in row.items():
+    if value in (None, ""):
+      continue
+    if column in INTEGER_COLUMNS:
+      value = int(value)
+    elif column == "topics" and not isinstance(value, list):
+      value = [topic.strip() for topic in value.split(";") if topic.strip()]
+    elif column == "typeOfSession":
+      value = getattr(SessionType, str(value))
+    data[column] = value
+  return data
+
+
+
+def _conferenceEntity(row):
+  """ Return (parent key, Conference properties) for an import row. """
+  data = _formFields(row)
+  organizer = data.pop("organizerUserId", None)
+  if not organizer:
+    raise endpoints.BadRequestException("'organizerUserId' field required")
+  data.pop("seatsAvailable", None)
+  data = ConferenceApi._conferenceDataFromForm(data)
+  data["organizerUserId"] = organizer
+  return ndb.Key(Profile, organizer), data
+
+
+
+def _sessionEntity(row, confs):
+  """ Return (parent key, Session properties) for an import row. """
+  data = _formFields(row)
+  wsck = data.get("websafeConferenceKey")
+  if not wsck:
+    raise endpoints.BadRequestException("'websafeConferenceKey' field required")
+  c_key = ndb.Key(urlsafe=wsck)
+  if not confs.get(c_key):
+    raise endpoints.NotFoundException("No conference found with key: %s" % wsck)
+  data.pop("websafeKey", None)
+  return c_key, ConferenceApi._sessionDataFromForm(data, confs[c_key])
+
+
+
+def runImportBatch(job_id):
+  """ Import the next batch of a job and chain the following one. """
+  job = BulkImportJob.get_by_id(job_id)
+  if not job or job.status != "running":
+    return
+
+  # read a batch of rows and remember where it ends
+  batch = []
+  end = job.offset
+  done = True
+  for raw, end in _readRows(job):
+    batch.append(raw)
+    if len(batch) >= IMPORT_BATCH_ROWS:
+      done = False
+      break
+
+  # parse the rows, keeping the errors (UnicodeDecodeError is a ValueError)
+  rows = []
+  errors = []
+  for index, raw in enumerate(batch):
+    try:
+      rows.append((index, _parseRow(job, raw)))
+    except ValueError as e:
+      errors.append("row %d: %s" % (job.rows + index + 1, e))
+
+  # the conferences the sessions of the batch belong to
+  confs = {}
+  if job.kind == "Session":
+    c_keys = set()
+    for index, row in rows:
+      try:
+        c_keys.add(ndb.Key(urlsafe=row["websafeConferenceKey"]))
+      except Exception:
+        pass
+    c_keys = list(c_keys)
+    confs = dict(zip(c_keys, ndb.get_multi(c_keys)))
+
+  # check and convert the rows into entities (without their keys yet),
+  # keeping the errors
+  model = KINDS[job.kind]
+  parsed = []
+  for index, row in rows:
+    try:
+      if job.kind == "Conference":
+        parent, data = _conferenceEntity(row)
+      else:
+        parent, data = _sessionEntity(row, confs)
+      parsed.append((parent, model(**data)))
+    except (endpoints.ServiceException, datastore_errors.BadValueError,
+            ValueError, KeyError, TypeError, AttributeError) as e:
+      errors.append("row %d: %s" % (job.rows + index + 1, e))
+
+  # the keys of a batch are saved before it is written; a retried batch
+  # reuses them, so it overwrites its entities instead of duplicating them
+  if job.pendingOffset != job.offset or len(job.pendingKeys) != len(parsed):
+    by_parent = {}
+    for parent, entity in parsed:
+      by_parent[parent] = by_parent.get(parent, 0) + 1
+    # one allocate_ids range per parent; ranges are (first, last) inclusive
+    ranges = {}
+    for parent, n in by_parent.items():
+      first, last = model.allocate_ids(size=n, parent=parent)
+      ranges[parent] = iter(xrange(first, last + 1))
+    job.pendingKeys = [ndb.Key(model, next(ranges[parent]), parent=parent)
+                       for parent, entity in parsed]
+    job.pendingOffset = job.offset
+    job.put()
+
+  entities = []
+  for key, (parent, entity) in zip(job.pendingKeys, parsed):
+    entity.key = key
+    entities.append(entity)
+  for i in range(0, len(entities), PUT_BATCH):
+    ndb.put_multi(entities[i:i + PUT_BATCH])
+
+  # the featured speaker and calendar feed of the conferences that got
+  # new sessions
+  if job.kind == "Session":
+    for c_key in set(key.parent() for key in job.pendingKeys):
+      ConferenceApi._scheduleFeaturedSpeaker(c_key.urlsafe())
+      ical.invalidateConference(c_key.urlsafe())
+
+  # checkpoint
+  job.offset = end
+  job.rows += len(batch)
+  job.imported += len(entities)
+  job.errors = (job.errors + errors)[:MAX_ERRORS]
+  job.pendingKeys = []
+  job.pendingOffset = None
+  if done:
+    job.status = "done"
+  job.put()
+  # counted once the batch is checkpointed, so that a retried batch does
+  # not count its sessions twice
+  if job.kind == "Session":
+    counters.incrementMulti(ConferenceApi._sessionCounts(entities))
+  if errors:
+    logging.warning("Bulk import %d: %d bad rows", job_id, len(errors))
+  if not done:
+    _enqueue(job)
+
+
+
+def failImport(job_id, error):
+  """ Mark a job "failed" after its last batch failed for good. """
+  job = BulkImportJob.get_by_id(job_id)
+  if job and job.status == "running":
+    job.status = "failed"
+    job.errors = (job.errors + ["batch at byte %d: %s" % (job.offset, error)]
+                  )[:MAX_ERRORS]
+    job.put()
+
+
+
+def _exportRow(kind, entity):
+  """ Return the export row (a dict of form field values) of an entity. """
+  if kind == "Conference":
+    row = dict((column, getattr(entity, column, None))
+               for column in CONFERENCE_COLUMNS)
+  else:
+    row = dict((column, getattr(entity, column, None))
+               for column in SESSION_COLUMNS)
+    row["websafeConferenceKey"] = entity.key.parent().urlsafe()
+    if entity.startTime and entity.endTime:
+      row["duration"] = (entity.endTime.hour * 60 + entity.endTime.minute) \
+                      - (entity.startTime.hour * 60 + entity.startTime.minute)
+  row["websafeKey"] = entity.key.urlsafe()
+  for column, value in row.items():
+    if value is not None and not isinstance(value, (int, long, list, basestring)):
+      row[column] = str(value)
+  return row
+
+
+
+def export(kind, fileFormat, write, cursor=None, max_rows=EXPORT_MAX_ROWS):
+  """ Write up to max_rows entities of a kind through write(), page by
+      page from cursor (a websafe cursor string); return the websafe
+      cursor to continue from, or None when the export is complete.
+  """
+  columns = CONFERENCE_COLUMNS if kind == "Conference" else SESSION_COLUMNS
+  query = KINDS[kind].query()
+  start = Cursor(urlsafe=cursor) if cursor else None
+  if fileFormat == "csv" and not cursor:
+    write(",".join(columns) + "\r\n")
+
+  written = 0
+  while written < max_rows:
+    page, start, more = query.fetch_page(
+      min(EXPORT_PAGE_ROWS, max_rows - written), start_cursor=start)
+    for entity in page:
+      row = _exportRow(kind, entity)
+      if fileFormat == "csv":
+        out = StringIO.StringIO()
+        if kind == "Conference":
+          row["topics"] = ";".join(row["topics"] or [])
+        csv.writer(out).writerow([
+          unicode(row[column]).encode("utf-8") if row.get(column) is not None
+          else "" for column in columns])
+        write(out.getvalue())
+      else:
+        write(json.dumps(row) + "\n")
+    written += len(page)
+    if not more or not start:
+      return None
+  return start.urlsafe()
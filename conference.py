@@ -1,20 +1,25 @@
 #!/usr/bin/env python
 
+import heapq
 import logging
 import json
 import os
 import time
+import uuid
 import httplib
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import urlfetch
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 
 from models import Profile
 from models import ProfileMiniForm
@@ -27,16 +32,36 @@ from models import SessionForms
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferenceDetailForm
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import BooleanMessage
 from models import ConflictException
+from models import ContentionException
 from models import StringMessage
 from models import SessionType
-
-from datetime import datetime, date, time
+from models import FeaturedSpeakerForm
+from models import FeaturedSpeakerForms
+from models import BatchCallForms
+from models import BatchResultForm
+from models import BatchResultForms
+from models import CountForm
+from models import ConferenceCountsForm
+from models import ConferenceNeighbours
+from models import SeatsForm
+from models import TrendingConferences
+
+from datetime import datetime, date, time, timedelta
 from settings import WEB_CLIENT_ID
 from  utils import getUserId
+import counters
+import geo
+import ical
+import mailer
+import ratelimit
+import seats
+import instrumentation
+import profiling
 
 
 
@@ -76,6 +101,16 @@ FIELDS =    {
             "TOPIC": "topics",
             "MONTH": "month",
             "MAX_ATTENDEES": "maxAttendees",
+            "START_DATE": "startDate",
+            "END_DATE": "endDate",
+            }
+
+# query sort orders; the results are then sorted by name
+SORT_FIELDS = {
+            "NAME": "name",
+            "START_DATE": "startDate",
+            "SEATS_AVAILABLE": "seatsAvailable",
+            "MAX_ATTENDEES": "maxAttendees",
             }
 
 
@@ -123,6 +158,17 @@ SESSION_TYPE_GET_REQUEST = endpoints.ResourceContainer(
   typeOfSession = messages.StringField(2),
 )
 
+SEATS_GET_REQUEST = endpoints.ResourceContainer(
+  message_types.VoidMessage,
+  websafeConferenceKey = messages.StringField(1),
+  version = messages.IntegerField(2),
+)
+
+FEATURED_SPEAKERS_GET_REQUEST = endpoints.ResourceContainer(
+  message_types.VoidMessage,
+  websafeConferenceKeys = messages.StringField(1, repeated=True),
+)
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 
@@ -131,6 +177,104 @@ API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 # memcache keys
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 MEMCACHE_FEATUREDSPEAKER_KEY = "FEATURED_SPEAKER %s"
+MEMCACHE_BOOTSTRAP_KEY = "BOOTSTRAP"
+MEMCACHE_UPCOMING_KEY = "UPCOMING_CONFERENCES"
+MEMCACHE_TRENDING_KEY = "TRENDING_CONFERENCES"
+MEMCACHE_DETAIL_KEY = "CONFERENCE_DETAIL %s"
+
+# page size of the upcoming conferences (the first page is cached and
+# embedded in the index page) and largest page size of queryConferences
+UPCOMING_PAGE_SIZE = 20
+QUERY_MAX_PAGE_SIZE = 100
+
+# sorted queries that no index serves are sorted in memory: the top
+# conferences of at most SORT_SCAN_LIMIT matching ones, read by batches
+SORT_SCAN_LIMIT = 1000
+SORT_SCAN_BATCH = 200
+
+# the cached conference details also expire, in case an invalidation
+# was missed
+DETAIL_CACHE_SECONDS = 600
+
+# number of conferences recommendConferences returns; the id of the
+# ConferenceNeighbours child of a conference (see recommendations.py)
+RECOMMEND_COUNT = 10
+NEIGHBOURS_ID = 1
+
+# radius of nearCity queries when withinKm is not given, and largest one;
+# each geohash cell query reads at most NEARBY_SCAN_LIMIT conferences
+NEARBY_DEFAULT_KM = 50
+NEARBY_MAX_KM = 500
+NEARBY_SCAN_LIMIT = 1000
+
+# featured speaker recomputes for a conference are coalesced into one
+# named task per time window of this many seconds
+FEATURED_SPEAKER_TASK_WINDOW = 10
+FEATURED_SPEAKER_QUEUE = "featured-speaker"
+
+# memcache value marking a websafeConferenceKey with no conference behind it
+MEMCACHE_NO_CONFERENCE = "__NO_CONFERENCE__"
+# negative entries expire so that a bad key is only looked up again rarely
+MEMCACHE_NEGATIVE_TTL = 600
+
+# counter of the wishlists holding a session (see counters.py)
+WISHLIST_COUNTER = "wishlist|%s"
+# counters of the attendees and of the sessions of a conference, in all
+# and by type and date; set from the datastore by the
+# count_conference_sessions migration
+ATTENDEES_COUNTER = "attendees|%s"
+SESSIONS_COUNTER = "sessions|%s"
+SESSIONS_BY_TYPE_COUNTER = "sessions-type|%s|%s"
+SESSIONS_BY_DATE_COUNTER = "sessions-date|%s|%s"
+# per-date session counts are only given for conferences up to this long
+COUNT_MAX_DAYS = 31
+
+# write-behind counters of the views of and registrations for a conference
+# (see counters.incrementLater), flushed by the trending cron job
+VIEWS_COUNTER = "views|%s"
+REGISTRATIONS_COUNTER = "registrations|%s"
+
+# trending score: views plus weighted registrations, halved every
+# TRENDING_HALF_LIFE_HOURS; lower scores are dropped, and only the best
+# TRENDING_KEEP scores are kept
+TRENDING_ID = "trending"
+TRENDING_COUNT = 10
+TRENDING_KEEP = 500
+TRENDING_HALF_LIFE_HOURS = 24.0
+TRENDING_REGISTRATION_WEIGHT = 10
+TRENDING_MIN_SCORE = 0.01
+
+# first word of the message of a registration whose transaction still
+# collided after ndb's retries, for the clients (and tools/loadgen.py)
+CONTENTION = "CONTENTION"
+
+# most calls a batch request may hold
+BATCH_MAX_CALLS = 20
+# read-only methods batch() runs concurrently, by their tasklets
+BATCH_ASYNC_METHODS = {
+  "getConference": "_getConferenceAsync",
+  "getConferenceSessions": "_getConferenceSessionsAsync",
+  "getConferenceSessionsByType": "_getConferenceSessionsByTypeAsync",
+  "getSessionsBySpeaker": "_getSessionsBySpeakerAsync",
+}
+# request fields holding websafe keys; the entities of a whole batch (and
+# their parents) are fetched together before its calls are run
+BATCH_KEY_FIELDS = ("websafeConferenceKey", "websafeConferenceKeys",
+                    "websafeSessionKey")
+
+# token buckets of the rate limited API methods, per user (or IP address
+# when anonymous): method -> (calls, per this many seconds); see
+# ratelimit.py
+RATE_LIMITS = {
+  "createConference": (10, 60),
+  "createSession": (30, 60),
+  "queryConferences": (120, 60),
+  "registerForConference": (20, 60),
+  "unregisterFromConference": (20, 60),
+  "addSessionToWishlist": (60, 60),
+  "deleteSessionInWishlist": (60, 60),
+}
+rateLimited = ratelimit.limited(RATE_LIMITS)
 
 
 
@@ -184,9 +328,15 @@ class ConferenceApi(remote.Service):
       raise endpoints.UnauthorizedException("Authorization required")
     user_id = getUserId(user, id_type="oauth")
 
-    # get the conference model
+    # make conference Key from the websafe conference key
     wsck = request.websafeConferenceKey
-    conf = ndb.Key(urlsafe=wsck).get()
+    c_key = ndb.Key(urlsafe=wsck)
+
+    # get the conference model and allocate new Session ID with the
+    # conference key as parent at the same time
+    conf_future = c_key.get_async()
+    s_id_future = Session.allocate_ids_async(size=1, parent=c_key)
+    conf = conf_future.get_result()
 
     # check that conference exists
     if not conf:
@@ -198,16 +348,82 @@ class ConferenceApi(remote.Service):
       raise endpoints.ForbiddenException(
         "Only the owner can update the conference.")
 
-    # check wether the "name" field is filled by user
-    if not request.name:
-      raise endpoints.BadRequestException("Session 'name' field required")
-
     # copy SessionForm/ProtoRPC Message into dict
     data = {field.name: getattr(request, field.name) for field in request.all_fields()}
 
+    # check and convert the fields into Session properties
+    data = self._sessionDataFromForm(data, conf)
+
+    # the Session ID allocated above
+    s_id = s_id_future.get_result()[0]
+
+    # make Session key from ID
+    s_key = ndb.Key(Session, s_id, parent=c_key)
+    data["key"] = s_key
+
+    # creates the Session object and put onto the cloud datastore
+    session = Session(**data)
+    session.put() 
+    counters.incrementMulti(self._sessionCounts([session]))
+    ical.invalidateConference(wsck)
+    memcache.delete(MEMCACHE_DETAIL_KEY % wsck)
+
+    # add task to queue to update featured speaker 
+    self._scheduleFeaturedSpeaker(wsck)
+
+    # return the original Session Form
+    return self._copySessionToForm(session)
+
+
+
+  @staticmethod
+  def _sessionCounts(sessions):
+    """ Return {counter name: number of the sessions} of the session
+        counters of their conferences; shared with bulk imports.
+    """
+    counts = {}
+    for session in sessions:
+      wsck = session.key.parent().urlsafe()
+      names = [SESSIONS_COUNTER % wsck,
+               SESSIONS_BY_TYPE_COUNTER % (wsck, session.typeOfSession)]
+      if session.date:
+        names.append(SESSIONS_BY_DATE_COUNTER % (wsck, session.date))
+      for name in names:
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+
+  @staticmethod
+  @ndb.non_transactional
+  def _recountConference(c_key):
+    """ Set the attendee and session counters of a conference from the
+        datastore; used by the count_conference_sessions migration.
+    """
+    wsck = c_key.urlsafe()
+    sessions_future = Session.query(ancestor=c_key).fetch_async()
+    attendees = Profile.query(
+      Profile.conferenceKeysToAttend == wsck).count()
+    counts = ConferenceApi._sessionCounts(sessions_future.get_result())
+    counts.setdefault(SESSIONS_COUNTER % wsck, 0)
+    counts[ATTENDEES_COUNTER % wsck] = attendees
+    for name, total in counts.items():
+      counters.setCount(name, total)
+
+
+
+  @staticmethod
+  def _sessionDataFromForm(data, conf):
+    """ Check and convert a dict of SessionForm fields into Session
+        properties for the given conference; shared with bulk imports.
+    """
+    # check wether the "name" field is filled by user
+    if not data.get("name"):
+      raise endpoints.BadRequestException("Session 'name' field required")
+
     # add default values for those missing (both data model & outbound Message)
     for df in SESSION_DEFAULTS:
-      if data[df] in (None, []):
+      if data.get(df) in (None, []):
         data[df] = SESSION_DEFAULTS[df]
         #setattr(request, df, SESSION_DEFAULTS[df])
 
@@ -216,7 +432,7 @@ class ConferenceApi(remote.Service):
       data["typeOfSession"] = str(data["typeOfSession"])
 
     # convert date from strings to Date objects
-    if data["date"]: # date
+    if data.get("date"): # date
       data["date"] = datetime.strptime(data["date"][:10], "%Y-%m-%d").date()
       # check if the date is during the conference period
       conf_start_date = getattr(conf, "startDate")
@@ -226,40 +442,20 @@ class ConferenceApi(remote.Service):
           raise endpoints.BadRequestException("Invallid date")
 
     # convert time from strings to time objects
-    if data["startTime"]: # time
+    if data.get("startTime"): # time
       data["startTime"] = datetime.strptime(data["startTime"][:8], "%H:%M:%S").time()
 
     # compute the endTime using the duration field
-    if data["duration"] and data["startTime"]: 
+    if data["duration"] and data.get("startTime"): 
       endTime_minute = (data["startTime"].minute + data["duration"]) % 60
       endTime_hour = data["startTime"].hour \
                 + (data["startTime"].minute + data["duration"]) / 60
       data["endTime"] = time(endTime_hour, endTime_minute)
 
     # delete unused fields
-    del[data["duration"]]
-    del[data["websafeConferenceKey"]]
-    del[data["wssk"]]
-
-    # make conference Key from the websafe conference key
-    c_key = ndb.Key(urlsafe=wsck)
-
-    # allocate new Session ID with the conference key as parent
-    s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-
-    # make Session key from ID
-    s_key = ndb.Key(Session, s_id, parent=c_key)
-    data["key"] = s_key
-
-    # creates the Session object and put onto the cloud datastore
-    Session(**data).put() 
-
-    # add task to queue to update featured speaker 
-    taskqueue.add(params={"websafeConferenceKey": wsck},
-              url="/tasks/set_featured_speaker")
-
-    # return the original Session Form
-    return self._copySessionToForm(s_key.get())
+    for field in ("duration", "websafeConferenceKey", "wssk"):
+      data.pop(field, None)
+    return data
 
 
 
@@ -269,6 +465,7 @@ class ConferenceApi(remote.Service):
   @endpoints.method(SESSION_CREATE_REQUEST, SessionForm,
           path="conference/{websafeConferenceKey}/new_session",
           http_method="PUT", name="createSession")
+  @rateLimited
   def createSession(self, request):
     """ Create session w/provided fields & return the info. """
     return self._createSessionObject(request)
@@ -288,23 +485,31 @@ class ConferenceApi(remote.Service):
           http_method="POST", name="getConferenceSessions")
   def getConferenceSessions(self, request):
     """ Return all sessions in the speicified conference. """
-    # get the conference model
+    return self._getConferenceSessionsAsync(request).get_result()
+
+
+
+  @ndb.tasklet
+  def _getConferenceSessionsAsync(self, request):
+    """ Tasklet of getConferenceSessions(), which batch() runs alongside
+        the other read-only calls.
+    """
+    # get the conference model and, at the same time, run the
+    # ancestor query for this conference
     wsck = request.websafeConferenceKey
     c_key = ndb.Key(urlsafe=wsck)
-    conf = c_key.get()
+    conf, sessions = yield (c_key.get_async(),
+                            Session.query(ancestor=c_key).fetch_async())
 
     # check that conference exists
     if not conf:
       raise endpoints.NotFoundException(
         "No conference found with key: %s" % wsck)
 
-    # create ancestor query for this conference
-    query_result = Session.query(ancestor=c_key)
-
     # return set of SessionForm objects per Session
-    return SessionForms(
-      items=[self._copySessionToForm(session) for session in query_result]
-    )
+    raise ndb.Return(SessionForms(
+      items=[self._copySessionToForm(session) for session in sessions]
+    ))
 
 
 
@@ -316,6 +521,15 @@ class ConferenceApi(remote.Service):
           http_method="POST", name="getSessionsBySpeaker")
   def getSessionsBySpeaker(self, request):
     """ Return all sessions presented by a specified speaker. """
+    return self._getSessionsBySpeakerAsync(request).get_result()
+
+
+
+  @ndb.tasklet
+  def _getSessionsBySpeakerAsync(self, request):
+    """ Tasklet of getSessionsBySpeaker(), which batch() runs alongside
+        the other read-only calls.
+    """
     # get raw results
     query_result = Session.query()
 
@@ -327,9 +541,10 @@ class ConferenceApi(remote.Service):
     query_result = query_result.order(Session.startTime)
 
     # return the resultant query result
-    return SessionForms(
-      items=[self._copySessionToForm(session) for session in query_result]
-    )
+    sessions = yield query_result.fetch_async()
+    raise ndb.Return(SessionForms(
+      items=[self._copySessionToForm(session) for session in sessions]
+    ))
 
 
 
@@ -341,13 +556,18 @@ class ConferenceApi(remote.Service):
           http_method="POST", name="getConferenceSessionsByType")
   def getConferenceSessionsByType(self, request):
     """ Return all sessions for a given type in a conference. """
+    return self._getConferenceSessionsByTypeAsync(request).get_result()
+
+
+
+  @ndb.tasklet
+  def _getConferenceSessionsByTypeAsync(self, request):
+    """ Tasklet of getConferenceSessionsByType(), which batch() runs
+        alongside the other read-only calls.
+    """
     # get the conference model
     c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-    conf = c_key.get()
-    # check that conference exists
-    if not conf:
-      raise endpoints.NotFoundException(
-        "No conference found with key: %s" % request.websafeConferenceKey)
+    conf_future = c_key.get_async()
 
     # create ancestor query for this conference
     query_result = Session.query(ancestor=c_key)
@@ -359,10 +579,18 @@ class ConferenceApi(remote.Service):
     query_result = query_result.order(Session.date)
     query_result = query_result.order(Session.startTime)
 
+    # run the query while the conference is being fetched
+    conf, sessions = yield conf_future, query_result.fetch_async()
+
+    # check that conference exists
+    if not conf:
+      raise endpoints.NotFoundException(
+        "No conference found with key: %s" % request.websafeConferenceKey)
+
     # return the resultant query result
-    return SessionForms(
-      items=[self._copySessionToForm(session) for session in query_result]
-    )
+    raise ndb.Return(SessionForms(
+      items=[self._copySessionToForm(session) for session in sessions]
+    ))
 
 
 
@@ -389,6 +617,13 @@ class ConferenceApi(remote.Service):
 
   def _getProfileFromUser(self):
     """ Return user Profile from datastore, creating new one if non-existent. """
+    return self._getProfileFromUserAsync().get_result()
+
+
+
+  @ndb.tasklet
+  def _getProfileFromUserAsync(self):
+    """ Tasklet version of _getProfileFromUser(). """
     # make usre that the user is authed
     user = endpoints.get_current_user()
     if not user:
@@ -397,7 +632,7 @@ class ConferenceApi(remote.Service):
     # get Profile from database
     user_id = getUserId(user, id_type="oauth")
     p_key = ndb.Key(Profile, user_id)
-    profile = p_key.get() # this creates a profile object
+    profile = yield p_key.get_async() # this creates a profile object
 
     # create new Profile if not there
     if not profile:
@@ -407,8 +642,8 @@ class ConferenceApi(remote.Service):
              mainEmail= user.email(),
              teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
       )
-      profile.put() # this place the profile object on google cloud datastore
-    return profile  # return Profile
+      yield profile.put_async() # this place the profile object on google cloud datastore
+    raise ndb.Return(profile)  # return Profile
 
 
 
@@ -455,6 +690,25 @@ class ConferenceApi(remote.Service):
 
 
 
+  #----------------------------------------------------------
+  # API: return the URL of the calendar feed of the user's wishlist
+  #----------------------------------------------------------
+  @endpoints.method(message_types.VoidMessage, StringMessage,
+            path="profile/calendar", http_method="GET",
+            name="getWishlistCalendar")
+  def getWishlistCalendar(self, request):
+    """ Return the (secret) path of the iCalendar feed of the user's
+        wishlist, for calendar clients to subscribe to.
+    """
+    prof = self._getProfileFromUser()
+    if not prof.calendarToken:
+      prof.calendarToken = uuid.uuid4().hex
+      prof.put()
+    return StringMessage(data="/calendar/wishlist/%s/%s.ics" % (
+      prof.key.id(), prof.calendarToken))
+
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 #
 #       Conference objects
@@ -491,35 +745,15 @@ class ConferenceApi(remote.Service):
       raise endpoints.UnauthorizedException("Authorization required")
     user_id = getUserId(user, id_type="oauth")
 
-    # check wether the 'name' field is filled by user
-    if not request.name:
-      raise endpoints.BadRequestException("Conference 'name' field required")
-
     # copy ConferenceForm/ProtoRPC Message into dict
     data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-    del data["websafeKey"]
-    del data["organizerDisplayName"]
-
-    # add default values for those missing (both data model & outbound Message)
-    for df in DEFAULTS:
-      if data[df] in (None, []):
-        data[df] = DEFAULTS[df]
-        setattr(request, df, DEFAULTS[df])
 
-    # convert dates from strings to Date objects; set month based on start_date
-    if data["startDate"]: # start date
-      data["startDate"] = datetime.strptime(data["startDate"][:10], "%Y-%m-%d").date()
-      data["month"] = data["startDate"].month
-    else:
-      data["month"] = 0
-    if data["endDate"]: # end date
-      data["endDate"] = datetime.strptime(data["endDate"][:10], "%Y-%m-%d").date()
+    # check and convert the fields into Conference properties
+    data = self._conferenceDataFromForm(data)
 
-    # set seatsAvailable to be same as maxAttendees on creation
-    # both for data model & outbound Message
-    if data["maxAttendees"] > 0:
-      data["seatsAvailable"] = data["maxAttendees"]
-      setattr(request, "seatsAvailable", data["maxAttendees"])
+    # copy the defaults and seatsAvailable back to the outbound Message
+    for df in DEFAULTS:
+      setattr(request, df, data[df])
 
     # make Profile Key from user ID
     p_key = ndb.Key(Profile, user_id)
@@ -534,16 +768,58 @@ class ConferenceApi(remote.Service):
 
     # creates the conference object and put onto the cloud datastore
     Conference(**data).put() 
+    # the cached upcoming page is built again on the next request
+    memcache.delete(MEMCACHE_UPCOMING_KEY)
 
     # send confirmation email 
-    taskqueue.add(params={"email": user.email(),
-        "conferenceInfo": repr(request)},
-        url="/tasks/send_confirmation_email"
-    )
+    mailer.enqueue("conference_created", user.email(), {
+        "name": data["name"],
+        "city": data["city"],
+        "topics": ", ".join(data["topics"]),
+        "startDate": str(data["startDate"] or ""),
+        "endDate": str(data["endDate"] or ""),
+        "maxAttendees": data["maxAttendees"],
+    })
 
     # return the (updated) ConferenceForm
     return request
 
+  @staticmethod
+  def _conferenceDataFromForm(data):
+    """ Check and convert a dict of ConferenceForm fields into Conference
+        properties; shared with bulk imports.
+    """
+    # check wether the 'name' field is filled by user
+    if not data.get("name"):
+      raise endpoints.BadRequestException("Conference 'name' field required")
+
+    for field in ("websafeKey", "organizerDisplayName", "websafeConferenceKey"):
+      data.pop(field, None)
+
+    # add default values for those missing
+    for df in DEFAULTS:
+      if data.get(df) in (None, []):
+        data[df] = DEFAULTS[df]
+
+    # geocode the city against the bundled gazetteer, for nearCity queries
+    data["location"], data["geohash"] = geo.locate(data["city"])
+
+    # convert dates from strings to Date objects; set month based on start_date
+    if data.get("startDate"): # start date
+      data["startDate"] = datetime.strptime(data["startDate"][:10], "%Y-%m-%d").date()
+      data["month"] = data["startDate"].month
+    else:
+      data["month"] = 0
+    if data.get("endDate"): # end date
+      data["endDate"] = datetime.strptime(data["endDate"][:10], "%Y-%m-%d").date()
+
+    # set seatsAvailable to be same as maxAttendees on creation
+    if data["maxAttendees"] > 0:
+      data["seatsAvailable"] = data["maxAttendees"]
+    return data
+
+
+
   @ndb.transactional()
   def _updateConferenceObject(self, request):
     """ Update the fields in the conference model. """
@@ -569,8 +845,13 @@ class ConferenceApi(remote.Service):
       raise endpoints.ForbiddenException(
         "Only the owner can update the conference.")
 
+    # the organizer profile, the parent of the conference (so in the
+    # entity group of this transaction), is fetched while it is updated
+    prof_future = conf.key.parent().get_async()
+
     # Not getting all the fields, so don't create a new object; just
     # copy relevant fields from ConferenceForm to Conference object
+    seats_available = conf.seatsAvailable
     for field in request.all_fields():
       data = getattr(request, field.name)
       # only copy fields where we get data
@@ -580,10 +861,23 @@ class ConferenceApi(remote.Service):
           data = datetime.strptime(data, "%Y-%m-%d").date()
           if field.name == "startDate":
             conf.month = data.month
+        elif field.name == "city":
+          conf.location, conf.geohash = geo.locate(data)
         # write to Conference object
         setattr(conf, field.name, data)
+    if conf.seatsAvailable != seats_available:
+      conf.seatsVersion += 1
     conf.put()
-    prof = ndb.Key(Profile, user_id).get()
+
+    # the seat count is published and the caches are dropped only once
+    # the transaction commits, so they never hold uncommitted data
+    wsck = request.websafeConferenceKey
+    def committed():
+      seats.publish(wsck, conf.seatsVersion, conf.seatsAvailable)
+      ical.invalidateConference(wsck)
+      memcache.delete_multi([MEMCACHE_DETAIL_KEY % wsck, MEMCACHE_UPCOMING_KEY])
+    ndb.get_context().call_on_commit(committed)
+    prof = prof_future.get_result()
 
     # return the conference form
     return self._copyConferenceToForm(conf, getattr(prof, "displayName"))
@@ -595,6 +889,7 @@ class ConferenceApi(remote.Service):
   #----------------------------------------------------------
   @endpoints.method(ConferenceForm, ConferenceForm, path="conference",
           http_method="POST", name="createConference")
+  @rateLimited
   def createConference(self, request):
     """ Create new conference. """
     return self._createConferenceObject(request)
@@ -614,24 +909,72 @@ class ConferenceApi(remote.Service):
 
     # get conferenceKeysToAttend from profile.
     conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-    conferences = ndb.get_multi(conf_keys)
 
-    # get organizers
-    organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
+    # get organizers; they are the parents of the conference keys, so
+    # they are fetched together with the conferences
+    organisers = list(set(c_key.parent() for c_key in conf_keys))
+    conf_futures = ndb.get_multi_async(conf_keys)
     profiles = ndb.get_multi(organisers)
+    conferences = [future.get_result() for future in conf_futures]
 
     # put display names in a dict for easier fetching
     names = {}
     for profile in profiles:
+      if profile:
         names[profile.key.id()] = profile.displayName
 
     # return set of ConferenceForm objects per Conference
-    return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-     for conf in conferences]
+    return ConferenceForms(items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))\
+     for conf in conferences if conf]
     )
 
 
 
+  #----------------------------------------------------------
+  # API: recommend conferences similar to the user's
+  #----------------------------------------------------------
+  @endpoints.method(message_types.VoidMessage, ConferenceForms,
+          path="conferences/recommended",
+          http_method="GET", name="recommendConferences")
+  def recommendConferences(self, request):
+    """ Recommend conferences with seats left that are similar (by topics
+        and city) to those the user registered for, by merging their
+        precomputed neighbour lists.
+    """
+    # get user Profile
+    prof = self._getProfileFromUser()
+    conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
+
+    # a neighbour of several of the user's conferences adds up their scores
+    lists = ndb.get_multi([ndb.Key(ConferenceNeighbours, NEIGHBOURS_ID,
+                                   parent=c_key) for c_key in conf_keys])
+    scores = {}
+    for neighbours in lists:
+      if neighbours:
+        for key, score in zip(neighbours.neighbours, neighbours.scores):
+          scores[key] = scores.get(key, 0.0) + score
+    for c_key in conf_keys:
+      scores.pop(c_key, None)
+
+    # some of the best ones may be full; the conferences are fetched with
+    # their organizers, the parents of their keys
+    best = sorted(scores, key=lambda key: -scores[key])[:2 * RECOMMEND_COUNT]
+    organisers = list(set(c_key.parent() for c_key in best))
+    entities = ndb.get_multi(best + organisers)
+    conferences = entities[:len(best)]
+    names = dict((profile.key.id(), profile.displayName)
+                 for profile in entities[len(best):] if profile)
+
+    # the lists are only rebuilt every few hours: leave out what started since
+    today = date.today()
+    return ConferenceForms(items=[
+      self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+      for conf in conferences if conf and conf.seatsAvailable > 0
+      and not (conf.startDate and conf.startDate < today)
+    ][:RECOMMEND_COUNT])
+
+
+
   #----------------------------------------------------------
   # API: update conferences and return the forms
   #----------------------------------------------------------
@@ -649,31 +992,202 @@ class ConferenceApi(remote.Service):
 #       Conference queries
 #
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-  def _getQuery(self, request):
-    """ Return formatted query from the submitted filters. """
+  def _getQuery(self, request, ordered=True):
+    """ Return formatted query from the submitted filters, in the requested
+        order unless ordered is False. Raise NeedIndexError when the
+        datastore cannot sort it that way.
+    """
     # get intial result
     q = Conference.query() 
 
     # construct filters
     inequality_filter, filters = self._formatFilters(request.filters)
 
-    # If exists, sort on inequality filter first
-    if not inequality_filter:
-      q = q.order(Conference.name)
-    else:
-      q = q.order(ndb.GenericProperty(inequality_filter))
-      q = q.order(Conference.name)
+    # upcoming conferences: those starting from today on
+    if request.upcoming:
+      if inequality_filter not in (None, "startDate"):
+        raise endpoints.BadRequestException(
+          "Upcoming conferences allow inequality filters on startDate only.")
+      inequality_filter = "startDate"
+      q = q.filter(Conference.startDate >= date.today())
+
+    # If exists, sort on inequality filter first, then on the sort
+    # field, then on name (see the composite indexes in index.yaml)
+    sort = request.sortBy or ("START_DATE" if request.upcoming else "NAME")
+    if sort not in SORT_FIELDS:
+      raise endpoints.BadRequestException("Invalid sort order: %s" % sort)
+    orders = [inequality_filter] if inequality_filter else []
+    if ordered:
+      if SORT_FIELDS[sort] not in orders:
+        if orders and sort != "NAME":
+          # the datastore sorts on the inequality filter property first
+          raise datastore_errors.NeedIndexError(
+            "Sorting by %s allows inequality filters on %s only." % (
+            sort, SORT_FIELDS[sort]))
+        orders.append(SORT_FIELDS[sort])
+      if "name" not in orders:
+        orders.append("name")
+    for order in orders:
+      q = q.order(ndb.GenericProperty(order))
 
     # apply filters
     for filtr in filters:
       if filtr["field"] in ["month", "maxAttendees"]:
         filtr["value"] = int(filtr["value"]) # cast into integers
+      elif filtr["field"] in ["startDate", "endDate"]:
+        try:
+          filtr["value"] = datetime.strptime(filtr["value"][:10], "%Y-%m-%d").date()
+        except ValueError:
+          raise endpoints.BadRequestException(
+            "Dates are formatted as YYYY-MM-DD: %s" % filtr["value"])
       formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
       q = q.filter(formatted_query) # apply filters
     return q
 
 
 
+  def _getConferencePage(self, query, page_size, cursor=None):
+    """ Return a page of a conference query as ConferenceForms, with the
+        cursor of the next page if there is one.
+    """
+    try:
+      start = Cursor(urlsafe=cursor) if cursor else None
+    except datastore_errors.BadValueError:
+      raise endpoints.BadRequestException("Invalid cursor: %s" % cursor)
+    confs, next_cursor, more = query.fetch_page(page_size, start_cursor=start)
+    profs = ndb.get_multi([ndb.Key(Profile, conf.organizerUserId)
+                           for conf in confs])
+    return ConferenceForms(
+      items=[self._copyConferenceToForm(conf, getattr(prof, "displayName", None))
+             for conf, prof in zip(confs, profs)],
+      nextCursor=next_cursor.urlsafe() if more and next_cursor else None,
+    )
+
+
+
+  def _querySorted(self, request):
+    """ Return the first page of a query in an order that no index serves:
+        the matching conferences (at most SORT_SCAN_LIMIT of them) are
+        streamed and the top ones kept in a heap of the page size.
+    """
+    sort = SORT_FIELDS[request.sortBy or
+                       ("START_DATE" if request.upcoming else "NAME")]
+    page_size = min(request.pageSize or QUERY_MAX_PAGE_SIZE,
+                    QUERY_MAX_PAGE_SIZE)
+    q = self._getQuery(request, ordered=False)
+
+    scanned = [0]
+    def stream():
+      for conf in q.iter(limit=SORT_SCAN_LIMIT, batch_size=SORT_SCAN_BATCH):
+        scanned[0] += 1
+        yield conf
+
+    # conferences without a value come last
+    try:
+      confs = heapq.nsmallest(page_size, stream(), key=lambda conf: (
+        getattr(conf, sort) is None, getattr(conf, sort), conf.name))
+    except datastore_errors.NeedIndexError as e:
+      raise endpoints.BadRequestException(
+        "These filters cannot be combined: %s" % e)
+    strategy = "scan" if scanned[0] < SORT_SCAN_LIMIT else "partial-scan"
+    logging.info("queryConferences sorted by %s without an index (%s of %d "
+                 "conferences): %s", sort, strategy, scanned[0], q)
+
+    profs = ndb.get_multi([ndb.Key(Profile, conf.organizerUserId)
+                           for conf in confs])
+    return ConferenceForms(
+      items=[self._copyConferenceToForm(conf, getattr(prof, "displayName", None))
+             for conf, prof in zip(confs, profs)],
+      sortStrategy=strategy,
+    )
+
+
+
+  def _queryNearby(self, request):
+    """ Return the conferences within withinKm km of nearCity, nearest
+        first, leaving out those that are over (or, when upcoming, have
+        started): one geohash prefix range query per cell covering the
+        circle (see geo.py), all run at once and projected on the geohash,
+        refined by distance; only the conferences of the page are read.
+    """
+    if request.filters or request.sortBy or request.cursor:
+      raise endpoints.BadRequestException(
+        "nearCity cannot be combined with filters, sortBy or cursor.")
+    center = geo.geocode(request.nearCity)
+    if not center:
+      raise endpoints.BadRequestException(
+        "Unknown city: %s" % request.nearCity)
+    km = request.withinKm or NEARBY_DEFAULT_KM
+    if not 0 < km <= NEARBY_MAX_KM:
+      raise endpoints.BadRequestException(
+        "withinKm must be between 0 and %d." % NEARBY_MAX_KM)
+
+    futures = [Conference.query(Conference.geohash >= prefix,
+                                Conference.geohash < prefix + "~").fetch_async(
+                 NEARBY_SCAN_LIMIT, projection=[Conference.geohash])
+               for prefix in geo.coverPrefixes(center[0], center[1], km)]
+    # the conferences of a city share its geohash
+    distances = {}
+    candidates = []
+    for future in futures:
+      for conf in future.get_result():
+        if conf.geohash not in distances:
+          point = geo.decode(conf.geohash)
+          distances[conf.geohash] = geo.distanceKm(center[0], center[1],
+                                                   point[0], point[1])
+        if distances[conf.geohash] <= km:
+          candidates.append((distances[conf.geohash], conf.key))
+    candidates.sort(key=lambda item: item[0])
+
+    # the dates are only known once read: the conferences are read a page
+    # at a time, nearest first, until the page is full
+    page_size = min(request.pageSize or QUERY_MAX_PAGE_SIZE,
+                    QUERY_MAX_PAGE_SIZE)
+    today = date.today()
+    nearby = []
+    for start in range(0, len(candidates), page_size):
+      if len(nearby) == page_size:
+        break
+      chunk = candidates[start:start + page_size]
+      confs = ndb.get_multi([c_key for distance, c_key in chunk])
+      for conf in confs:
+        if not conf or conf.location is None:
+          continue
+        last_day = conf.endDate or conf.startDate
+        if request.upcoming and not (conf.startDate and conf.startDate >= today):
+          continue
+        if last_day and last_day < today:
+          continue
+        nearby.append((geo.distanceKm(center[0], center[1],
+                                      conf.location.lat, conf.location.lon),
+                       conf))
+      nearby = nearby[:page_size]
+
+    profs = ndb.get_multi([ndb.Key(Profile, conf.organizerUserId)
+                           for distance, conf in nearby])
+    items = []
+    for (distance, conf), prof in zip(nearby, profs):
+      cf = self._copyConferenceToForm(conf, getattr(prof, "displayName", None))
+      cf.distanceKm = round(distance, 1)
+      items.append(cf)
+    return ConferenceForms(items=items)
+
+
+
+  @staticmethod
+  def _cacheUpcoming():
+    """ Create the first page of upcoming conferences & assign it to
+        memcache, as JSON; used by the announcement cron job and by
+        queryConferences() when it is not cached.
+    """
+    api = ConferenceApi()
+    upcoming = protojson.encode_message(api._getConferencePage(
+      api._getQuery(ConferenceQueryForms(upcoming=True)), UPCOMING_PAGE_SIZE))
+    memcache.set(MEMCACHE_UPCOMING_KEY, upcoming)
+    return upcoming
+
+
+
   def _formatFilters(self, filters):
     """ Parse, check validity and format user supplied filters. """
     formatted_filters = [] 
@@ -705,24 +1219,55 @@ class ConferenceApi(remote.Service):
   @endpoints.method(ConferenceQueryForms, ConferenceForms,
           path="queryConferences", http_method="POST",
           name="queryConferences")
+  @rateLimited
   def queryConferences(self, request):
-    """ Query conferences subject to user defined filters. """
-    conferences = self._getQuery(request)
-
-    # need to fetch organiser displayName from profiles
-    # get all keys and use get_multi for speed
-    organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-    profiles = ndb.get_multi(organisers)
-
-    # put display names in a dict for easier fetching
-    names = {}
-    for profile in profiles:
-      names[profile.key.id()] = profile.displayName
-
-    return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-            conferences]
-    )
+    """ Query conferences subject to user defined filters; by pages of
+        pageSize conferences when pageSize or cursor is given, which the
+        upcoming conferences always are. An order that no index serves
+        gives the first page only, sorted in memory; sortStrategy tells
+        which way the results were sorted.
+    """
+    if request.nearCity:
+      return self._queryNearby(request)
+
+    # the first page of upcoming conferences, the landing query, is cached
+    if request.upcoming and not request.filters and not request.cursor \
+        and (request.sortBy or "START_DATE") == "START_DATE" \
+        and (request.pageSize or UPCOMING_PAGE_SIZE) == UPCOMING_PAGE_SIZE:
+      upcoming = memcache.get(MEMCACHE_UPCOMING_KEY) or self._cacheUpcoming()
+      forms = protojson.decode_message(ConferenceForms, upcoming)
+      forms.sortStrategy = "index"
+      return forms
+
+    try:
+      q = self._getQuery(request)
+      page_size = request.pageSize or \
+        (UPCOMING_PAGE_SIZE if request.upcoming else None)
+      if page_size or request.cursor:
+        forms = self._getConferencePage(
+          q, min(page_size or QUERY_MAX_PAGE_SIZE, QUERY_MAX_PAGE_SIZE),
+          request.cursor)
+      else:
+        # need to fetch organiser displayName from profiles; each organiser
+        # is fetched as soon as its conference arrives, and ndb batches and
+        # de-duplicates these gets while the query is still running
+        @ndb.tasklet
+        def withOrganiser(conf):
+          prof = yield ndb.Key(Profile, conf.organizerUserId).get_async()
+          raise ndb.Return(conf, getattr(prof, "displayName", None))
+
+        results = q.map(withOrganiser)
+
+        forms = ConferenceForms(
+                items=[self._copyConferenceToForm(conf, name) for conf, name in \
+                results]
+        )
+    except datastore_errors.NeedIndexError:
+      # there is no composite index for these filters in this order (see
+      # index.yaml); the sortStrategy of the response tells which to add
+      return self._querySorted(request)
+    forms.sortStrategy = "index"
+    return forms
 
 
 
@@ -734,17 +1279,101 @@ class ConferenceApi(remote.Service):
           http_method="GET", name="getConference")
   def getConference(self, request):
     """ Return requested conference (by websafeConferenceKey). """
-    # get Conference object from request; bail if not found
-    conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+    return self._getConferenceAsync(request).get_result()
+
+
+
+  @ndb.tasklet
+  def _getConferenceAsync(self, request):
+    """ Tasklet of getConference(), which batch() runs alongside the other
+        read-only calls.
+    """
+    # get Conference object from request together with the profile model
+    # of the organizer (the parent of the conference); bail if not found
+    c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+    conf, prof = yield ndb.get_multi_async([c_key, c_key.parent()])
     if not conf:
       raise endpoints.NotFoundException(
         "No conference found with key: %s" % request.websafeConferenceKey)
-
-    # this is the profile model of the organizer
-    prof = conf.key.parent().get()
+    counters.incrementLater(VIEWS_COUNTER % request.websafeConferenceKey)
 
     # return ConferenceForm
-    return self._copyConferenceToForm(conf, getattr(prof, "displayName"))
+    raise ndb.Return(
+      self._copyConferenceToForm(conf, getattr(prof, "displayName")))
+
+
+
+  def _getConferenceDetail(self, wsck):
+    """ Return the part of the detail of a conference that is the same for
+        every user (conference, featured speaker and sessions by date and
+        time) as JSON, from memcache or built & assigned to memcache; None
+        if there is no such conference.
+    """
+    memcache_key = MEMCACHE_DETAIL_KEY % wsck
+    detail = memcache.get(memcache_key)
+    if detail is not None:
+      return detail
+
+    # the sessions are queried while the conference and its organizer (the
+    # parent of the conference) are read
+    c_key = ndb.Key(urlsafe=wsck)
+    sessions_future = Session.query(ancestor=c_key).fetch_async()
+    conf, prof = ndb.get_multi([c_key, c_key.parent()])
+    if not conf:
+      return None
+    sessions = sorted(sessions_future.get_result(),
+                      key=lambda session: (session.date or date.max,
+                                           session.startTime or time.max))
+
+    detail = protojson.encode_message(ConferenceDetailForm(
+      conference=self._copyConferenceToForm(conf,
+                                            getattr(prof, "displayName")),
+      featuredSpeaker=self._getFeaturedSpeakers([wsck]).get(wsck),
+      sessions=[self._copySessionToForm(session) for session in sessions]))
+    memcache.set(memcache_key, detail, time=DETAIL_CACHE_SECONDS)
+    return detail
+
+
+
+  #----------------------------------------------------------
+  # API: Return everything the conference detail page shows
+  #----------------------------------------------------------
+  @endpoints.method(CONF_GET_REQUEST, ConferenceDetailForm,
+          path="conference/{websafeConferenceKey}/detail",
+          http_method="GET", name="getConferenceDetail")
+  def getConferenceDetail(self, request):
+    """ Return the conference, its organizer, featured speaker and
+        sessions (one cached aggregate), with the current seats available
+        and, for a signed in user, whether they attend it and which of
+        its sessions are in their wishlist.
+    """
+    wsck = request.websafeConferenceKey
+    # the profile of the user is read while the aggregate is looked up
+    user = endpoints.get_current_user()
+    prof_future = None
+    if user:
+      prof_future = ndb.Key(Profile,
+                            getUserId(user, id_type="oauth")).get_async()
+
+    detail = self._getConferenceDetail(wsck)
+    if detail is None:
+      raise endpoints.NotFoundException(
+        "No conference found with key: %s" % wsck)
+    form = protojson.decode_message(ConferenceDetailForm, detail)
+    counters.incrementLater(VIEWS_COUNTER % wsck)
+
+    # registrations do not invalidate the aggregate; their seat count is
+    # published by seats.py
+    state = seats.current(wsck)
+    if state:
+      form.conference.seatsAvailable = state[1]
+
+    prof = prof_future.get_result() if prof_future else None
+    if prof:
+      form.isAttending = wsck in prof.conferenceKeysToAttend
+      wssks = set(sf.wssk for sf in form.sessions)
+      form.wishlist = [wssk for wssk in prof.wishlist if wssk in wssks]
+    return form
 
 
 
@@ -765,11 +1394,12 @@ class ConferenceApi(remote.Service):
     p_key = ndb.Key(Profile, getUserId(user, id_type="oauth"))
 
     # create ancestor query for this user
-    conferences = Conference.query(ancestor=p_key)
+    conferences = Conference.query(ancestor=p_key).fetch_async()
 
     # get the user profile and display name
     prof = p_key.get()
-    displayName = getattr(prof, "displayName")
+    displayName = getattr(prof, "displayName", None)
+    conferences = conferences.get_result()
 
     # return set of ConferenceForm objects per Conference
     return ConferenceForms(
@@ -785,13 +1415,16 @@ class ConferenceApi(remote.Service):
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
   def _doWishlist(self, request, add=True):
     """ add and remove sessions from user's wishlist. """
+    # check if session exists given websafeSessionKey; the session is
+    # fetched while the user Profile is being retrieved
+    wssk = request.websafeSessionKey
+    s_key = ndb.Key(urlsafe=wssk) # session key
+    session_future = s_key.get_async()
+
     # get user Profile
     prof = self._getProfileFromUser()
 
-    # check if session exists given websafeSessionKey
-    wssk = request.websafeSessionKey
-    s_key = ndb.Key(urlsafe=wssk) # session key
-    session = s_key.get()
+    session = session_future.get_result()
     if not session:
       raise endpoints.NotFoundException(
         "No session found with key: %s" % wssk)
@@ -824,6 +1457,8 @@ class ConferenceApi(remote.Service):
 
     # update the profile in the cloud 
     prof.put()
+    counters.increment(WISHLIST_COUNTER % wssk, 1 if add else -1)
+    ical.invalidateWishlist(prof.key.id())
     return BooleanMessage(data=True)
 
 
@@ -834,6 +1469,7 @@ class ConferenceApi(remote.Service):
   @endpoints.method(SESSION_POST_REQUEST, BooleanMessage,
           path="wishlist/{websafeSessionKey}",
           http_method="POST", name="addSessionToWishlist")
+  @rateLimited
   def addSessionToWishlist(self, request):
     """ Add the session to the wishlist. """
     return self._doWishlist(request)
@@ -846,6 +1482,7 @@ class ConferenceApi(remote.Service):
   @endpoints.method(SESSION_POST_REQUEST, BooleanMessage,
           path="wishlist/{websafeSessionKey}",
           http_method="DELETE", name="deleteSessionInWishlist")
+  @rateLimited
   def deleteSessionInWishlist(self, request):
     """ Remove the session from the wishlist. """
     return self._doWishlist(request, add=False)
@@ -862,15 +1499,13 @@ class ConferenceApi(remote.Service):
     """ Query for all the sessions in a conference that the user 
         is interested in.
     """
-    # get user Profile
-    prof = self._getProfileFromUser() 
-
-    # get Conference object from request; bail if not found
+    # get Conference object from request; it is fetched in the background
     wsck = request.websafeConferenceKey
     c_key = ndb.Key(urlsafe=wsck)
-    if not c_key.get():
-      raise endpoints.NotFoundException(
-        "No conference found with key: %s" % request.websafeConferenceKey)
+    conf_future = c_key.get_async()
+
+    # get user Profile
+    prof = self._getProfileFromUser() 
 
     # get the list of keys for sessions in the wishlist
     s_keys = [ndb.Key(urlsafe=wssk) for wssk in prof.wishlist]  
@@ -879,11 +1514,17 @@ class ConferenceApi(remote.Service):
     s_keys = [cur_key for cur_key in s_keys if cur_key.parent() == c_key]
 
     # get the resultant session from the key list
-    sessions = ndb.get_multi(s_keys)
+    session_futures = ndb.get_multi_async(s_keys)
+
+    # bail if the conference is not found
+    if not conf_future.get_result():
+      raise endpoints.NotFoundException(
+        "No conference found with key: %s" % request.websafeConferenceKey)
+    sessions = [future.get_result() for future in session_futures]
 
     # return the SessionForms
     return SessionForms(
-        items=[self._copySessionToForm(session) for session in sessions]
+        items=[self._copySessionToForm(session) for session in sessions if session]
     )
 
 
@@ -897,12 +1538,13 @@ class ConferenceApi(remote.Service):
   def _conferenceRegistration(self, request, reg=True):
     """ Register or unregister user for selected conference. """
     retval = None
-    prof = self._getProfileFromUser() # get user Profile
 
     # check if conf exists given websafeConfKey
-    # get conference; check that it exists
+    # get conference (in parallel with the user Profile); check that it exists
     wsck = request.websafeConferenceKey
-    conf = ndb.Key(urlsafe=wsck).get()
+    conf_future = ndb.Key(urlsafe=wsck).get_async()
+    prof = self._getProfileFromUser() # get user Profile
+    conf = conf_future.get_result()
     if not conf:
       raise endpoints.NotFoundException(
         "No conference found with key: %s" % wsck)
@@ -932,9 +1574,17 @@ class ConferenceApi(remote.Service):
         retval = True
       else:
         retval = False
-    # write things back to the datastore & return
-    prof.put()
-    conf.put()
+    # write things back to the datastore & return; the watchers of the
+    # conference get the new seat count, and the registration is counted,
+    # once the transaction commits
+    if retval:
+      conf.seatsVersion += 1
+      def committed():
+        seats.publish(wsck, conf.seatsVersion, conf.seatsAvailable)
+        counters.incrementLater(REGISTRATIONS_COUNTER % wsck,
+                                1 if reg else -1)
+      ndb.get_context().call_on_commit(committed)
+    ndb.put_multi([prof, conf])
     return BooleanMessage(data=retval)
 
 
@@ -945,9 +1595,26 @@ class ConferenceApi(remote.Service):
   @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
           path="conference/{websafeConferenceKey}",
           http_method="POST", name="registerForConference")
+  @rateLimited
   def registerForConference(self, request):
     """ Register user for selected conference. """
-    return self._conferenceRegistration(request)
+    return self._register(request)
+
+
+
+  def _register(self, request, reg=True):
+    """ Run _conferenceRegistration() and count the attendee it added or
+        removed; a transaction that kept colliding is a ContentionException.
+    """
+    try:
+      result = self._conferenceRegistration(request, reg)
+    except datastore_errors.TransactionFailedError:
+      raise ContentionException(
+        "%s: too many registrations at once, try again." % CONTENTION)
+    if result.data:
+      counters.increment(ATTENDEES_COUNTER % request.websafeConferenceKey,
+                         1 if reg else -1)
+    return result
 
 
 
@@ -957,9 +1624,31 @@ class ConferenceApi(remote.Service):
   @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
           path="conference/{websafeConferenceKey}",
           http_method="DELETE", name="unregisterFromConference")
+  @rateLimited
   def unregisterFromConference(self, request):
     """ Unregister user for selected conference. """
-    return self._conferenceRegistration(request, reg=False)
+    return self._register(request, reg=False)
+
+
+
+  #----------------------------------------------------------
+  # API: wait for the seats available of a conference to change
+  #----------------------------------------------------------
+  @endpoints.method(SEATS_GET_REQUEST, SeatsForm,
+          path="conference/{websafeConferenceKey}/seats",
+          http_method="GET", name="watchConferenceSeats")
+  def watchConferenceSeats(self, request):
+    """ Long poll: return the seats available of a conference as soon as
+        their version differs from the given one (at once without a
+        version), or the unchanged state after seats.WATCH_SECONDS.
+    """
+    wsck = request.websafeConferenceKey
+    state = seats.watch(wsck, request.version)
+    if not state:
+      raise endpoints.NotFoundException(
+        "No conference found with key: %s" % wsck)
+    return SeatsForm(websafeConferenceKey=wsck, version=state[0],
+                     seatsAvailable=state[1])
 
 
 
@@ -1011,6 +1700,34 @@ class ConferenceApi(remote.Service):
 
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+#
+#       Index page bootstrap payload
+#
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+  @staticmethod
+  def _cacheBootstrap(announcement):
+    """ Create the JSON payload embedded in the index page (the announcement
+        and the first upcoming conferences) & assign to memcache; used by
+        the announcement cron job.
+    """
+    upcoming = json.loads(ConferenceApi._cacheUpcoming()).get("items", [])
+    payload = json.dumps({"announcement": announcement, "upcoming": upcoming})
+    memcache.set(MEMCACHE_BOOTSTRAP_KEY, payload)
+    return payload
+
+
+
+  @staticmethod
+  def _getBootstrap():
+    """ Return the cached bootstrap payload, or None. It is only ever read
+        from memcache; on a miss the page goes without it (and the client
+        makes the calls) until the next cron run.
+    """
+    return memcache.get(MEMCACHE_BOOTSTRAP_KEY)
+
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 #
 #       Featured speaker
@@ -1045,10 +1762,11 @@ class ConferenceApi(remote.Service):
     # this the message
     msg = "N/A"
 
-    if featured_speaker is not None:
+    if featured_speaker:
       # get the name of the featured speaker
       speakerKey = ndb.Key(Profile, featured_speaker)
-      speakerName = speakerKey.get().displayName 
+      speaker = speakerKey.get()
+      speakerName = getattr(speaker, "displayName", None) or featured_speaker
 
       # get all sessions by this speaker through additional filtering
       sessions = sessions.filter(Session.speaker == featured_speaker)
@@ -1057,15 +1775,93 @@ class ConferenceApi(remote.Service):
       session_names = ", ".join([session.name for session in sessions])
       msg = "%s (%s)" % (speakerName, session_names)
 
-      # store the featured speaker in memcache
-      memcache.set(memcache_key, msg)
-
-    else: # if no featured speaker
-      memcache.delete(memcache_key)
+    # store the featured speaker in memcache; "N/A" is cached as well so
+    # that readers know the conference exists without touching the datastore
+    memcache.set(memcache_key, msg)
+    memcache.delete(MEMCACHE_DETAIL_KEY % wsck)
     return msg
 
 
 
+  @staticmethod
+  def _scheduleFeaturedSpeaker(wsck):
+    """ Enqueue a featured speaker recompute for a given conference.
+        The task is named after the conference and the current time window,
+        so a burst of new sessions results in a single recompute that runs
+        once the window has closed.
+    """
+    now = (datetime.utcnow() - datetime(1970, 1, 1)).total_seconds()
+    bucket = int(now // FEATURED_SPEAKER_TASK_WINDOW)
+    countdown = (bucket + 1) * FEATURED_SPEAKER_TASK_WINDOW - now
+    try:
+      taskqueue.add(name="featured-speaker-%s-%d" % (wsck, bucket),
+                    params={"websafeConferenceKey": wsck},
+                    url="/tasks/set_featured_speaker",
+                    queue_name=FEATURED_SPEAKER_QUEUE,
+                    countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      # a recompute for this window is already scheduled (or has just run)
+      pass
+
+
+
+  @staticmethod
+  def _getFeaturedSpeakers(wscks):
+    """ Return a dict mapping each websafeConferenceKey to its featured
+        speaker message, or to None if there is no such conference.
+        Memcache is checked first with a single get_multi; the misses are
+        validated with a single ndb.get_multi and written back with a
+        single set_multi (unknown keys are negatively cached).
+    """
+    memcache_keys = dict((MEMCACHE_FEATUREDSPEAKER_KEY % wsck, wsck)
+                         for wsck in wscks)
+    cached = memcache.get_multi(memcache_keys.keys())
+
+    result = {}
+    misses = []
+    for memcache_key, wsck in memcache_keys.items():
+      if memcache_key in cached:
+        msg = cached[memcache_key]
+        result[wsck] = None if msg == MEMCACHE_NO_CONFERENCE else msg
+      else:
+        misses.append(wsck)
+
+    if not misses:
+      return result
+
+    # decode the missing keys; undecodable keys are unknown conferences
+    c_keys = {}
+    for wsck in misses:
+      try:
+        c_key = ndb.Key(urlsafe=wsck)
+      except Exception:
+        c_key = None
+      if c_key is not None and c_key.kind() == Conference._get_kind():
+        c_keys[wsck] = c_key
+      else:
+        result[wsck] = None
+
+    wscks_to_get = c_keys.keys()
+    confs = ndb.get_multi([c_keys[wsck] for wsck in wscks_to_get])
+    for wsck, conf in zip(wscks_to_get, confs):
+      # the conference exists but its featured speaker has not been set yet
+      result[wsck] = "N/A" if conf else None
+
+    # cache the conferences that exist and those that do not separately,
+    # since only the negative entries expire
+    found = dict((MEMCACHE_FEATUREDSPEAKER_KEY % wsck, result[wsck])
+                 for wsck in misses if result[wsck] is not None)
+    missing = dict((MEMCACHE_FEATUREDSPEAKER_KEY % wsck, MEMCACHE_NO_CONFERENCE)
+                   for wsck in misses if result[wsck] is None)
+    if found:
+      # add() so that a concurrent _cacheFeaturedSpeaker() is not overwritten
+      memcache.add_multi(found)
+    if missing:
+      memcache.add_multi(missing, time=MEMCACHE_NEGATIVE_TTL)
+    return result
+
+
+
   #----------------------------------------------------------
   # API: set/update the featured speaker for a given conference 
   #----------------------------------------------------------
@@ -1086,18 +1882,35 @@ class ConferenceApi(remote.Service):
           http_method="GET", name="getFeaturedSpeaker")
   def getFeaturedSpeaker(self, request):
     """ Fetch the featured speaker for a conference from the memcache. """
-    # get the conference model
     wsck = request.websafeConferenceKey
-    conf = ndb.Key(urlsafe=wsck).get()
+    msg = self._getFeaturedSpeakers([wsck])[wsck]
 
     # check if conf exists given websafeConfKey
-    if not conf:
+    if msg is None:
       raise endpoints.NotFoundException(
         "No conference found with key: %s" % wsck)
+    return StringMessage(data=msg)
 
-    # this is the resultant memcache key
-    memcache_key = MEMCACHE_FEATUREDSPEAKER_KEY % wsck
-    return StringMessage(data=memcache.get(memcache_key) or "N/A")
+
+
+  #----------------------------------------------------------
+  # API: Fetch the featured speakers for many conferences at once
+  #----------------------------------------------------------
+  @endpoints.method(FEATURED_SPEAKERS_GET_REQUEST, FeaturedSpeakerForms,
+          path="conferences/featured_speakers",
+          http_method="GET", name="getFeaturedSpeakers")
+  def getFeaturedSpeakers(self, request):
+    """ Fetch the featured speakers for a list of conferences. """
+    wscks = request.websafeConferenceKeys
+    speakers = self._getFeaturedSpeakers(set(wscks))
+
+    # keep the order of the request; unknown conferences are flagged
+    return FeaturedSpeakerForms(
+      items=[FeaturedSpeakerForm(websafeConferenceKey=wsck,
+                                 speaker=speakers[wsck] or "N/A",
+                                 found=speakers[wsck] is not None)
+             for wsck in wscks]
+    )
 
 
 
@@ -1123,7 +1936,11 @@ class ConferenceApi(remote.Service):
 
     # get the conference model
     wsck = request.websafeConferenceKey
-    conf = ndb.Key(urlsafe=wsck).get()
+    conf_future = ndb.Key(urlsafe=wsck).get_async()
+
+    # apply the filter; the query runs while the organizer is checked
+    query_result = Profile.query(Profile.conferenceKeysToAttend.IN([wsck,])).fetch_async()
+    conf = conf_future.get_result()
 
     # check that conference exists
     if not conf:
@@ -1134,9 +1951,7 @@ class ConferenceApi(remote.Service):
     if user_id != conf.organizerUserId:
       raise endpoints.ForbiddenException(
         "Only the conference organizer can query for attendees.")
-
-    # apply the filter
-    query_result = Profile.query(Profile.conferenceKeysToAttend.IN([wsck,]))
+    query_result = query_result.get_result()
 
     # return the ProfileForms
     return ProfileForms(
@@ -1156,12 +1971,7 @@ class ConferenceApi(remote.Service):
     # get the conference model
     wsck = request.websafeConferenceKey
     c_key = ndb.Key(urlsafe=wsck)
-    conf = c_key.get()
-
-    # check that conference exists
-    if not conf:
-      raise endpoints.NotFoundException(
-        "No conference found with key: %s" % wsck)
+    conf_future = c_key.get_async()
 
     # create ancestor query for this conference
     query_result = Session.query(ancestor=c_key)
@@ -1169,14 +1979,332 @@ class ConferenceApi(remote.Service):
     # apply the filter using date
     query_result = query_result.filter(\
          Session.date==datetime.strptime(request.date[:10], "%Y-%m-%d").date())
+    sessions_future = query_result.fetch_async()
+
+    # check that conference exists
+    if not conf_future.get_result():
+      raise endpoints.NotFoundException(
+        "No conference found with key: %s" % wsck)
 
     # return set of SessionForm objects per Session
     return SessionForms(
-      items=[self._copySessionToForm(session) for session in query_result]
+      items=[self._copySessionToForm(session)
+             for session in sessions_future.get_result()]
     )
- 
 
 
-# registers API
-api = endpoints.api_server([ConferenceApi]) 
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+#
+#       Counts
+#
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+  #----------------------------------------------------------
+  # API: dashboard counts of a conference (open only to the organizer)
+  #----------------------------------------------------------
+  @endpoints.method(CONF_GET_REQUEST, ConferenceCountsForm,
+          path="conference/{websafeConferenceKey}/counts",
+          http_method="GET", name="getConferenceCounts")
+  def getConferenceCounts(self, request):
+    """ Return the session counts per type and date, the attendee count and
+        the wishlist count of each session of a conference, without
+        fetching the sessions or the profiles.
+    """
+    # make sure that the user is authed
+    user = endpoints.get_current_user()
+    if not user:
+      raise endpoints.UnauthorizedException("Authorization required")
+    user_id = getUserId(user, id_type="oauth")
+
+    # all the counts are kept by sharded counters, maintained as sessions
+    # are created and users register; the session keys (for their wishlist
+    # counters) are queried while the conference is fetched
+    wsck = request.websafeConferenceKey
+    c_key = ndb.Key(urlsafe=wsck)
+    conf_future = c_key.get_async()
+    s_keys_future = Session.query(ancestor=c_key).fetch_async(keys_only=True)
+    conf = conf_future.get_result()
+
+    # check that conference exists
+    if not conf:
+      raise endpoints.NotFoundException(
+        "No conference found with key: %s" % wsck)
+
+    # check if the user is the organizer of the conference
+    if user_id != conf.organizerUserId:
+      raise endpoints.ForbiddenException(
+        "Only the conference organizer can get the conference counts.")
+
+    # session dates are within the conference dates; one count per day
+    types = [name for name, number in sorted(SessionType.to_dict().items(),
+                                             key=lambda item: item[1])]
+    days = []
+    if conf.startDate and conf.endDate and \
+        (conf.endDate - conf.startDate).days < COUNT_MAX_DAYS:
+      days = [conf.startDate + timedelta(days=n)
+              for n in range((conf.endDate - conf.startDate).days + 1)]
+
+    # how many wishlists hold each session is counted by _doWishlist, as
+    # profiles are too many to query
+    s_keys = s_keys_future.get_result()
+    counts = counters.getCounts(
+      [SESSIONS_COUNTER % wsck, ATTENDEES_COUNTER % wsck]
+      + [SESSIONS_BY_TYPE_COUNTER % (wsck, name) for name in types]
+      + [SESSIONS_BY_DATE_COUNTER % (wsck, day) for day in days]
+      + [WISHLIST_COUNTER % s_key.urlsafe() for s_key in s_keys])
+
+    by_type = [(name, counts[SESSIONS_BY_TYPE_COUNTER % (wsck, name)])
+               for name in types]
+    by_date = [(str(day), counts[SESSIONS_BY_DATE_COUNTER % (wsck, day)])
+               for day in days]
+    return ConferenceCountsForm(
+      websafeConferenceKey=wsck,
+      sessions=counts[SESSIONS_COUNTER % wsck],
+      sessionsByType=[CountForm(name=name, count=count)
+                      for name, count in by_type if count],
+      sessionsByDate=[CountForm(name=name, count=count)
+                      for name, count in by_date if count],
+      attendees=counts[ATTENDEES_COUNTER % wsck],
+      seatsAvailable=conf.seatsAvailable,
+      wishlistBySession=[
+        CountForm(name=s_key.urlsafe(),
+                  count=counts[WISHLIST_COUNTER % s_key.urlsafe()])
+        for s_key in s_keys],
+    )
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+#
+#       Trending conferences
+#
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+  @staticmethod
+  def _cacheTrending():
+    """ Flush the pending view and registration counters into the decayed
+        trending scores of their conferences, then create the list of the
+        top upcoming conferences & assign it to memcache and the
+        datastore, as JSON; used by the trending cron job.
+    """
+    activity = {}
+    views = VIEWS_COUNTER % ""
+    registrations = REGISTRATIONS_COUNTER % ""
+    for name, delta in counters.flushPending().items():
+      if name.startswith(views):
+        wsck = name[len(views):]
+      elif name.startswith(registrations):
+        wsck = name[len(registrations):]
+        delta *= TRENDING_REGISTRATION_WEIGHT
+      else:
+        continue
+      c_key = ndb.Key(urlsafe=wsck)
+      activity[c_key] = activity.get(c_key, 0) + delta
+
+    trending = TrendingConferences.get_by_id(TRENDING_ID) or \
+      TrendingConferences(id=TRENDING_ID)
+    decay = 1.0
+    if trending.updated:
+      hours = (datetime.now() - trending.updated).total_seconds() / 3600.0
+      decay = 0.5 ** (hours / TRENDING_HALF_LIFE_HOURS)
+    scores = dict((c_key, score * decay) for c_key, score
+                  in zip(trending.conferences, trending.scores))
+    for c_key, delta in activity.items():
+      scores[c_key] = scores.get(c_key, 0.0) + delta
+    kept = sorted((c_key for c_key in scores
+                   if scores[c_key] >= TRENDING_MIN_SCORE),
+                  key=lambda key: -scores[key])[:TRENDING_KEEP]
+
+    # the top conferences are fetched with their organizers, the parents
+    # of their keys; some of them may be over already, or deleted
+    best = kept[:2 * TRENDING_COUNT]
+    organisers = list(set(c_key.parent() for c_key in best))
+    entities = ndb.get_multi(best + organisers)
+    names = dict((profile.key.id(), profile.displayName)
+                 for profile in entities[len(best):] if profile)
+    api = ConferenceApi()
+    today = date.today()
+    top = protojson.encode_message(ConferenceForms(items=[
+      api._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+      for conf in entities[:len(best)]
+      if conf and not (conf.endDate and conf.endDate < today)
+    ][:TRENDING_COUNT]))
+
+    deleted = set(c_key for c_key, conf in zip(best, entities) if not conf)
+    trending.conferences = [c_key for c_key in kept if c_key not in deleted]
+    trending.scores = [scores[c_key] for c_key in trending.conferences]
+    trending.top = top
+    trending.put()
+    memcache.set(MEMCACHE_TRENDING_KEY, top)
+    return top
+
+
+
+  #----------------------------------------------------------
+  # API: Return the trending conferences
+  #----------------------------------------------------------
+  @endpoints.method(message_types.VoidMessage, ConferenceForms,
+          path="conferences/trending",
+          http_method="GET", name="getTrendingConferences")
+  def getTrendingConferences(self, request):
+    """ Return the most viewed and registered for upcoming conferences
+        lately, as computed by the trending cron job.
+    """
+    top = memcache.get(MEMCACHE_TRENDING_KEY)
+    if top is None:
+      trending = TrendingConferences.get_by_id(TRENDING_ID)
+      top = trending.top if trending else None
+      if top:
+        memcache.add(MEMCACHE_TRENDING_KEY, top)
+    if not top:
+      return ConferenceForms()
+    return protojson.decode_message(ConferenceForms, top)
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+#
+#       Batch
+#
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+  @staticmethod
+  def _batchKeys(requests):
+    """ Return the keys of the entities the requests refer to by websafe
+        key, and of their parents (organizer profiles, conferences).
+    """
+    keys = set()
+    for request in requests:
+      for name in BATCH_KEY_FIELDS:
+        values = getattr(request, name, None) or []
+        if isinstance(values, basestring):
+          values = [values]
+        for value in values:
+          try:
+            key = ndb.Key(urlsafe=value)
+          except Exception:
+            # a bad key fails its own call later on
+            continue
+          keys.add(key)
+          if key.parent():
+            keys.add(key.parent())
+    return list(keys)
+
+
+
+  @staticmethod
+  def _batchOutcome(name, call):
+    """ Return (response, None) of a batch call, or (None, error) when it
+        failed; only this call fails.
+    """
+    try:
+      return call(), None
+    except endpoints.ServiceException as e:
+      return None, e
+    except Exception as e:
+      # e.g. a malformed websafe key
+      logging.exception("Batch call %s failed", name)
+      return None, endpoints.InternalServerErrorException(
+        "%s failed: %s" % (name, e))
+
+
+
+  def _batchWait(self, calls, pending, outcomes):
+    """ Wait for the started (index, future) calls of a batch and record
+        their outcomes.
+    """
+    for index, future in pending:
+      outcomes[index] = self._batchOutcome(calls[index][0], future.get_result)
+
+
+
+  #----------------------------------------------------------
+  # API: run several API calls in one request
+  #----------------------------------------------------------
+  @endpoints.method(BatchCallForms, BatchResultForms, path="batch",
+          http_method="POST", name="batch")
+  def batch(self, request):
+    """ Run several API calls (method name plus JSON request message) in
+        one request; return the result of each call, in order.
+    """
+    if len(request.calls) > BATCH_MAX_CALLS:
+      raise endpoints.BadRequestException(
+        "A batch holds at most %d calls." % BATCH_MAX_CALLS)
+    methods = self.all_remote_methods()
+
+    # decode all the requests first; a bad one only fails its own call
+    calls = []
+    for call in request.calls:
+      method = methods.get(call.method)
+      if not method or call.method == "batch":
+        calls.append((call.method, None, endpoints.NotFoundException(
+          "Unknown method: %s" % call.method)))
+        continue
+      try:
+        sub_request = protojson.decode_message(method.remote.request_type,
+                                               call.params or "{}")
+      except (messages.Error, ValueError) as e:
+        calls.append((call.method, None, endpoints.BadRequestException(
+          "Bad params for %s: %s" % (call.method, e))))
+        continue
+      calls.append((call.method, sub_request, None))
+
+    # get the entities of all the calls in one batch into the request's
+    # ndb context cache, where the calls find them; the user (resolved once
+    # for the whole batch, see getUserId) is looked up while they are in
+    # flight, then the profile is added to the batch
+    futures = ndb.get_multi_async(self._batchKeys(
+      sub_request for name, sub_request, error in calls if sub_request))
+    user = endpoints.get_current_user()
+    if user:
+      futures.append(
+        ndb.Key(Profile, getUserId(user, id_type="oauth")).get_async())
+    ndb.Future.wait_all(futures)
+
+    # take the rate limit tokens of all the calls at once; the calls of a
+    # method that ran out of tokens fail
+    waits = ratelimit.take(RATE_LIMITS, [name for name, sub_request, error
+                                         in calls])
+    for index, wait in enumerate(waits):
+      name, sub_request, error = calls[index]
+      if wait is not None and error is None:
+        calls[index] = (name, None, ratelimit.refuse(name, wait))
+
+    # the read-only calls with a tasklet are started at once and run
+    # together; the other calls run in order, once the calls before them
+    # are done, so that a call sees the writes of the previous ones
+    outcomes = [None] * len(calls)
+    pending = []
+    with ratelimit.prepaid():
+      for index, (name, sub_request, error) in enumerate(calls):
+        if error is not None:
+          outcomes[index] = (None, error)
+        elif name in BATCH_ASYNC_METHODS:
+          future = getattr(self, BATCH_ASYNC_METHODS[name])(sub_request)
+          pending.append((index, future))
+        else:
+          self._batchWait(calls, pending, outcomes)
+          pending = []
+          outcomes[index] = self._batchOutcome(
+            name, lambda: getattr(self, name)(sub_request))
+      self._batchWait(calls, pending, outcomes)
+
+    items = []
+    for index, (response, error) in enumerate(outcomes):
+      name = calls[index][0]
+      if error is not None:
+        items.append(BatchResultForm(method=name, error=str(error),
+          status=getattr(error, "http_status", httplib.BAD_REQUEST)))
+      else:
+        items.append(BatchResultForm(method=name, status=httplib.OK,
+          result=protojson.encode_message(response)))
+    return BatchResultForms(items=items)
+
+
+# registers API; SPI paths end in ConferenceApi.<method name>; sampled
+# requests are profiled (see profiling.py)
+API_ENDPOINTS = ["ConferenceApi.%s" % name
+                 for name in ConferenceApi.all_remote_methods()]
+api = profiling.profile(
+  instrumentation.instrument(endpoints.api_server([ConferenceApi]),
+                             API_ENDPOINTS),
+  API_ENDPOINTS)
 
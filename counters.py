@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+""" counters.py
+
+Sharded counters, for the counts that are too large to compute with a
+query whenever they are read (e.g. how many wishlists hold a session).
+
+A counter is split into SHARDS CounterShard entities, so that concurrent
+increments seldom write the same entity group: an increment adds to one
+random shard in a transaction, then to the cached total in memcache.
+Totals are read from memcache, for many counters at once, and summed
+from the shards of the counters that are not cached.
+
+Counters bumped on every read of a page (e.g. conference views) are
+written behind instead: incrementLater() only adds to a pending delta in
+memcache, and flush(), run by a cron job for the counters it names, moves
+the pending deltas to one more shard per counter, its flush shard, which
+is only written by flush(). An increment that memcache evicts before it
+is flushed is lost.
+
+The first increment of a counter since it was last flushed also writes
+its name into the next slot of a memcache registry (numbered with an
+incr), so flushPending() flushes just the counters with pending
+increments, read from the slots filled since its last run.
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import CounterShard
+
+SHARDS = 10
+# most entity groups a cross-group transaction may write
+XG_MAX_GROUPS = 25
+
+# memcache namespace of the cached totals; they expire, so that a total
+# that missed an increment (e.g. one made while it was being summed) is
+# corrected after a while
+COUNTERS_NAMESPACE = "counters"
+CACHE_SECONDS = 3600
+
+# memcache namespace of the increments not flushed yet; memcache counters
+# cannot go below zero, so a pending delta is kept as PENDING_BASE + delta
+PENDING_NAMESPACE = "counters-pending"
+PENDING_BASE = 1 << 32
+
+# registry of the counters with pending increments, in PENDING_NAMESPACE:
+# slots DIRTY_SLOT_KEY % 1..n, n being the value of DIRTY_COUNT_KEY, and
+# the last slot read by flushPending(). A slot that is still empty among
+# the last DIRTY_GRACE_SLOTS is being written and is read next time.
+DIRTY_COUNT_KEY = "dirty"
+DIRTY_FLUSHED_KEY = "dirty-flushed"
+DIRTY_SLOT_KEY = "dirty|%d"
+DIRTY_SLOT_SECONDS = 86400
+DIRTY_GRACE_SLOTS = 100
+FLUSH_MAX_SLOTS = 5000
+
+
+
+def _shardKeys(name):
+  return [ndb.Key(CounterShard, "%s|%d" % (name, index))
+          for index in range(SHARDS)]
+
+
+
+def _flushShardKey(name):
+  return ndb.Key(CounterShard, "%s|flush" % name)
+
+
+
+@ndb.transactional
+def _addToShard(key, delta):
+  shard = key.get() or CounterShard(key=key)
+  shard.count += delta
+  shard.put()
+
+
+
+def increment(name, delta=1):
+  """ Add delta (which may be negative) to a counter. """
+  _addToShard(random.choice(_shardKeys(name)), delta)
+  # a total that is not cached is left alone; it is summed when read
+  memcache.offset_multi({name: delta}, namespace=COUNTERS_NAMESPACE)
+
+
+
+def incrementMulti(deltas):
+  """ Add to several counters ({name: delta}), a random shard of each, in
+      cross-group transactions of up to XG_MAX_GROUPS counters.
+  """
+  names = list(deltas)
+  for start in range(0, len(names), XG_MAX_GROUPS):
+    _addToShards(dict((random.choice(_shardKeys(name)), deltas[name])
+                      for name in names[start:start + XG_MAX_GROUPS]))
+  memcache.offset_multi(deltas, namespace=COUNTERS_NAMESPACE)
+
+
+
+@ndb.transactional(xg=True)
+def _addToShards(deltas):
+  keys = list(deltas)
+  shards = []
+  for key, shard in zip(keys, ndb.get_multi(keys)):
+    shard = shard or CounterShard(key=key)
+    shard.count += deltas[key]
+    shards.append(shard)
+  ndb.put_multi(shards)
+
+
+
+def setCount(name, total):
+  """ Set the total of a counter, e.g. to recount it; an increment made
+      meanwhile may be lost.
+  """
+  _setShards(name, total)
+  memcache.delete(name, namespace=COUNTERS_NAMESPACE)
+
+
+
+@ndb.transactional(xg=True)
+def _setShards(name, total):
+  keys = _shardKeys(name) + [_flushShardKey(name)]
+  ndb.put_multi([CounterShard(key=key, count=total if index == 0 else 0)
+                 for index, key in enumerate(keys)])
+
+
+
+def getCounts(names):
+  """ Return {name: total} for the counters; one memcache call, plus one
+      get_multi of the shards of the totals that are not cached.
+  """
+  counts = memcache.get_multi(names, namespace=COUNTERS_NAMESPACE)
+  missing = [name for name in names if name not in counts]
+  if missing:
+    shards = ndb.get_multi([key for name in missing
+                            for key in _shardKeys(name) + [_flushShardKey(name)]])
+    totals = {}
+    per_name = SHARDS + 1
+    for index, name in enumerate(missing):
+      totals[name] = sum(shard.count for shard in
+                         shards[index * per_name:(index + 1) * per_name]
+                         if shard)
+    memcache.add_multi(totals, time=CACHE_SECONDS,
+                       namespace=COUNTERS_NAMESPACE)
+    counts.update(totals)
+  return counts
+
+
+
+def incrementLater(name, delta=1):
+  """ Add delta (which may be negative) to a counter in memcache only; it
+      reaches the datastore with the next flush() of the counter.
+  """
+  values = memcache.offset_multi({name: delta}, namespace=PENDING_NAMESPACE,
+                                 initial_value=PENDING_BASE) or {}
+  # the first pending increment of the counter registers it
+  if values.get(name) == PENDING_BASE + delta:
+    _registerPending([name])
+
+
+
+def _registerPending(names):
+  """ Write the names of counters with pending increments into the next
+      slots of the registry.
+  """
+  last = memcache.incr(DIRTY_COUNT_KEY, delta=len(names),
+                       namespace=PENDING_NAMESPACE, initial_value=0)
+  if last is None:
+    return
+  first = last - len(names) + 1
+  memcache.set_multi(dict((DIRTY_SLOT_KEY % (first + index), name)
+                          for index, name in enumerate(names)),
+                     time=DIRTY_SLOT_SECONDS, namespace=PENDING_NAMESPACE)
+
+
+
+def flush(names):
+  """ Write the pending increments of the counters to their flush shards;
+      return {name: delta written} for the counters that had some. Only
+      one flush() may run at a time (it is run by a cron job).
+  """
+  pending = memcache.get_multi(names, namespace=PENDING_NAMESPACE)
+  deltas = dict((name, int(value) - PENDING_BASE)
+                for name, value in pending.items()
+                if int(value) != PENDING_BASE)
+  if not deltas:
+    return {}
+  # take the deltas out of memcache first; the increments made meanwhile
+  # stay pending, and their counters are registered again
+  left = memcache.offset_multi(
+    dict((name, -delta) for name, delta in deltas.items()),
+    namespace=PENDING_NAMESPACE) or {}
+  again = [name for name, value in left.items()
+           if value is not None and value != PENDING_BASE]
+  if again:
+    _registerPending(again)
+
+  flushed = list(deltas)
+  keys = [_flushShardKey(name) for name in flushed]
+  shards = []
+  for name, key, shard in zip(flushed, keys, ndb.get_multi(keys)):
+    shard = shard or CounterShard(key=key)
+    shard.count += deltas[name]
+    shards.append(shard)
+  ndb.put_multi(shards)
+  memcache.offset_multi(deltas, namespace=COUNTERS_NAMESPACE)
+  return deltas
+
+
+
+def flushPending():
+  """ flush() the counters registered as pending since the last call;
+      return {name: delta written}. Run by a cron job, one at a time.
+  """
+  count = memcache.get(DIRTY_COUNT_KEY, namespace=PENDING_NAMESPACE)
+  if not count:
+    return {}
+  count = int(count)
+  read = int(memcache.get(DIRTY_FLUSHED_KEY, namespace=PENDING_NAMESPACE)
+             or 0)
+  if read > count:
+    # the slot number was evicted and started again
+    read = 0
+  last = min(count, read + FLUSH_MAX_SLOTS)
+  slots = range(read + 1, last + 1)
+  names = memcache.get_multi([DIRTY_SLOT_KEY % slot for slot in slots],
+                             namespace=PENDING_NAMESPACE)
+
+  # stop before a recent slot that has been numbered but not written yet
+  for slot in slots:
+    if DIRTY_SLOT_KEY % slot not in names and slot > count - DIRTY_GRACE_SLOTS:
+      last = slot - 1
+      break
+  memcache.set(DIRTY_FLUSHED_KEY, last, namespace=PENDING_NAMESPACE)
+  return flush(list(set(name for key, name in names.items()
+                        if int(key.split("|")[1]) <= last)))
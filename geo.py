@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+""" geo.py
+
+Offline geocoding of conference cities and geohash based "nearby" search.
+
+Cities are looked up in gazetteer.csv (name, country, latitude and
+longitude of major cities), bundled with the app, so creating a
+conference makes no geocoding call. Conference.geohash holds the geohash
+of the city, GEOHASH_PRECISION characters long; all the conferences in a
+geohash cell share its prefix, so a cell is a range of that property.
+
+A "within N km" search takes the cells of the longest geohash length
+whose cells are at least N km high and wide, so that the circle fits in
+the 3x3 block of cells around its center, and keeps those the circle
+touches (coverPrefixes()). One prefix range query per cell, projected
+on the geohash, finds the candidates, which are then refined with the
+distance to the center of their geohash (decode()), a few meters from
+the city at GEOHASH_PRECISION.
+
+"""
+
+import csv
+import math
+import os
+
+from google.appengine.ext import ndb
+
+GAZETTEER = os.path.join(os.path.dirname(__file__), "gazetteer.csv")
+GEOHASH_PRECISION = 8
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# normalized city name -> (latitude, longitude); loaded on first use
+_cities = None
+
+
+
+def _normalize(name):
+  return " ".join((name or "").lower().split())
+
+
+
+def geocode(city):
+  """ Return the (latitude, longitude) of a city, or None if the city is
+      not in the gazetteer.
+  """
+  global _cities
+  if _cities is None:
+    with open(GAZETTEER) as f:
+      _cities = dict(
+        (_normalize(row["name"]),
+         (float(row["latitude"]), float(row["longitude"])))
+        for row in csv.DictReader(f))
+  return _cities.get(_normalize(city))
+
+
+
+def locate(city):
+  """ Return the Conference (location, geohash) of a city; (None, None)
+      if the city is not in the gazetteer.
+  """
+  point = geocode(city)
+  if not point:
+    return None, None
+  return ndb.GeoPt(*point), encode(*point)
+
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+  """ Return the geohash of a point. """
+  ranges = [[-180.0, 180.0], [-90.0, 90.0]]   # longitude, latitude
+  values = [longitude, latitude]
+  chars = []
+  bit = 0
+  while len(chars) < precision:
+    value = 0
+    for shift in range(4, -1, -1):
+      rng = ranges[bit % 2]
+      mid = (rng[0] + rng[1]) / 2
+      if values[bit % 2] >= mid:
+        value |= 1 << shift
+        rng[0] = mid
+      else:
+        rng[1] = mid
+      bit += 1
+    chars.append(BASE32[value])
+  return "".join(chars)
+
+
+
+def decode(geohash):
+  """ Return the (latitude, longitude) of the center of a geohash cell. """
+  (south, north), (west, east) = _bbox(geohash)
+  return (south + north) / 2, (west + east) / 2
+
+
+
+def _bbox(geohash):
+  """ Return ((south, north), (west, east)) of a geohash cell. """
+  ranges = [[-180.0, 180.0], [-90.0, 90.0]]   # longitude, latitude
+  bit = 0
+  for char in geohash:
+    value = BASE32.index(char)
+    for shift in range(4, -1, -1):
+      rng = ranges[bit % 2]
+      mid = (rng[0] + rng[1]) / 2
+      if value >> shift & 1:
+        rng[0] = mid
+      else:
+        rng[1] = mid
+      bit += 1
+  return tuple(ranges[1]), tuple(ranges[0])
+
+
+
+def _cellDegrees(precision):
+  """ Return the (height, width) in degrees of the cells of a length. """
+  bits = 5 * precision
+  return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+
+def distanceKm(lat1, lon1, lat2, lon2):
+  """ Great-circle (haversine) distance between two points. """
+  dlat = math.radians(lat2 - lat1)
+  dlon = math.radians(lon2 - lon1)
+  a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) \
+      * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+  return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+
+def _distanceToCell(latitude, longitude, geohash):
+  """ Distance from a point to the nearest point of a geohash cell. """
+  (south, north), (west, east) = _bbox(geohash)
+  # the side of the antimeridian the point is on
+  if west - longitude > 180:
+    west, east = west - 360, east - 360
+  elif longitude - east > 180:
+    west, east = west + 360, east + 360
+  return distanceKm(latitude, longitude, min(max(latitude, south), north),
+                    min(max(longitude, west), east))
+
+
+
+def coverPrefixes(latitude, longitude, km):
+  """ Return the geohash prefixes of the cells that hold every point
+      within km of a point.
+  """
+  precision = 1
+  for length in range(GEOHASH_PRECISION, 0, -1):
+    height, width = _cellDegrees(length)
+    if height * KM_PER_DEGREE >= km and width * KM_PER_DEGREE \
+        * math.cos(math.radians(latitude)) >= km:
+      precision = length
+      break
+
+  height, width = _cellDegrees(precision)
+  prefixes = set()
+  for dlat in (-height, 0, height):
+    if not -90 <= latitude + dlat <= 90:
+      continue
+    for dlon in (-width, 0, width):
+      prefix = encode(latitude + dlat,
+                      (longitude + dlon + 180) % 360 - 180, precision)
+      if _distanceToCell(latitude, longitude, prefix) <= km:
+        prefixes.add(prefix)
+  return sorted(prefixes)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+""" ical.py
+
+iCalendar (RFC 5545) feeds of the sessions of a conference and of the
+sessions in a user's wishlist, for calendar clients to subscribe to
+(CalendarHandler in main.py).
+
+A feed is written straight from the Session entities, page by page
+(FEED_PAGE_SIZE sessions per datastore call, the next page being fetched
+while the current one is written), without building SessionForms. The
+text is kept in memcache with its ETag and Last-Modified date until the
+schedule changes (invalidateConference(), invalidateWishlist()), or for
+CACHE_SECONDS at most since edits of the conferences themselves are not
+tracked.
+
+The ETag is a hash of the feed written without its DTSTAMPs, and the
+hash is remembered (in memcache, with no expiration) with the time it
+was first seen, which gives the DTSTAMPs and Last-Modified. A feed built
+again with the same content keeps its validators, so clients still get a
+304 after the cached text expired or was invalidated.
+
+"""
+
+import calendar
+import email.utils
+import hashlib
+import logging
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import Session
+
+FEED_PAGE_SIZE = 100
+CACHE_SECONDS = 3600
+MEMCACHE_CONFERENCE_FEED_KEY = "ICAL_CONFERENCE %s"
+MEMCACHE_WISHLIST_FEED_KEY = "ICAL_WISHLIST %s"
+# memcache key of the (content hash, modification time) of a feed, from
+# its feed key
+MEMCACHE_FEED_VERSION_KEY = "%s VERSION"
+# stands for the DTSTAMP while the content of a feed is hashed
+STAMP_PLACEHOLDER = "@DTSTAMP@"
+
+PRODID = "-//Conference Central//Sessions//EN"
+UID_DOMAIN = "conference-central"
+
+
+
+def _escape(text):
+  return (unicode(text).replace("\\", "\\\\").replace(";", "\\;")
+          .replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+
+def _fold(line):
+  """ Fold a content line into lines of at most 75 octets. """
+  data = line.encode("utf-8")
+  lines = []
+  while len(data) > 75:
+    cut = 75 if not lines else 74
+    # do not split a UTF-8 sequence
+    while cut and (ord(data[cut]) & 0xC0) == 0x80:
+      cut -= 1
+    lines.append(data[:cut])
+    data = data[cut:]
+  lines.append(data)
+  return "\r\n ".join(lines) + "\r\n"
+
+
+
+def _event(session, conf):
+  """ Return the VEVENT of a session, or "" for a session with no date. """
+  if not session.date:
+    return ""
+  lines = [
+    "BEGIN:VEVENT",
+    "UID:%s@%s" % (session.key.urlsafe(), UID_DOMAIN),
+    "DTSTAMP:%s" % STAMP_PLACEHOLDER,
+  ]
+  if session.startTime:
+    # floating times: the local time of the conference
+    start = datetime.combine(session.date, session.startTime)
+    lines.append("DTSTART:%s" % start.strftime("%Y%m%dT%H%M%S"))
+    if session.endTime:
+      end = datetime.combine(session.date, session.endTime)
+      lines.append("DTEND:%s" % end.strftime("%Y%m%dT%H%M%S"))
+  else:
+    lines.append("DTSTART;VALUE=DATE:%s" % session.date.strftime("%Y%m%d"))
+  lines.append("SUMMARY:%s" % _escape(session.name))
+  description = []
+  if session.speaker:
+    description.append("Speaker: %s" % session.speaker)
+  if session.highlights:
+    description.append(session.highlights)
+  if conf:
+    description.append("Conference: %s" % conf.name)
+    if conf.city:
+      lines.append("LOCATION:%s" % _escape(conf.city))
+  if description:
+    lines.append("DESCRIPTION:%s" % _escape("\n".join(description)))
+  if session.typeOfSession and session.typeOfSession != "NOT_SPECIFIED":
+    lines.append("CATEGORIES:%s" % _escape(session.typeOfSession))
+  lines.append("END:VEVENT")
+  return "".join(_fold(line) for line in lines)
+
+
+
+def _queryPages(query):
+  """ Yield the pages of a query, fetching each page while the previous
+      one is being used.
+  """
+  future = query.fetch_page_async(FEED_PAGE_SIZE)
+  while future:
+    page, cursor, more = future.get_result()
+    future = None
+    if more and cursor:
+      future = query.fetch_page_async(FEED_PAGE_SIZE, start_cursor=cursor)
+    yield page
+
+
+
+def _keyPages(keys):
+  """ Yield the entities of keys by pages, like _queryPages(). """
+  pages = [keys[i:i + FEED_PAGE_SIZE]
+           for i in range(0, len(keys), FEED_PAGE_SIZE)]
+  futures = ndb.get_multi_async(pages[0]) if pages else None
+  for index in range(len(pages)):
+    current = futures
+    if index + 1 < len(pages):
+      futures = ndb.get_multi_async(pages[index + 1])
+    yield [future.get_result() for future in current]
+
+
+
+def _calendar(name, pages, confs):
+  """ Return the iCalendar text of the sessions of pages, with
+      STAMP_PLACEHOLDER for their DTSTAMP; confs gives the conference of a
+      session key (or None).
+  """
+  parts = [_fold(line) for line in (
+    "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:%s" % PRODID,
+    "CALSCALE:GREGORIAN", "X-WR-CALNAME:%s" % _escape(name))]
+  for page in pages:
+    page = [session for session in page if session]
+    page_confs = confs(page)
+    for session in page:
+      parts.append(_event(session, page_confs.get(session.key.parent())))
+  parts.append(_fold("END:VCALENDAR"))
+  return "".join(parts)
+
+
+
+def _cached(key, build):
+  """ Return (body, etag, last modified) from memcache, or build the body
+      and cache it.
+  """
+  feed = memcache.get(key)
+  if feed is None:
+    body = build()
+    if body is None:
+      return None
+    # the same content keeps the modification time it was first seen at
+    digest = hashlib.md5(body).hexdigest()
+    version_key = MEMCACHE_FEED_VERSION_KEY % key
+    version = memcache.get(version_key)
+    if not version or version[0] != digest:
+      version = (digest, datetime.utcnow())
+      memcache.set(version_key, version)
+    modified = version[1]
+    body = body.replace(STAMP_PLACEHOLDER, modified.strftime("%Y%m%dT%H%M%SZ"))
+    feed = (body, '"%s"' % digest, email.utils.formatdate(
+      calendar.timegm(modified.utctimetuple()), usegmt=True))
+    try:
+      memcache.set(key, feed, time=CACHE_SECONDS)
+    except ValueError:
+      # too large for memcache; built again on the next request
+      logging.warning("Calendar feed %s not cached: %d bytes", key, len(body))
+  return feed
+
+
+
+def conferenceFeed(wsck):
+  """ Return (body, etag, last modified) of the feed of a conference's
+      sessions, or None if there is no such conference.
+  """
+  try:
+    c_key = ndb.Key(urlsafe=wsck)
+  except Exception:
+    return None
+  if c_key.kind() != "Conference":
+    return None
+
+  def build():
+    conf = c_key.get()
+    if not conf:
+      return None
+    return _calendar(conf.name, _queryPages(Session.query(ancestor=c_key)),
+                     lambda page: {c_key: conf})
+  return _cached(MEMCACHE_CONFERENCE_FEED_KEY % wsck, build)
+
+
+
+def wishlistFeed(user_id, token):
+  """ Return (body, etag, last modified) of the feed of the sessions in a
+      user's wishlist, or None unless token is the user's calendarToken.
+  """
+  # the token is checked (with one get) before the cached feed is used
+  prof = ndb.Key(Profile, user_id).get()
+  if not prof or not prof.calendarToken or prof.calendarToken != token:
+    return None
+
+  def build():
+    def confs(page):
+      c_keys = list(set(session.key.parent() for session in page))
+      return dict(zip(c_keys, ndb.get_multi(c_keys)))
+    s_keys = [ndb.Key(urlsafe=wssk) for wssk in prof.wishlist]
+    name = "Wishlist"
+    if prof.displayName:
+      name = "%s's wishlist" % prof.displayName
+    return _calendar(name, _keyPages(s_keys), confs)
+  return _cached(MEMCACHE_WISHLIST_FEED_KEY % user_id, build)
+
+
+
+def invalidateConference(wsck):
+  """ Drop the cached feed of a conference after its schedule changed. """
+  memcache.delete(MEMCACHE_CONFERENCE_FEED_KEY % wsck)
+
+
+
+def invalidateWishlist(user_id):
+  """ Drop the cached feed of a user's wishlist after it changed. """
+  memcache.delete(MEMCACHE_WISHLIST_FEED_KEY % user_id)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+""" instrumentation.py
+
+Per-request RPC instrumentation for the API and the webapp2 handlers.
+
+instrument() wraps a WSGI app; while one of its requests is running, every
+API call (datastore, memcache, taskqueue, urlfetch, mail...) made from the
+request thread is counted and timed through apiproxy hooks, so ndb,
+memcache and friends are covered without touching their call sites. At
+the end of the request the counters are added to per-endpoint totals in
+memcache with a single offset_multi, and requests slower than
+settings.STATS_SLOW_REQUEST_MS are logged with their RPC breakdown.
+
+getStats() reads the totals back for the admin stats handler in main.py.
+
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+from settings import STATS_SLOW_REQUEST_MS
+
+# memcache namespace of the counters
+STATS_NAMESPACE = "stats"
+
+# upper bounds (in ms) of the request latency histogram buckets
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# RPC categories reported per endpoint; (service, call) pairs that are
+# not listed in RPC_CATEGORIES count as "<service>" or "other"
+CATEGORIES = ("get", "query", "put", "delete", "txn", "memcache",
+              "taskqueue", "urlfetch", "mail", "other")
+RPC_CATEGORIES = {
+  ("datastore_v3", "Get"): "get",
+  ("datastore_v3", "RunQuery"): "query",
+  ("datastore_v3", "Next"): "query",
+  ("datastore_v3", "Count"): "query",
+  ("datastore_v3", "Put"): "put",
+  ("datastore_v3", "AllocateIds"): "put",
+  ("datastore_v3", "Delete"): "delete",
+  ("datastore_v3", "BeginTransaction"): "txn",
+  ("datastore_v3", "Commit"): "txn",
+  ("datastore_v3", "Rollback"): "txn",
+}
+
+# names of the instrumented endpoints, for getStats()
+ENDPOINTS = set()
+
+_local = threading.local()
+
+
+
+class _RequestStats(object):
+  """ RPC counters of the request running in the current thread. """
+  def __init__(self, endpoint):
+    self.endpoint = endpoint
+    self.start = time.time()
+    self.calls = dict((category, 0) for category in CATEGORIES)
+    self.ms = dict((category, 0.0) for category in CATEGORIES)
+    self.rpcs = []
+    self.pending = {}
+
+
+
+def _category(service, call):
+  category = RPC_CATEGORIES.get((service, call))
+  if category:
+    return category
+  if service in CATEGORIES:
+    return service
+  return "other"
+
+
+
+def _preCall(service, call, request, response, rpc):
+  stats = getattr(_local, "stats", None)
+  if stats is not None:
+    stats.pending[id(rpc)] = time.time()
+
+
+
+def _postCall(service, call, request, response, rpc, error):
+  stats = getattr(_local, "stats", None)
+  if stats is None:
+    return
+  start = stats.pending.pop(id(rpc), None)
+  ms = (time.time() - start) * 1000.0 if start else 0.0
+  category = _category(service, call)
+  stats.calls[category] += 1
+  stats.ms[category] += ms
+  stats.rpcs.append(("%s.%s" % (service, call), ms))
+
+def installHooks():
+  """ Add the hooks to the current apiproxy (again, after the testbed has
+      replaced it); installing them twice is harmless.
+  """
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    "instrumentation", _preCall)
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    "instrumentation", _postCall)
+
+installHooks()
+
+
+
+@contextlib.contextmanager
+def recording(endpoint):
+  """ Count the RPCs made by the current thread inside the with block;
+      yields the _RequestStats being filled in.
+  """
+  stats = _local.stats = _RequestStats(endpoint)
+  try:
+    yield stats
+  finally:
+    _local.stats = None
+
+
+
+def _statKeys(endpoint):
+  """ Return all the memcache keys kept for an endpoint. """
+  keys = ["%s|requests" % endpoint, "%s|errors" % endpoint,
+          "%s|ms" % endpoint]
+  keys.extend("%s|le_%d" % (endpoint, bound) for bound in LATENCY_BUCKETS)
+  keys.append("%s|le_inf" % endpoint)
+  for category in CATEGORIES:
+    keys.append("%s|%s_calls" % (endpoint, category))
+    keys.append("%s|%s_ms" % (endpoint, category))
+  return keys
+
+
+
+def _record(stats, status):
+  """ Add the counters of a finished request to the memcache totals. """
+  ms = (time.time() - stats.start) * 1000.0
+  endpoint = stats.endpoint
+  deltas = {
+    "%s|requests" % endpoint: 1,
+    "%s|ms" % endpoint: int(ms),
+  }
+  if status >= 500:
+    deltas["%s|errors" % endpoint] = 1
+  for bound in LATENCY_BUCKETS:
+    if ms <= bound:
+      deltas["%s|le_%d" % (endpoint, bound)] = 1
+      break
+  else:
+    deltas["%s|le_inf" % endpoint] = 1
+  for category in CATEGORIES:
+    if stats.calls[category]:
+      deltas["%s|%s_calls" % (endpoint, category)] = stats.calls[category]
+      deltas["%s|%s_ms" % (endpoint, category)] = int(stats.ms[category])
+  memcache.offset_multi(deltas, namespace=STATS_NAMESPACE, initial_value=0)
+
+  if STATS_SLOW_REQUEST_MS and ms >= STATS_SLOW_REQUEST_MS:
+    logging.warning("Slow request %s: %.0f ms, %d RPCs\n%s", endpoint, ms,
+      len(stats.rpcs),
+      "\n".join("  %-32s %8.1f ms" % rpc for rpc in stats.rpcs))
+
+
+
+def instrument(app, names, name=None):
+  """ Wrap a WSGI app so that its requests are instrumented. The endpoint
+      name is name(environ), or the last path segment by default (which
+      is the method name for /_ah/spi/ConferenceApi.<method> requests);
+      names that are not listed in names are counted as "other".
+  """
+  names = set(names)
+  ENDPOINTS.update(names)
+  ENDPOINTS.add("other")
+
+  def wsgi(environ, start_response):
+    if name:
+      endpoint = name(environ)
+    else:
+      endpoint = environ.get("PATH_INFO", "").rstrip("/").rsplit("/", 1)[-1]
+    if endpoint not in names:
+      endpoint = "other"
+    status = [500]
+
+    def recordStatus(status_line, headers, exc_info=None):
+      status[0] = int(status_line.split(" ", 1)[0])
+      return start_response(status_line, headers, exc_info)
+
+    try:
+      with recording(endpoint) as stats:
+        return app(environ, recordStatus)
+    finally:
+      # recording has stopped before the counters are written to memcache
+      try:
+        _record(stats, status[0])
+      except Exception:
+        logging.exception("Could not record the stats of %s", endpoint)
+  return wsgi
+
+
+
+def getStats(endpoints=None):
+  """ Return {endpoint: stats dict} for the given (default: all known)
+      endpoints that have served at least one request.
+  """
+  endpoints = sorted(endpoints or ENDPOINTS)
+  keys = []
+  for endpoint in endpoints:
+    keys.extend(_statKeys(endpoint))
+  values = memcache.get_multi(keys, namespace=STATS_NAMESPACE)
+
+  result = {}
+  for endpoint in endpoints:
+    get = lambda metric: int(values.get("%s|%s" % (endpoint, metric), 0))
+    requests = get("requests")
+    if not requests:
+      continue
+    histogram = [("<=%d" % bound, get("le_%d" % bound))
+                 for bound in LATENCY_BUCKETS]
+    histogram.append((">%d" % LATENCY_BUCKETS[-1], get("le_inf")))
+    rpcs = {}
+    for category in CATEGORIES:
+      calls = get("%s_calls" % category)
+      if calls:
+        rpcs[category] = {
+          "calls": calls,
+          "ms": get("%s_ms" % category),
+          "per_request": round(float(calls) / requests, 2),
+        }
+    result[endpoint] = {
+      "requests": requests,
+      "errors": get("errors"),
+      "mean_ms": round(float(get("ms")) / requests, 1),
+      "histogram": histogram,
+      "rpcs": rpcs,
+    }
+  return result
+
+
+
+def resetStats(endpoints=None):
+  """ Drop the totals of the given (default: all known) endpoints. """
+  keys = []
+  for endpoint in endpoints or ENDPOINTS:
+    keys.extend(_statKeys(endpoint))
+  memcache.delete_multi(keys, namespace=STATS_NAMESPACE)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+""" mailer.py
+
+Batched outgoing mail pipeline built on a pull queue.
+
+Producers call enqueue() with a message kind, a recipient and a small dict
+of template values. The worker (process_batch(), driven by the
+/crons/send_mail cron job) leases tasks in batches, renders them from
+TEMPLATES, sends them with bounded concurrency and deletes only the tasks
+that were sent, so failed items are retried when their lease expires.
+
+"""
+
+import json
+import logging
+import threading
+import Queue
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+
+# the pull queue defined in queue.yaml
+MAIL_QUEUE = "mail"
+
+# how many tasks are leased at once and for how long (in seconds)
+LEASE_BATCH_SIZE = 100
+LEASE_SECONDS = 60
+
+# at most this many messages are being sent at the same time
+MAX_CONCURRENT_SENDS = 5
+
+# a message that failed this many times is dropped
+MAX_RETRIES = 5
+
+# message kind -> (subject, body); bodies are str.format() templates
+# filled in with the "ctx" dict of the payload
+TEMPLATES = {
+  "conference_created": (
+    "You created a new Conference!",
+    "Hi, you have created a following conference:\r\n\r\n"
+    "Name: {name}\r\n"
+    "City: {city}\r\n"
+    "Topics: {topics}\r\n"
+    "Start date: {startDate}\r\n"
+    "End date: {endDate}\r\n"
+    "Max attendees: {maxAttendees}\r\n"
+  ),
+  "conference_registered": (
+    "You are registered for {name}",
+    "Hi, you have registered for the following conference:\r\n\r\n"
+    "Name: {name}\r\n"
+    "City: {city}\r\n"
+    "Start date: {startDate}\r\n"
+  ),
+}
+
+
+
+class LocalMailStub(object):
+  """ Stand-in for mail.send_mail() that records the messages instead of
+      sending them; pass it as the send argument of process_batch().
+      Recipients listed in fail_for raise an error, to exercise retries.
+  """
+  def __init__(self, fail_for=()):
+    self.sent = []
+    self.fail_for = set(fail_for)
+    self._lock = threading.Lock()
+
+  def __call__(self, sender, to, subject, body):
+    if to in self.fail_for:
+      raise mail.Error("stubbed failure for %s" % to)
+    with self._lock:
+      self.sent.append((sender, to, subject, body))
+
+
+
+def enqueue(kind, to, ctx, transactional=False):
+  """ Add a message of the given kind for the given recipient. """
+  if kind not in TEMPLATES:
+    raise ValueError("Unknown mail kind: %s" % kind)
+  payload = json.dumps({"kind": kind, "to": to, "ctx": ctx},
+                       separators=(",", ":"))
+  taskqueue.Queue(MAIL_QUEUE).add(
+    taskqueue.Task(payload=payload, method="PULL", tag=kind),
+    transactional=transactional)
+
+
+
+def render(payload):
+  """ Return (sender, to, subject, body) for a task payload. """
+  data = json.loads(payload)
+  subject, body = TEMPLATES[data["kind"]]
+  ctx = data.get("ctx") or {}
+  sender = "noreply@%s.appspotmail.com" % app_identity.get_application_id()
+  return (sender, data["to"],
+          unicode(subject).format(**ctx), unicode(body).format(**ctx))
+
+
+
+def _sendAll(messages, send):
+  """ Send (task, message) pairs with at most MAX_CONCURRENT_SENDS at a
+      time; return the tasks whose message went out.
+  """
+  pending = Queue.Queue()
+  for item in messages:
+    pending.put(item)
+  sent = []
+  lock = threading.Lock()
+
+  def worker():
+    while True:
+      try:
+        task, message = pending.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        send(*message)
+      except Exception:
+        logging.exception("Sending mail to %s failed (attempt %d)",
+                          message[1], task.retry_count + 1)
+      else:
+        with lock:
+          sent.append(task)
+
+  threads = [threading.Thread(target=worker)
+             for _ in range(min(MAX_CONCURRENT_SENDS, len(messages)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return sent
+
+
+
+def process_batch(send=None, batch_size=LEASE_BATCH_SIZE):
+  """ Lease one batch of mail tasks and send them; return the number of
+      tasks leased (0 when the queue is empty).
+  """
+  send = send or mail.send_mail
+  queue = taskqueue.Queue(MAIL_QUEUE)
+  tasks = queue.lease_tasks(LEASE_SECONDS, batch_size)
+  if not tasks:
+    return 0
+
+  done = []
+  messages = []
+  for task in tasks:
+    if task.retry_count >= MAX_RETRIES:
+      logging.error("Dropping mail task %s after %d attempts",
+                    task.name, task.retry_count)
+      done.append(task)
+      continue
+    try:
+      messages.append((task, render(task.payload)))
+    except (ValueError, KeyError, IndexError):
+      # a payload that cannot be rendered will never succeed
+      logging.exception("Dropping malformed mail task %s", task.name)
+      done.append(task)
+
+  done.extend(_sendAll(messages, send))
+
+  # only the tasks that are done are deleted; the others become
+  # available again once their lease expires
+  if done:
+    queue.delete_tasks(done)
+  return len(tasks)
@@ -1,8 +1,22 @@
 #!/usr/bin/env python
+import cgi
+import json
+import logging
+import os
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext.webapp import blobstore_handlers
 from conference import ConferenceApi
+from models import BulkImportJob
+from models import MigrationState
+import bulk
+import ical
+import instrumentation
+import profiling
+import mailer
+import migrations
+import recommendations
 
 class setFeatureSpeakerHandler(webapp2.RequestHandler):
   """ Set/update the feature speaker of a conference in Memcache. """
@@ -13,24 +27,252 @@ class setFeatureSpeakerHandler(webapp2.RequestHandler):
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
   def get(self):
-    """ Set Announcement in Memcache. """
-    ConferenceApi._cacheAnnouncement()
+    """ Set Announcement and the index page bootstrap payload in Memcache. """
+    ConferenceApi._cacheBootstrap(ConferenceApi._cacheAnnouncement())
     self.response.set_status(204)
 
-class SendConfirmationEmailHandler(webapp2.RequestHandler):
+class BuildRecommendationsHandler(webapp2.RequestHandler):
+  def get(self):
+    """ Rebuild the neighbour lists of recommendConferences. """
+    recommendations.buildNeighbours()
+    self.response.set_status(204)
+
+class TrendingHandler(webapp2.RequestHandler):
+  def get(self):
+    """ Flush the view/registration counters and cache the trending list. """
+    ConferenceApi._cacheTrending()
+    self.response.set_status(204)
+
+class SendMailHandler(webapp2.RequestHandler):
+  def get(self):
+    """ Send the queued emails, one leased batch at a time. """
+    while mailer.process_batch():
+      pass
+    self.response.set_status(204)
+
+class StatsHandler(webapp2.RequestHandler):
+  def get(self):
+    """ Show the per-endpoint RPC counters and latency histograms. """
+    self.response.headers["Content-Type"] = "application/json"
+    self.response.write(json.dumps(instrumentation.getStats(),
+                                   indent=2, sort_keys=True))
+
+  def post(self):
+    """ Reset the per-endpoint counters. """
+    instrumentation.resetStats()
+    self.response.set_status(204)
+
+class ProfileHandler(webapp2.RequestHandler):
+  def get(self):
+    """ Show the top functions of the merged profiles of an endpoint, or
+        the number of profiles of each endpoint.
+    """
+    endpoint = self.request.get("endpoint")
+    if not endpoint:
+      self.response.headers["Content-Type"] = "application/json"
+      self.response.write(json.dumps(profiling.getEndpoints(),
+                                     indent=2, sort_keys=True))
+      return
+    report = profiling.getReport(endpoint,
+                                 sort=self.request.get("sort", "cumulative"),
+                                 limit=int(self.request.get("limit", 30)))
+    if report is None:
+      self.abort(404)
+    self.response.headers["Content-Type"] = "text/plain"
+    self.response.write(report)
+
   def post(self):
-    """ Send email confirming Conference creation. """
-    mail.send_mail(
-      "noreply@%s.appspotmail.com" % (
-          app_identity.get_application_id()),     
-      self.request.get("email"),                 
-      "You created a new Conference!",          
-      "Hi, you have created a following "      
-      "conference:\r\n\r\n%s" % self.request.get("conferenceInfo")
-    )
-
-app = webapp2.WSGIApplication([
+    """ Drop the stored profiles. """
+    profiling.deleteSamples()
+    self.response.set_status(204)
+
+class BulkHandler(webapp2.RequestHandler):
+  def get(self):
+    """ Show the bulk import form and the recent import jobs. """
+    jobs = BulkImportJob.query().order(-BulkImportJob.created).fetch(20)
+    self.response.write(
+      "<h1>Bulk import</h1>"
+      "<form method='post' enctype='multipart/form-data' action='%s'>"
+      "<select name='kind'><option>Conference</option>"
+      "<option>Session</option></select> "
+      "<input type='file' name='file'> "
+      "<input type='submit' value='Import'></form>"
+      "<p>Export: <a href='/admin/bulk/export?kind=Conference&format=jsonl'>"
+      "conferences</a>, <a href='/admin/bulk/export?kind=Session&format=jsonl'>"
+      "sessions</a></p><table><tr><th>job</th><th>kind</th><th>status</th>"
+      "<th>rows</th><th>imported</th><th>errors</th></tr>"
+      % blobstore.create_upload_url("/admin/bulk/upload"))
+    for job in jobs:
+      self.response.write(
+        "<tr><td>%d</td><td>%s</td><td>%s</td><td>%d</td><td>%d</td>"
+        "<td>%s</td></tr>" % (job.key.id(), job.kind, job.status, job.rows,
+        job.imported, "<br>".join(cgi.escape(e) for e in job.errors)))
+    self.response.write("</table>")
+
+class BulkUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
+  def post(self):
+    """ Start the import of an uploaded CSV/JSONL file. """
+    upload = self.get_uploads("file")[0]
+    fileFormat = "csv" if upload.filename.lower().endswith(".csv") else "jsonl"
+    bulk.startImport(self.request.get("kind"), fileFormat, upload.key())
+    self.redirect("/admin/bulk")
+
+class BulkImportTaskHandler(webapp2.RequestHandler):
+  def post(self):
+    """ Import the next batch of a bulk import job; the job fails once
+        the queue has retried the batch IMPORT_TASK_RETRIES times.
+    """
+    job_id = int(self.request.get("job"))
+    try:
+      bulk.runImportBatch(job_id)
+    except Exception as e:
+      retries = int(self.request.headers.get("X-AppEngine-TaskRetryCount", 0))
+      if retries < bulk.IMPORT_TASK_RETRIES:
+        raise
+      logging.exception("Bulk import %d failed", job_id)
+      bulk.failImport(job_id, e)
+    self.response.set_status(204)
+
+class BulkExportHandler(webapp2.RequestHandler):
+  def get(self):
+    """ Export conferences or sessions as CSV/JSONL; when the export does
+        not fit in one response, X-Next-Cursor tells where to go on from.
+    """
+    kind = self.request.get("kind")
+    fileFormat = self.request.get("format", "jsonl")
+    if kind not in bulk.KINDS or fileFormat not in bulk.FORMATS:
+      self.abort(400)
+    self.response.headers["Content-Type"] = \
+      "text/csv" if fileFormat == "csv" else "application/x-ndjson"
+    cursor = bulk.export(kind, fileFormat, self.response.write,
+                         cursor=self.request.get("cursor") or None)
+    if cursor:
+      self.response.headers["X-Next-Cursor"] = cursor
+
+class MigrationsHandler(webapp2.RequestHandler):
+  def get(self):
+    """ Show the registered migrations and their progress. """
+    states = dict((state.key.id(), state) for state in
+                  ndb.get_multi([ndb.Key(MigrationState, name)
+                                 for name in sorted(migrations.MIGRATIONS)])
+                  if state)
+    result = {}
+    for name, (model, function) in sorted(migrations.MIGRATIONS.items()):
+      state = states.get(name)
+      result[name] = {"kind": model._get_kind()}
+      if state:
+        result[name].update(status=state.status, dryRun=state.dryRun,
+          batches=state.batches, processed=state.processed,
+          changed=state.changed, writesPerSecond=state.writesPerSecond,
+          started=str(state.started), updated=str(state.updated))
+    self.response.headers["Content-Type"] = "application/json"
+    self.response.write(json.dumps(result, indent=2, sort_keys=True))
+
+  def post(self):
+    """ Start, stop or resume a migration: action=start|stop|resume,
+        name=<migration>, dry_run=1 and rate=<writes per second>.
+    """
+    name = self.request.get("name")
+    if name not in migrations.MIGRATIONS:
+      self.abort(404)
+    action = self.request.get("action", "start")
+    if action == "start":
+      migrations.startMigration(name,
+        dry_run=bool(self.request.get("dry_run")),
+        writes_per_second=float(self.request.get("rate") or 0) or None)
+    elif action == "stop":
+      migrations.stopMigration(name)
+    elif action == "resume":
+      migrations.resumeMigration(name)
+    else:
+      self.abort(400)
+    self.response.set_status(202)
+
+class MigrationTaskHandler(webapp2.RequestHandler):
+  def post(self):
+    """ Run the next batch of a migration; the migration fails once the
+        queue has retried the batch MIGRATION_TASK_RETRIES times.
+    """
+    name = self.request.get("name")
+    try:
+      migrations.runMigrationBatch(name)
+    except Exception:
+      retries = int(self.request.headers.get("X-AppEngine-TaskRetryCount", 0))
+      if retries < migrations.MIGRATION_TASK_RETRIES:
+        raise
+      logging.exception("Migration %s failed", name)
+      migrations.failMigration(name)
+    self.response.set_status(204)
+
+class IndexHandler(webapp2.RequestHandler):
+  # the page built by tools/build_assets.py when there is one
+  PAGES = (
+    os.path.join(os.path.dirname(__file__), "static", "build", "index.html"),
+    os.path.join(os.path.dirname(__file__), "templates", "index.html"),
+  )
+  page = None
+
+  def get(self):
+    """ Serve the index page with the cached bootstrap payload embedded. """
+    if IndexHandler.page is None:
+      path = next(path for path in self.PAGES if os.path.exists(path))
+      with open(path) as f:
+        IndexHandler.page = f.read()
+    payload = ConferenceApi._getBootstrap() or "null"
+    script = "<script>var BOOTSTRAP = %s;</script>\n</head>" % \
+      payload.replace("</", "<\\/")
+    self.response.headers["Cache-Control"] = "no-cache"
+    self.response.write(IndexHandler.page.replace("</head>", script, 1))
+
+class CalendarHandler(webapp2.RequestHandler):
+  def get(self, *args):
+    """ Serve the iCalendar feed of a conference or of a user's wishlist;
+        clients revalidate with If-None-Match/If-Modified-Since.
+    """
+    if len(args) == 1:
+      feed = ical.conferenceFeed(args[0])
+    else:
+      feed = ical.wishlistFeed(*args)
+    if not feed:
+      self.abort(404)
+    body, etag, last_modified = feed
+    self.response.headers["ETag"] = etag
+    self.response.headers["Last-Modified"] = last_modified
+    self.response.headers["Cache-Control"] = "private, no-cache"
+    if_none_match = self.request.headers.get("If-None-Match")
+    if if_none_match:
+      fresh = etag in [tag.strip() for tag in if_none_match.split(",")]
+    else:
+      fresh = self.request.headers.get("If-Modified-Since") == last_modified
+    if fresh:
+      self.response.set_status(304)
+      return
+    self.response.headers["Content-Type"] = "text/calendar; charset=utf-8"
+    self.response.write(body)
+
+ROUTES = [
+  ("/", IndexHandler),
   ("/crons/set_announcement", SetAnnouncementHandler),
-  ("/tasks/set_feature_speaker", setFeatureSpeakerHandler),
-  ("/tasks/send_confirmation_email", SendConfirmationEmailHandler),
-], debug=True)
+  ("/tasks/set_featured_speaker", setFeatureSpeakerHandler),
+  ("/crons/send_mail", SendMailHandler),
+  ("/crons/build_recommendations", BuildRecommendationsHandler),
+  ("/crons/trending", TrendingHandler),
+  ("/admin/stats", StatsHandler),
+  ("/admin/profile", ProfileHandler),
+  ("/admin/bulk", BulkHandler),
+  ("/admin/bulk/upload", BulkUploadHandler),
+  ("/admin/bulk/export", BulkExportHandler),
+  ("/tasks/bulk_import", BulkImportTaskHandler),
+  ("/admin/migrations", MigrationsHandler),
+  ("/tasks/migrate", MigrationTaskHandler),
+  (r"/calendar/conference/([^/]+)\.ics", CalendarHandler),
+  (r"/calendar/wishlist/([^/]+)/([^/]+)\.ics", CalendarHandler),
+]
+
+ROUTE_NAMES = [path for path, handler in ROUTES
+               if path not in ("/admin/stats", "/admin/profile")]
+app = profiling.profile(
+  instrumentation.instrument(
+    webapp2.WSGIApplication(ROUTES, debug=True), ROUTE_NAMES,
+    name=lambda environ: environ.get("PATH_INFO", "")),
+  ROUTE_NAMES, name=lambda environ: environ.get("PATH_INFO", ""))
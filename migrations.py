@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+""" migrations.py
+
+Resumable data migrations.
+
+A migration is a function registered with @migration(name, model); it is
+given one entity at a time, updates it in place and returns True when the
+entity has to be written back. It must be idempotent: a batch that failed
+half way is run again.
+
+startMigration() records a MigrationState and runs the migration as a
+chain of tasks on the migrations queue, one cursor-delimited batch per
+task. A batch is a page of keys; each entity is read again, migrated and
+written back in a transaction of its own, all of them at once, so that
+a registration or a wishlist change committed since the page was read
+is not overwritten with a stale copy (a retried transaction calls the
+function again). The state holds the cursor of the next batch, so a
+migration carries on where it stopped after a failure (or
+after resumeMigration()). Batches are spaced out so that the writes stay
+under the target rate, and a dry run counts the entities that would be
+changed without writing them. The checkpoint of a batch is made in a
+transaction that re-reads the state, so a stop made meanwhile is kept
+and a batch that was already checkpointed is not counted twice; a batch
+that still fails on its last try marks the migration "failed".
+
+"""
+
+import calendar
+import logging
+
+import geo
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import Conference
+from models import MigrationState
+from models import Profile
+from models import Session
+
+MIGRATIONS_QUEUE = "migrations"
+BATCH_SIZE = 100
+DEFAULT_WRITES_PER_SECOND = 50.0
+# task_retry_limit of the migrations queue (queue.yaml)
+MIGRATION_TASK_RETRIES = 5
+
+# name -> (model class, function)
+MIGRATIONS = {}
+
+
+
+def migration(name, model):
+  """ Register a migration function for the entities of a model. """
+  def register(function):
+    MIGRATIONS[name] = (model, function)
+    return function
+  return register
+
+
+
+def startMigration(name, dry_run=False, writes_per_second=None):
+  """ Start (or restart from scratch) a registered migration. """
+  model, function = MIGRATIONS[name]
+  state = MigrationState(id=name, kind=model._get_kind(), dryRun=dry_run,
+                         writesPerSecond=writes_per_second
+                                         or DEFAULT_WRITES_PER_SECOND)
+  state.put()
+  _enqueue(state)
+  return state
+
+
+
+def resumeMigration(name):
+  """ Carry on with a stopped or failed migration from its cursor; a
+      running one already has its next batch queued.
+  """
+  state, resumed = _setRunning(name)
+  if resumed:
+    _enqueue(state, named=False)
+  return state
+
+
+
+@ndb.transactional
+def _setRunning(name):
+  """ Return the state of a migration and whether it was set running
+      again (from stopped or failed).
+  """
+  state = MigrationState.get_by_id(name)
+  if state and state.status in ("stopped", "failed"):
+    state.status = "running"
+    state.put()
+    return state, True
+  return state, False
+
+
+
+@ndb.transactional
+def stopMigration(name):
+  """ Stop a migration after its current batch. """
+  state = MigrationState.get_by_id(name)
+  if state and state.status == "running":
+    state.status = "stopped"
+    state.put()
+  return state
+
+
+
+def _enqueue(state, countdown=0, named=True):
+  """ Add the task of the next batch; it is named after the run and the
+      batch so that a batch is never queued twice (resumeMigration() adds
+      an unnamed task, since the name of a failed task stays taken).
+  """
+  name = None
+  if named:
+    name = "migration-%s-%d-%d" % (state.key.id(),
+      calendar.timegm(state.started.timetuple()), state.batches)
+  try:
+    taskqueue.add(name=name,
+                  url="/tasks/migrate",
+                  params={"name": state.key.id()},
+                  queue_name=MIGRATIONS_QUEUE,
+                  countdown=countdown)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+
+def runMigrationBatch(name):
+  """ Run the next batch of a migration and chain the following one. """
+  state = MigrationState.get_by_id(name)
+  if not state or state.status != "running":
+    return
+  model, function = MIGRATIONS[name]
+
+  start = Cursor(urlsafe=state.cursor) if state.cursor else None
+  keys, cursor, more = model.query().fetch_page(BATCH_SIZE, keys_only=True,
+                                                start_cursor=start)
+  futures = [_migrateAsync(key, function, state.dryRun) for key in keys]
+  changed = sum(1 for future in futures if future.get_result())
+
+  state = _checkpoint(name, state.batches,
+                      cursor.urlsafe() if cursor else None,
+                      len(keys), changed, not more or not cursor)
+  if state and state.status == "done":
+    logging.info("Migration %s done: %d of %d entities %s", name,
+                 state.changed, state.processed,
+                 "would change" if state.dryRun else "changed")
+  elif state and state.status == "running":
+    # wait long enough for the writes of this batch to stay under the rate
+    _enqueue(state, countdown=changed / state.writesPerSecond)
+
+
+
+@ndb.tasklet
+def _migrateAsync(key, function, dry_run):
+  """ Migrate the current version of an entity in a transaction; return
+      whether it changed (or would have, in a dry run).
+  """
+  @ndb.tasklet
+  def txn():
+    entity = yield key.get_async()
+    if not entity or not function(entity):
+      raise ndb.Return(False)
+    if not dry_run:
+      yield entity.put_async()
+    raise ndb.Return(True)
+  changed = yield ndb.transaction_async(txn)
+  raise ndb.Return(changed)
+
+
+
+@ndb.transactional
+def _checkpoint(name, batches, cursor, processed, changed, done):
+  """ Record the batch that followed the first batches of a migration;
+      return the state, or None when that batch was already recorded
+      (by another run of it). The status is re-read, so that a stop made
+      while the batch ran is kept.
+  """
+  state = MigrationState.get_by_id(name)
+  if not state or state.batches != batches:
+    return None
+  state.cursor = cursor
+  state.batches += 1
+  state.processed += processed
+  state.changed += changed
+  if done:
+    state.status = "done"
+  state.put()
+  return state
+
+
+
+@ndb.transactional
+def failMigration(name):
+  """ Mark a running migration "failed" after a batch failed for good;
+      resumeMigration() carries on from its last checkpoint.
+  """
+  state = MigrationState.get_by_id(name)
+  if state and state.status == "running":
+    state.status = "failed"
+    state.put()
+  return state
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+#
+#       Migrations
+#
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+@migration("recompute_conference_month", Conference)
+def recomputeConferenceMonth(conf):
+  """ Set Conference.month from startDate (0 when there is none). """
+  month = conf.startDate.month if conf.startDate else 0
+  if conf.month == month:
+    return False
+  conf.month = month
+  return True
+
+
+
+@migration("geocode_conference", Conference)
+def geocodeConference(conf):
+  """ Set Conference.location and geohash from the city (see geo.py). """
+  location, geohash = geo.locate(conf.city)
+  if conf.location == location and conf.geohash == geohash:
+    return False
+  conf.location = location
+  conf.geohash = geohash
+  return True
+
+
+
+@migration("count_conference_sessions", Conference)
+@ndb.non_transactional
+def countConferenceSessions(conf):
+  """ Set the attendee and session counters of a conference (see
+      getConferenceCounts) from its sessions and attendees, outside the
+      transaction of the conference; the conference itself is not
+      changed, and a dry run sets no counter.
+  """
+  state = MigrationState.get_by_id("count_conference_sessions")
+  if not state.dryRun:
+    ConferenceApi._recountConference(conf.key)
+  return False
+
+
+
+def _rewrite(entity):
+  """ Write the entity back unchanged, so that its index rows follow the
+      indexed settings of its model (e.g. after properties were made
+      indexed=False, which only takes effect for rewritten entities).
+  """
+  return True
+
+for _model in (Conference, Session, Profile):
+  migration("reindex_%s" % _model._get_kind().lower(), _model)(_rewrite)
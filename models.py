@@ -13,13 +13,15 @@ from google.appengine.ext import ndb
 
 class Session(ndb.Model):
   """Session -- conference session info"""
-  name            = ndb.StringProperty(required=True)
-  highlights      = ndb.StringProperty()
+  # only the properties that queries filter or sort on are indexed; see
+  # tools/index_audit.py and the reindex_* migrations in migrations.py
+  name            = ndb.StringProperty(required=True, indexed=False)
+  highlights      = ndb.StringProperty(indexed=False)
   speaker         = ndb.StringProperty()
   typeOfSession   = ndb.StringProperty(default="NOT_SPECIFIED")
   date            = ndb.DateProperty()
   startTime       = ndb.TimeProperty()
-  endTime         = ndb.TimeProperty()
+  endTime         = ndb.TimeProperty(indexed=False)
 
 class SessionForm(messages.Message):
   """SessionForm -- Session outbound form message"""
@@ -46,10 +48,63 @@ class SessionType(messages.Enum):
   LECURE = 5
   KEYNOTE = 6
 
+class FeaturedSpeakerForm(messages.Message):
+  """FeaturedSpeakerForm -- featured speaker of a conference outbound form message"""
+  websafeConferenceKey = messages.StringField(1)
+  speaker              = messages.StringField(2)
+  found                = messages.BooleanField(3)
+
+class FeaturedSpeakerForms(messages.Message):
+  """FeaturedSpeakerForms -- multiple FeaturedSpeakerForm outbound form message"""
+  items = messages.MessageField(FeaturedSpeakerForm, 1, repeated=True)
+
+class BatchCallForm(messages.Message):
+  """BatchCallForm -- one API call of a batch inbound form message"""
+  method = messages.StringField(1, required=True)
+  params = messages.StringField(2)  # JSON request message of the method
+
+class BatchCallForms(messages.Message):
+  """BatchCallForms -- multiple BatchCallForm inbound form message"""
+  calls = messages.MessageField(BatchCallForm, 1, repeated=True)
+
+class BatchResultForm(messages.Message):
+  """BatchResultForm -- result of one API call of a batch outbound form message"""
+  method = messages.StringField(1)
+  status = messages.IntegerField(2, variant=messages.Variant.INT32)
+  result = messages.StringField(3)  # JSON response message of the method
+  error  = messages.StringField(4)
+
+class BatchResultForms(messages.Message):
+  """BatchResultForms -- multiple BatchResultForm outbound form message"""
+  items = messages.MessageField(BatchResultForm, 1, repeated=True)
+
+class CountForm(messages.Message):
+  """CountForm -- a named count outbound form message"""
+  name  = messages.StringField(1)
+  count = messages.IntegerField(2, variant=messages.Variant.INT32)
+
+class ConferenceCountsForm(messages.Message):
+  """ConferenceCountsForm -- dashboard counts of a conference outbound form message"""
+  websafeConferenceKey = messages.StringField(1)
+  sessions             = messages.IntegerField(2, variant=messages.Variant.INT32)
+  sessionsByType       = messages.MessageField(CountForm, 3, repeated=True)
+  sessionsByDate       = messages.MessageField(CountForm, 4, repeated=True)
+  attendees            = messages.IntegerField(5, variant=messages.Variant.INT32)
+  seatsAvailable       = messages.IntegerField(6, variant=messages.Variant.INT32)
+  wishlistBySession    = messages.MessageField(CountForm, 7, repeated=True)
+
 class ConflictException(endpoints.ServiceException):
   """ConflictException -- exception mapped to HTTP 409 response"""
   http_status = httplib.CONFLICT
 
+class ContentionException(endpoints.ServiceException):
+  """ContentionException -- transaction that kept colliding, mapped to HTTP 409 response"""
+  http_status = httplib.CONFLICT
+
+class RateLimitedException(endpoints.ServiceException):
+  """RateLimitedException -- rate limited call, mapped to HTTP 409 response (Endpoints turns a 429 into a 404)"""
+  http_status = httplib.CONFLICT
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
@@ -60,11 +115,12 @@ class BooleanMessage(messages.Message):
 
 class Profile(ndb.Model):
   """Profile -- User profile object"""
-  displayName = ndb.StringProperty()
-  mainEmail = ndb.StringProperty()
-  teeShirtSize = ndb.StringProperty(default="NOT_SPECIFIED")
+  displayName = ndb.StringProperty(indexed=False)
+  mainEmail = ndb.StringProperty(indexed=False)
+  teeShirtSize = ndb.StringProperty(default="NOT_SPECIFIED", indexed=False)
   conferenceKeysToAttend = ndb.StringProperty(repeated=True)
-  wishlist = ndb.StringProperty(repeated=True)
+  wishlist = ndb.StringProperty(repeated=True, indexed=False)
+  calendarToken = ndb.StringProperty(indexed=False)
 
 class ProfileMiniForm(messages.Message):
   """ProfileMiniForm -- update Profile form message"""
@@ -99,8 +155,8 @@ class TeeShirtSize(messages.Enum):
 class Conference(ndb.Model):
   """Conference -- Conference object"""
   name            = ndb.StringProperty(required=True)
-  description     = ndb.StringProperty()
-  organizerUserId = ndb.StringProperty()
+  description     = ndb.StringProperty(indexed=False)
+  organizerUserId = ndb.StringProperty(indexed=False)
   topics          = ndb.StringProperty(repeated=True)
   city            = ndb.StringProperty()
   startDate       = ndb.DateProperty()
@@ -108,6 +164,9 @@ class Conference(ndb.Model):
   endDate         = ndb.DateProperty()
   maxAttendees    = ndb.IntegerProperty()
   seatsAvailable  = ndb.IntegerProperty()
+  seatsVersion    = ndb.IntegerProperty(default=0, indexed=False)   # see seats.py
+  location        = ndb.GeoPtProperty(indexed=False)
+  geohash         = ndb.StringProperty()   # of the city; see geo.py
 
 class ConferenceForm(messages.Message):
   """ConferenceForm -- Conference outbound form message"""
@@ -123,10 +182,27 @@ class ConferenceForm(messages.Message):
   endDate         = messages.StringField(10)
   websafeKey      = messages.StringField(11)
   organizerDisplayName = messages.StringField(12)
+  distanceKm      = messages.FloatField(13)   # nearCity queries only
+
+class SeatsForm(messages.Message):
+  """SeatsForm -- seats available of a conference, as of a version"""
+  websafeConferenceKey = messages.StringField(1)
+  seatsAvailable  = messages.IntegerField(2, variant=messages.Variant.INT32)
+  version         = messages.IntegerField(3)
 
 class ConferenceForms(messages.Message):
   """ConferenceForms -- multiple Conference outbound form message"""
   items = messages.MessageField(ConferenceForm, 1, repeated=True)
+  nextCursor = messages.StringField(2)
+  sortStrategy = messages.StringField(3)   # queryConferences: index, scan or partial-scan
+
+class ConferenceDetailForm(messages.Message):
+  """ConferenceDetailForm -- conference detail page outbound form message; the caller's state is in isAttending and wishlist"""
+  conference      = messages.MessageField(ConferenceForm, 1)
+  featuredSpeaker = messages.StringField(2)
+  sessions        = messages.MessageField(SessionForm, 3, repeated=True)
+  isAttending     = messages.BooleanField(4)
+  wishlist        = messages.StringField(5, repeated=True)   # session keys
 
 class ProfileForms(messages.Message):
   """ConferenceForms -- multiple Conference outbound form message"""
@@ -141,4 +217,62 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
   """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
   filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+  sortBy = messages.StringField(2)      # NAME (default), START_DATE, SEATS_AVAILABLE or MAX_ATTENDEES
+  upcoming = messages.BooleanField(3)   # only those starting from today on
+  pageSize = messages.IntegerField(4, variant=messages.Variant.INT32)
+  cursor = messages.StringField(5)
+  nearCity = messages.StringField(6)    # conferences within withinKm of it
+  withinKm = messages.FloatField(7)
+
+
+class BulkImportJob(ndb.Model):
+  """BulkImportJob -- progress checkpoint of a bulk import (see bulk.py)"""
+  kind            = ndb.StringProperty(required=True)
+  fileFormat      = ndb.StringProperty(required=True)
+  blobKey         = ndb.BlobKeyProperty(required=True)
+  columns         = ndb.StringProperty(repeated=True, indexed=False)
+  offset          = ndb.IntegerProperty(default=0, indexed=False)
+  rows            = ndb.IntegerProperty(default=0, indexed=False)
+  imported        = ndb.IntegerProperty(default=0, indexed=False)
+  errors          = ndb.TextProperty(repeated=True)
+  pendingOffset   = ndb.IntegerProperty(indexed=False)
+  pendingKeys     = ndb.KeyProperty(repeated=True, indexed=False)
+  status          = ndb.StringProperty(default="running")
+  created         = ndb.DateTimeProperty(auto_now_add=True)
+  updated         = ndb.DateTimeProperty(auto_now=True)
+
+class ConferenceNeighbours(ndb.Model):
+  """ConferenceNeighbours -- most similar conferences of its parent Conference (see recommendations.py)"""
+  neighbours      = ndb.KeyProperty(repeated=True, indexed=False)
+  scores          = ndb.FloatProperty(repeated=True, indexed=False)
+  updated         = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class TrendingConferences(ndb.Model):
+  """TrendingConferences -- decayed trending scores and the cached top conferences (JSON ConferenceForms)"""
+  conferences     = ndb.KeyProperty(repeated=True, indexed=False)
+  scores          = ndb.FloatProperty(repeated=True, indexed=False)
+  top             = ndb.TextProperty()
+  updated         = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class ProfileSample(ndb.Model):
+  """ProfileSample -- cProfile stats of a sampled request, marshalled and zlib-compressed (see profiling.py)"""
+  endpoint        = ndb.StringProperty(required=True)
+  created         = ndb.DateTimeProperty(auto_now_add=True)
+  stats           = ndb.BlobProperty(required=True)
+
+class CounterShard(ndb.Model):
+  """CounterShard -- one shard of a sharded counter (see counters.py)"""
+  count           = ndb.IntegerProperty(default=0, indexed=False)
 
+class MigrationState(ndb.Model):
+  """MigrationState -- progress of a data migration, keyed by its name (see migrations.py)"""
+  kind            = ndb.StringProperty(required=True)
+  cursor          = ndb.StringProperty(indexed=False)
+  batches         = ndb.IntegerProperty(default=0, indexed=False)
+  processed       = ndb.IntegerProperty(default=0, indexed=False)
+  changed         = ndb.IntegerProperty(default=0, indexed=False)
+  dryRun          = ndb.BooleanProperty(default=False, indexed=False)
+  writesPerSecond = ndb.FloatProperty(indexed=False)
+  status          = ndb.StringProperty(default="running")
+  started         = ndb.DateTimeProperty(auto_now_add=True)
+  updated         = ndb.DateTimeProperty(auto_now=True)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+""" profiling.py
+
+Opt-in cProfile sampling of the API and the webapp2 handlers.
+
+profile() wraps a WSGI app; a request is run under cProfile when it is
+drawn by settings.PROFILE_SAMPLE_RATE (0, the default, profiles nothing)
+or when it carries the PROFILE_HEADER header, from a signed in admin or
+with settings.PROFILE_TOKEN as its value. The stats of a profiled request
+are stored marshalled and zlib-compressed in a ProfileSample entity,
+keyed by endpoint like the counters of instrumentation.py.
+
+getReport() merges the latest samples of an endpoint with pstats for the
+admin profile handler in main.py.
+
+"""
+
+import cProfile
+import logging
+import marshal
+import pstats
+import random
+import StringIO
+import zlib
+
+from google.appengine.api import users
+from google.appengine.ext import ndb
+
+from models import ProfileSample
+from settings import PROFILE_SAMPLE_RATE
+from settings import PROFILE_TOKEN
+
+# request header asking for a request to be profiled
+PROFILE_HEADER = "HTTP_X_CONFERENCE_PROFILE"
+
+# samples merged by getReport(), latest first
+REPORT_MAX_SAMPLES = 50
+
+
+
+def _wanted(environ):
+  """ Whether the request is to be profiled. """
+  header = environ.get(PROFILE_HEADER)
+  if header and (users.is_current_user_admin()
+                 or (PROFILE_TOKEN and header == PROFILE_TOKEN)):
+    return True
+  return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+
+def _save(endpoint, profiler):
+  """ Store the stats of a profiled request. """
+  profiler.create_stats()
+  ProfileSample(endpoint=endpoint,
+                stats=zlib.compress(marshal.dumps(profiler.stats))).put()
+
+
+
+def profile(app, names, name=None):
+  """ Wrap a WSGI app so that its sampled requests are profiled. The
+      endpoint name is name(environ), or the last path segment by default;
+      names that are not listed in names are stored as "other" (as in
+      instrumentation.instrument()).
+  """
+  names = set(names)
+
+  def wsgi(environ, start_response):
+    if not _wanted(environ):
+      return app(environ, start_response)
+
+    if name:
+      endpoint = name(environ)
+    else:
+      endpoint = environ.get("PATH_INFO", "").rstrip("/").rsplit("/", 1)[-1]
+    if endpoint not in names:
+      endpoint = "other"
+
+    profiler = cProfile.Profile()
+    try:
+      return profiler.runcall(app, environ, start_response)
+    finally:
+      try:
+        _save(endpoint, profiler)
+      except Exception:
+        logging.exception("Could not store the profile of %s", endpoint)
+  return wsgi
+
+
+
+class _Sample(object):
+  """ Stats of a stored sample, in the shape pstats loads from a profiler. """
+  def __init__(self, stats):
+    self.stats = stats
+
+  def create_stats(self):
+    pass
+
+
+
+def getEndpoints():
+  """ Return {endpoint: number of samples} of the stored samples. """
+  counts = {}
+  for sample in ProfileSample.query().iter(projection=[ProfileSample.endpoint]):
+    counts[sample.endpoint] = counts.get(sample.endpoint, 0) + 1
+  return counts
+
+
+
+def getReport(endpoint, sort="cumulative", limit=30):
+  """ Return the pstats listing of the top functions of the latest
+      samples of an endpoint merged, or None if there are none.
+  """
+  samples = ProfileSample.query(ProfileSample.endpoint == endpoint) \
+    .order(-ProfileSample.created).fetch(REPORT_MAX_SAMPLES)
+  if not samples:
+    return None
+  out = StringIO.StringIO()
+  stats = pstats.Stats(
+    *[_Sample(marshal.loads(zlib.decompress(sample.stats)))
+      for sample in samples], stream=out)
+  out.write("%d samples of %s\n\n" % (len(samples), endpoint))
+  stats.strip_dirs().sort_stats(sort).print_stats(limit)
+  return out.getvalue()
+
+
+
+def deleteSamples():
+  """ Drop all the stored samples. """
+  ndb.delete_multi(ProfileSample.query().fetch(keys_only=True))
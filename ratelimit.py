@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+""" ratelimit.py
+
+Per-caller rate limits of the API methods, as token buckets in memcache.
+
+The bucket of a method holds `tokens` tokens and is refilled every
+`seconds`: a call takes a token with an atomic memcache incr of the
+counter of the current period (keyed by method, caller and period), and
+is refused once the counter is past `tokens`. The caller is the user id
+(see utils.getUserId), or the IP address of anonymous calls.
+
+A refused call gets an HTTP 409 (Endpoints only passes a few 4xx codes
+through and turns a 429 into a 404) whose message starts with
+RATE_LIMITED and gives the seconds left until the refill as
+retryAfter=<seconds>, e.g. "RATE_LIMITED retryAfter=12: ...".
+
+The buckets a request needs are checked with one offset_multi: a
+@limited method takes its own token, and a batch takes the tokens of all
+its calls at once before running them inside prepaid(). An instance
+remembers the buckets it found empty until their refill, so the calls
+of a caller over its limit are refused without a memcache call; the
+others cost one memcache RPC. The calls are let through when memcache is
+unavailable.
+
+"""
+
+import contextlib
+import functools
+import math
+import os
+import threading
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+from models import RateLimitedException
+from utils import getUserId
+
+# memcache namespace of the bucket counters; the counters of past periods
+# are never read again and are left to be evicted
+RATELIMIT_NAMESPACE = "ratelimit"
+
+# machine-readable start of the message of a refused call
+RATE_LIMITED = "RATE_LIMITED"
+
+_local = threading.local()
+
+# buckets this instance found empty: memcache key -> time of the refill
+EMPTY_MAX_ENTRIES = 10000
+_empty = {}
+_lock = threading.Lock()
+
+
+
+def _caller():
+  """ Return the id of the caller: its user id, or its IP address. """
+  user = endpoints.get_current_user()
+  if user:
+    user_id = getUserId(user, id_type="oauth")
+    if user_id:
+      return "user:%s" % user_id
+  return "ip:%s" % os.getenv("REMOTE_ADDR", "")
+
+
+
+def take(limits, names):
+  """ Take a token for each call of names (method names, repeated for
+      repeated calls) from the buckets of the caller, limits being
+      {method: (tokens, seconds)}. Return, for each call, None when it
+      may run, else the seconds until its bucket is refilled.
+  """
+  now = time.time()
+  caller = _caller()
+  deltas = {}
+  keys = []
+  empty = {}
+  for name in names:
+    key = None
+    if name in limits:
+      tokens, seconds = limits[name]
+      key = "%s|%s|%d" % (name, caller, int(now // seconds))
+      refill = _empty.get(key)
+      if refill and refill > now:
+        empty[key] = refill
+      else:
+        deltas[key] = deltas.get(key, 0) + 1
+    keys.append(key)
+  if not deltas:
+    return [empty[key] - now if key in empty else None for key in keys]
+
+  counts = memcache.offset_multi(deltas, namespace=RATELIMIT_NAMESPACE,
+                                 initial_value=0) or {}
+  # the calls of a method are counted in order; the last ones of a
+  # bucket that ran out are refused
+  taken = {}
+  waits = []
+  refills = {}
+  for name, key in zip(names, keys):
+    if key in empty:
+      waits.append(empty[key] - now)
+      continue
+    count = counts.get(key)
+    if key is None or count is None:
+      waits.append(None)
+      continue
+    taken[key] = taken.get(key, 0) + 1
+    tokens, seconds = limits[name]
+    if count - deltas[key] + taken[key] <= tokens:
+      waits.append(None)
+    else:
+      waits.append(seconds - now % seconds)
+      refills[key] = now + waits[-1]
+  if refills:
+    with _lock:
+      if len(_empty) >= EMPTY_MAX_ENTRIES:
+        _empty.clear()
+      _empty.update(refills)
+  return waits
+
+
+
+def refuse(name, wait):
+  """ Return the error of a call refused for wait seconds. """
+  return RateLimitedException("%s retryAfter=%d: too many %s calls." % (
+    RATE_LIMITED, math.ceil(wait), name))
+
+
+
+@contextlib.contextmanager
+def prepaid():
+  """ Run @limited methods without taking tokens: the caller took them. """
+  _local.prepaid = True
+  try:
+    yield
+  finally:
+    _local.prepaid = False
+
+
+
+def limited(limits):
+  """ Return a decorator of API methods taking a token from the bucket of
+      the method in limits ({method: (tokens, seconds)}) on every call.
+  """
+  def decorate(method):
+    @functools.wraps(method)
+    def wrapper(service, request):
+      if not getattr(_local, "prepaid", False):
+        wait = take(limits, [method.__name__])[0]
+        if wait is not None:
+          raise refuse(method.__name__, wait)
+      return method(service, request)
+    return wrapper
+  return decorate
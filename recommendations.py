@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+""" recommendations.py
+
+Precomputed "similar conferences" lists for recommendConferences.
+
+buildNeighbours(), run by the /crons/build_recommendations cron job,
+gives every conference a sparse vector over its topics and city (topics
+weighted by their inverse document frequency, the city by CITY_WEIGHT),
+L2-normalized, and indexes the vectors by feature. The cosine similarity
+of a conference is then summed with NumPy over the postings of its own
+few features only, so the work and memory grow with the conferences
+that share a feature with it rather than with all the conferences times
+all the features. The TOP_K most similar upcoming (or undated) conferences are
+stored with their scores in a ConferenceNeighbours entity, a child of
+the conference, so recommendConferences only has to get_multi the lists
+of the user's conferences and merge them.
+
+"""
+
+import logging
+from datetime import date
+
+import numpy
+from google.appengine.ext import ndb
+
+from conference import DEFAULTS
+from conference import NEIGHBOURS_ID
+from models import Conference
+from models import ConferenceNeighbours
+
+TOP_K = 20
+CITY_WEIGHT = 0.5
+PAGE_SIZE = 500
+
+
+
+def _features(conf):
+  """ Return the topic and city features of a conference, leaving out the
+      default values given to conferences created without them.
+  """
+  features = ["topic:%s" % topic.strip().lower() for topic in conf.topics
+              if topic not in DEFAULTS["topics"]]
+  if conf.city and conf.city != DEFAULTS["city"]:
+    features.append("city:%s" % conf.city.strip().lower())
+  return features
+
+
+
+def _loadConferences():
+  """ Return all the conferences, read by pages. """
+  confs = []
+  cursor = None
+  more = True
+  while more:
+    page, cursor, more = Conference.query().fetch_page(
+      PAGE_SIZE, start_cursor=cursor)
+    confs.extend(page)
+    more = more and cursor
+  return confs
+
+
+
+def _vectors(confs):
+  """ Return the L2-normalized sparse vectors of the conferences, as a list
+      of (features, weights) per conference, and the postings of every
+      feature, a (rows, weights) pair of arrays.
+  """
+  rows = [sorted(set(_features(conf))) for conf in confs]
+  frequency = {}
+  for features in rows:
+    for feature in features:
+      frequency[feature] = frequency.get(feature, 0) + 1
+
+  # rare topics tell more about a conference than common ones
+  vectors = []
+  postings = {}
+  for i, features in enumerate(rows):
+    weights = numpy.array([
+      CITY_WEIGHT if feature.startswith("city:") else
+      numpy.log((1.0 + len(confs)) / (1.0 + frequency[feature])) + 1.0
+      for feature in features], numpy.float32)
+    norm = numpy.sqrt((weights * weights).sum())
+    if norm:
+      weights /= norm
+    vectors.append((features, weights))
+    for feature, weight in zip(features, weights):
+      postings.setdefault(feature, ([], []))
+      postings[feature][0].append(i)
+      postings[feature][1].append(weight)
+
+  for feature, (indexes, weights) in postings.items():
+    postings[feature] = (numpy.array(indexes, numpy.int32),
+                         numpy.array(weights, numpy.float32))
+  return vectors, postings
+
+
+
+def buildNeighbours():
+  """ Compute and store the neighbour list of every conference; return
+      how many were written.
+  """
+  confs = _loadConferences()
+  if not confs:
+    return 0
+  vectors, postings = _vectors(confs)
+  today = date.today()
+  # only conferences that are still to come are recommended
+  candidates = numpy.array([not conf.startDate or conf.startDate >= today
+                            for conf in confs])
+
+  written = 0
+  scores = numpy.zeros(len(confs), numpy.float32)
+  entities = []
+  for i, (features, weights) in enumerate(vectors):
+    # only the conferences sharing a feature have a score
+    touched = numpy.zeros(0, numpy.int32)
+    if features:
+      touched = numpy.unique(numpy.concatenate(
+        [postings[feature][0] for feature in features]))
+    for feature, weight in zip(features, weights):
+      indexes, others = postings[feature]
+      scores[indexes] += weight * others
+    columns = touched[candidates[touched] & (touched != i)]
+    # numpy 1.6 (the App Engine one) has no argpartition
+    columns = columns[numpy.argsort(-scores[columns])[:TOP_K]]
+    entities.append(ConferenceNeighbours(
+      key=ndb.Key(ConferenceNeighbours, NEIGHBOURS_ID, parent=confs[i].key),
+      neighbours=[confs[column].key for column in columns],
+      scores=[round(float(score), 4) for score in scores[columns]]))
+    scores[touched] = 0.0
+
+    if len(entities) == PAGE_SIZE:
+      ndb.put_multi(entities)
+      written += len(entities)
+      entities = []
+  if entities:
+    ndb.put_multi(entities)
+    written += len(entities)
+
+  logging.info("Built the neighbour lists of %d conferences", written)
+  return written
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+""" seats.py
+
+Seat availability updates for the clients watching a conference, so that
+they do not reload the conference to follow its seatsAvailable.
+
+Every change of Conference.seatsAvailable bumps Conference.seatsVersion;
+once it is written, publish() stores (version, seats) in memcache, never
+over a newer version. watch() is the long poll of watchConferenceSeats:
+it returns as soon as the published version is not the one the client
+has, or after WATCH_SECONDS with the same state. The requests waiting on
+an instance share one memcache read per conference every POLL_SECONDS,
+so a registration costs one memcache write and its watchers a few
+memcache reads a second per instance, however many they are; the
+datastore is only read when a conference has nothing published.
+
+"""
+
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+SEATS_NAMESPACE = "seats"
+WATCH_SECONDS = 25
+POLL_SECONDS = 0.5
+CAS_RETRIES = 3
+
+# the last state read from memcache by this instance, shared by its
+# waiting requests: websafeConferenceKey -> (time read, (version, seats))
+LATEST_MAX_ENTRIES = 1000
+_latest = {}
+_lock = threading.Lock()
+
+
+
+def publish(wsck, version, seats):
+  """ Publish the seats available of a conference, as of its version. """
+  client = memcache.Client()
+  for _ in range(CAS_RETRIES):
+    current = client.gets(wsck, namespace=SEATS_NAMESPACE)
+    if current is None:
+      if client.add(wsck, (version, seats), namespace=SEATS_NAMESPACE):
+        return
+    elif current[0] >= version:
+      return
+    elif client.cas(wsck, (version, seats), namespace=SEATS_NAMESPACE):
+      return
+  # still contended: let the next read publish it from the datastore
+  memcache.delete(wsck, namespace=SEATS_NAMESPACE)
+
+
+
+def _state(wsck):
+  """ Return the published (version, seats) of a conference, None if it
+      does not exist; memcache is read at most every POLL_SECONDS.
+  """
+  now = time.time()
+  with _lock:
+    read = _latest.get(wsck)
+  if read and now - read[0] < POLL_SECONDS:
+    return read[1]
+
+  state = memcache.get(wsck, namespace=SEATS_NAMESPACE)
+  if state is None:
+    conf = ndb.Key(urlsafe=wsck).get()
+    if not conf:
+      return None
+    state = (conf.seatsVersion, conf.seatsAvailable)
+    memcache.add(wsck, state, namespace=SEATS_NAMESPACE)
+  with _lock:
+    if len(_latest) >= LATEST_MAX_ENTRIES:
+      _latest.clear()
+    _latest[wsck] = (now, state)
+  return state
+
+
+
+def current(wsck):
+  """ Return the published (version, seats) of a conference, None if it
+      does not exist (e.g. to show up-to-date seats in a cached page).
+  """
+  return _state(wsck)
+
+
+
+def watch(wsck, version=None):
+  """ Return the (version, seats) of a conference once its version is not
+      the given one, or the current state after WATCH_SECONDS; None if the
+      conference does not exist.
+  """
+  deadline = time.time() + WATCH_SECONDS
+  state = _state(wsck)
+  while state and state[0] == version and time.time() < deadline:
+    time.sleep(POLL_SECONDS)
+    state = _state(wsck)
+  return state
@@ -13,3 +13,14 @@ created/forked from conference.py by wesc on 2014 may 24
 # Replace the following lines with client IDs obtained from the APIs
 # Console or Cloud Console.
 WEB_CLIENT_ID = '1030942758608-ufjc7oer9vf2i911msgr80jooodrachs.apps.googleusercontent.com'
+
+# Requests slower than this (in ms) are logged with their RPC breakdown
+# by instrumentation.py; 0 turns the slow request log off.
+STATS_SLOW_REQUEST_MS = 1000
+
+# Fraction of the requests profiled with cProfile by profiling.py; 0 turns
+# sampling off. A request with an X-Conference-Profile header is profiled
+# when it comes from a signed in admin or when the header value is
+# PROFILE_TOKEN (None: admins only).
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_TOKEN = None
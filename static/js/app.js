@@ -72,10 +72,35 @@ app.filter('startFrom', function () {
  *
  */
 app.constant('HTTP_ERRORS', {
-    'UNAUTHORIZED': 401
+    'UNAUTHORIZED': 401,
+    'NOT_FOUND': 404
 });
 
 
+/**
+ * @ngdoc constant
+ * @name BOOTSTRAP
+ *
+ * @description
+ * The payload embedded in the index page by the server (the announcement and the first upcoming conferences),
+ * or null when the page was served without it.
+ *
+ */
+app.constant('BOOTSTRAP', window.BOOTSTRAP || null);
+
+
+/**
+ * @ngdoc constant
+ * @name LANDING_QUERY
+ *
+ * @description
+ * The parameters of the first conference.queryConferences call of the conference list: the first page of
+ * upcoming conferences, which the embedded payload holds and the server caches.
+ *
+ */
+app.constant('LANDING_QUERY', {filters: [], sortBy: 'START_DATE', upcoming: true, pageSize: 20});
+
+
 /**
  * @ngdoc service
  * @name oauth2Provider
@@ -130,3 +155,139 @@ app.factory('oauth2Provider', function ($modal) {
 
     return oauth2Provider;
 });
+
+/**
+ * @ngdoc service
+ * @name conferenceCache
+ *
+ * @description
+ * Stale-while-revalidate cache of the conference API read calls.
+ * Responses are kept per method and parameters; a cached response is handed to the callback right away and,
+ * when it is older than FRESH_MS, refreshed in the background, the callback being called again if the
+ * refreshed response differs. Identical calls made while one is in flight share its response.
+ * Failed responses are not cached. The mutations call invalidate() with the methods whose responses
+ * they make stale.
+ *
+ */
+app.factory('conferenceCache', function (BOOTSTRAP, LANDING_QUERY) {
+    var conferenceCache = {
+        FRESH_MS: 5000
+    };
+
+    /**
+     * Cached responses by key: {resp: response, time: the time it was fetched}.
+     * @type {{}}
+     */
+    var entries = {};
+
+    /**
+     * Callbacks waiting for the call in flight, by key.
+     * @type {{}}
+     */
+    var pending = {};
+
+    /**
+     * Bumped by invalidate() and clear(), so that the responses of the calls started before are not cached.
+     * @type {number}
+     */
+    var generation = 0;
+
+    var cacheKey = function (method, params) {
+        return method + ':' + JSON.stringify(params || {});
+    };
+
+    /**
+     * Calls gapi.client.conference[method], sharing the call with the identical ones in flight.
+     */
+    var fetch = function (method, params, key, callback) {
+        if (pending[key]) {
+            pending[key].push(callback);
+            return;
+        }
+        pending[key] = [callback];
+        var started = generation;
+        gapi.client.conference[method](params || {}).execute(function (resp) {
+            var callbacks = pending[key];
+            delete pending[key];
+            if (!resp.error && started === generation) {
+                entries[key] = {resp: resp, time: new Date().getTime()};
+            }
+            angular.forEach(callbacks, function (waiting) {
+                waiting(resp);
+            });
+        });
+    };
+
+    /**
+     * Executes a read call of the conference API through the cache.
+     * The callback is called like the gapi execute callback, once with the cached response if there is one,
+     * and once more if a background refresh brings a different one.
+     *
+     * @param {string} method the name of the API method.
+     * @param {Object} params the request parameters.
+     * @param {Function} callback called with the response.
+     */
+    conferenceCache.execute = function (method, params, callback) {
+        var key = cacheKey(method, params);
+        var entry = entries[key];
+        if (!entry) {
+            fetch(method, params, key, callback);
+            return;
+        }
+        // Asynchronous, like a gapi callback, so that the callers can $apply.
+        setTimeout(function () {
+            callback(entry.resp);
+        }, 0);
+        if (new Date().getTime() - entry.time > conferenceCache.FRESH_MS) {
+            fetch(method, params, key, function (resp) {
+                if (!resp.error && angular.toJson(resp.result) !== angular.toJson(entry.resp.result)) {
+                    callback(resp);
+                }
+            });
+        }
+    };
+
+    /**
+     * Drops the cached responses of the methods, for any parameters.
+     *
+     * @param {string[]} methods the names of the API methods.
+     */
+    conferenceCache.invalidate = function (methods) {
+        generation++;
+        angular.forEach(Object.keys(entries), function (key) {
+            if (methods.indexOf(key.split(':')[0]) >= 0) {
+                delete entries[key];
+            }
+        });
+    };
+
+    /**
+     * Drops all the cached responses, e.g. when the user signs in or out.
+     */
+    conferenceCache.clear = function () {
+        generation++;
+        entries = {};
+    };
+
+    /**
+     * Stores a response obtained elsewhere as if it had just been fetched.
+     *
+     * @param {string} method the name of the API method.
+     * @param {Object} params the request parameters.
+     * @param {Object} resp the response.
+     */
+    conferenceCache.seed = function (method, params, resp) {
+        entries[cacheKey(method, params)] = {resp: resp, time: new Date().getTime()};
+    };
+
+    // The announcement and the upcoming conferences embedded in the page are as recent as the ones
+    // getAnnouncement and the landing queryConferences call would return.
+    if (BOOTSTRAP) {
+        conferenceCache.seed('getAnnouncement', {}, {result: {data: BOOTSTRAP.announcement}});
+        var upcoming = {items: BOOTSTRAP.upcoming, sortStrategy: 'index'};
+        conferenceCache.seed('queryConferences', LANDING_QUERY,
+            angular.extend({result: upcoming}, upcoming));
+    }
+
+    return conferenceCache;
+});
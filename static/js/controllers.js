@@ -25,7 +25,7 @@ conferenceApp.controllers = angular.module('conferenceControllers', ['ui.bootstr
  * A controller used for the My Profile page.
  */
 conferenceApp.controllers.controller('MyProfileCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, conferenceCache, HTTP_ERRORS) {
         $scope.submitted = false;
         $scope.loading = false;
 
@@ -63,8 +63,8 @@ conferenceApp.controllers.controller('MyProfileCtrl',
             var retrieveProfileCallback = function () {
                 $scope.profile = {};
                 $scope.loading = true;
-                gapi.client.conference.getProfile().
-                    execute(function (resp) {
+                conferenceCache.execute('getProfile', {},
+                    function (resp) {
                         $scope.$apply(function () {
                             $scope.loading = false;
                             if (resp.error) {
@@ -111,6 +111,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
                             }
                         } else {
                             // The request has succeeded.
+                            conferenceCache.invalidate(['getProfile']);
                             $scope.messages = 'The profile has been updated';
                             $scope.alertStatus = 'success';
                             $scope.submitted = false;
@@ -135,7 +136,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
  * A controller used for the Create conferences page.
  */
 conferenceApp.controllers.controller('CreateConferenceCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, conferenceCache, HTTP_ERRORS) {
 
         /**
          * The conference object being edited in the page.
@@ -231,6 +232,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
                             }
                         } else {
                             // The request has succeeded.
+                            conferenceCache.invalidate(['queryConferences', 'getConferencesCreated']);
                             $scope.messages = 'The conference has been created : ' + resp.result.name;
                             $scope.alertStatus = 'success';
                             $scope.submitted = false;
@@ -249,7 +251,8 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, conferenceCache,
+                                                                     HTTP_ERRORS, LANDING_QUERY) {
 
     /**
      * Holds the status if the query is being executed.
@@ -270,9 +273,33 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         {enumValue: 'CITY', displayName: 'City'},
         {enumValue: 'TOPIC', displayName: 'Topic'},
         {enumValue: 'MONTH', displayName: 'Start month'},
-        {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'}
+        {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'},
+        {enumValue: 'START_DATE', displayName: 'Start date (YYYY-MM-DD)'},
+        {enumValue: 'END_DATE', displayName: 'End date (YYYY-MM-DD)'}
     ]
 
+    /**
+     * Possible sort orders of queryConferencesAll.
+     *
+     * @type {{displayName: string, enumValue: string}[]}
+     */
+    $scope.sortOrders = [
+        {displayName: 'Name', enumValue: 'NAME'},
+        {displayName: 'Start date', enumValue: 'START_DATE'},
+        {displayName: 'Seats available', enumValue: 'SEATS_AVAILABLE'},
+        {displayName: 'Max attendees', enumValue: 'MAX_ATTENDEES'}
+    ];
+
+    // The order of the landing query.
+    $scope.sortOrder = $scope.sortOrders[1];
+
+    /**
+     * Whether the next query of the 'ALL' tab is the first one, which lists the upcoming conferences with
+     * LANDING_QUERY (answered from the embedded payload); the searches list all the conferences.
+     * @type {boolean}
+     */
+    var landing = true;
+
     /**
      * Possible operators.
      *
@@ -423,12 +450,24 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         }
     };
 
+    /**
+     * The number of the last conference list query; the cached queries may call back again after a
+     * refresh, and only the callbacks of the last query update $scope.conferences.
+     * @type {number}
+     */
+    var currentQuery = 0;
+
     /**
      * Invokes the conference.queryConferences API.
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
-            filters: []
+            filters: [],
+            sortBy: $scope.sortOrder.enumValue
+        }
+        if (landing) {
+            landing = false;
+            sendFilters = angular.copy(LANDING_QUERY);
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -441,8 +480,13 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
             }
         }
         $scope.loading = true;
-        gapi.client.conference.queryConferences(sendFilters).
-            execute(function (resp) {
+        var query = ++currentQuery;
+        conferenceCache.execute('queryConferences', sendFilters,
+            function (resp) {
+                if (query !== currentQuery) {
+                    // A later query (e.g. of another tab) owns the list.
+                    return;
+                }
                 $scope.$apply(function () {
                     $scope.loading = false;
                     if (resp.error) {
@@ -473,8 +517,13 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesCreated = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
-            execute(function (resp) {
+        var query = ++currentQuery;
+        conferenceCache.execute('getConferencesCreated', {},
+            function (resp) {
+                if (query !== currentQuery) {
+                    // A later query (e.g. of another tab) owns the list.
+                    return;
+                }
                 $scope.$apply(function () {
                     $scope.loading = false;
                     if (resp.error) {
@@ -511,8 +560,13 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesAttend = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
-            execute(function (resp) {
+        var query = ++currentQuery;
+        conferenceCache.execute('getConferencesToAttend', {},
+            function (resp) {
+                if (query !== currentQuery) {
+                    // A later query (e.g. of another tab) owns the list.
+                    return;
+                }
                 $scope.$apply(function () {
                     if (resp.error) {
                         // The request has failed.
@@ -547,21 +601,94 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
  * @description
  * A controller used for the conference detail page.
  */
-conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, $timeout,
+                                                                    oauth2Provider, conferenceCache, HTTP_ERRORS) {
     $scope.conference = {};
 
     $scope.isUserAttending = false;
 
+    $scope.sessions = [];
+
+    $scope.wishlist = [];
+
+    /**
+     * The cached responses made stale by registering for or unregistering from a conference
+     * (seatsAvailable and the conferences the user attends).
+     * @type {string[]}
+     */
+    var REGISTRATION_METHODS = ['getProfile', 'getConference', 'getConferenceDetail', 'getConferencesToAttend',
+        'queryConferences', 'getConferencesCreated'];
+
+    /**
+     * How long to wait before watching the seats again after a failed request, in milliseconds.
+     * @type {number}
+     */
+    var WATCH_RETRY_MS = 10000;
+
+    /**
+     * Whether the page is still shown; the seats are watched until it is left.
+     * @type {boolean}
+     */
+    var watching = true;
+
+    /**
+     * Whether the long poll of the seats was started; the cached detail may call back twice (the cached
+     * response, then a refresh), and the page holds a single long poll.
+     * @type {boolean}
+     */
+    var seatsWatched = false;
+
+    $scope.$on('$destroy', function () {
+        watching = false;
+    });
+
+    /**
+     * Keeps $scope.conference.seatsAvailable up to date with the conference.watchConferenceSeats
+     * long poll, which answers when the seats of the given version have changed.
+     *
+     * @param {number} version the version of the seats shown, undefined for the current ones.
+     */
+    var watchSeats = function (version) {
+        if (!watching) {
+            return;
+        }
+        gapi.client.conference.watchConferenceSeats({
+            websafeConferenceKey: $routeParams.websafeConferenceKey,
+            version: version
+        }).execute(function (resp) {
+            if (resp.error) {
+                $log.error('Failed to watch the seats : ' + (resp.error.message || ''));
+                if (resp.code == HTTP_ERRORS.NOT_FOUND) {
+                    // There is no such conference.
+                    return;
+                }
+                $timeout(function () {
+                    watchSeats(version);
+                }, WATCH_RETRY_MS);
+                return;
+            }
+            $scope.$apply(function () {
+                if (version !== undefined && resp.result.version != version) {
+                    conferenceCache.invalidate(['getConference', 'getConferenceDetail']);
+                }
+                $scope.conference.seatsAvailable = resp.result.seatsAvailable;
+            });
+            watchSeats(resp.result.version);
+        });
+    };
+
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.getConferenceDetail method and sets the returned conference, featured speaker,
+     * sessions and the state of the user in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        // The conference, its featured speaker and sessions and whether the user attends it, in one call.
+        conferenceCache.execute('getConferenceDetail', {
             websafeConferenceKey: $routeParams.websafeConferenceKey
-        }).execute(function (resp) {
+        }, function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
                 if (resp.error) {
@@ -574,31 +701,33 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     // The request has succeeded.
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
-                }
-            });
-        });
-
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
-                            // The user is attending the conference.
-                            $scope.alertStatus = 'info';
-                            $scope.messages = 'You are attending this conference';
-                            $scope.isUserAttending = true;
-                        }
+                    $scope.conference = resp.result.conference;
+                    $scope.featuredSpeaker = resp.result.featuredSpeaker;
+                    $scope.sessions = resp.result.sessions || [];
+                    $scope.wishlist = resp.result.wishlist || [];
+                    if (resp.result.isAttending) {
+                        // The user is attending the conference.
+                        $scope.alertStatus = 'info';
+                        $scope.messages = 'You are attending this conference';
+                        $scope.isUserAttending = true;
                     }
                 }
             });
         });
+        if (!seatsWatched) {
+            seatsWatched = true;
+            watchSeats();
+        }
+    };
+
+    /**
+     * Whether a session is in the wishlist of the user.
+     *
+     * @param {Object} session the session.
+     * @returns {boolean}
+     */
+    $scope.isInWishlist = function (session) {
+        return $scope.wishlist.indexOf(session.wssk) >= 0;
     };
 
 
@@ -626,6 +755,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     if (resp.result) {
                         // Register succeeded.
+                        conferenceCache.invalidate(REGISTRATION_METHODS);
                         $scope.messages = 'Registered for the conference';
                         $scope.alertStatus = 'success';
                         $scope.isUserAttending = true;
@@ -662,6 +792,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     if (resp.result) {
                         // Unregister succeeded.
+                        conferenceCache.invalidate(REGISTRATION_METHODS);
                         $scope.messages = 'Unregistered from the conference';
                         $scope.alertStatus = 'success';
                         $scope.conference.seatsAvailable = $scope.conference.seatsAvailable + 1;
@@ -691,7 +822,39 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
  * such as user authentications.
  *
  */
-conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider) {
+conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, $window, oauth2Provider, conferenceCache,
+                                                           BOOTSTRAP) {
+
+    /**
+     * The announcement of the nearly sold out conferences.
+     * @type {string}
+     */
+    $scope.announcement = '';
+
+    /**
+     * The first upcoming conferences, from the payload embedded in the page.
+     * @type {Array}
+     */
+    $scope.upcomingConferences = BOOTSTRAP ? BOOTSTRAP.upcoming : [];
+
+    /**
+     * Invokes the conference.getAnnouncement method, which is answered from the embedded payload
+     * when there is one; without it, the call waits for the conference API to be loaded.
+     */
+    $scope.getAnnouncement = function () {
+        if (!BOOTSTRAP && !gapi.client.conference) {
+            $window.conferenceApiWaiting.push($scope.getAnnouncement);
+            return;
+        }
+        conferenceCache.execute('getAnnouncement', {}, function (resp) {
+            $scope.$apply(function () {
+                if (!resp.error) {
+                    $scope.announcement = resp.result.data;
+                }
+            });
+        });
+    };
+    $scope.getAnnouncement();
 
     /**
      * Returns if the viewLocation is the currently viewed page.
@@ -720,6 +883,7 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
             gapi.client.oauth2.userinfo.get().execute(function (resp) {
                 $scope.$apply(function () {
                     if (resp.email) {
+                        conferenceCache.clear();
                         oauth2Provider.signedIn = true;
                         $scope.alertStatus = 'success';
                         $scope.rootMessages = 'Logged in with ' + resp.email;
@@ -755,6 +919,7 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
      */
     $scope.signOut = function () {
         oauth2Provider.signOut();
+        conferenceCache.clear();
         $scope.alertStatus = 'success';
         $scope.rootMessages = 'Logged out';
     };
@@ -778,11 +943,12 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
  *
  */
 conferenceApp.controllers.controller('OAuth2LoginModalCtrl',
-    function ($scope, $modalInstance, $rootScope, oauth2Provider) {
+    function ($scope, $modalInstance, $rootScope, oauth2Provider, conferenceCache) {
         $scope.singInViaModal = function () {
             oauth2Provider.signIn(function () {
                 gapi.client.oauth2.userinfo.get().execute(function (resp) {
                     $scope.$root.$apply(function () {
+                        conferenceCache.clear();
                         oauth2Provider.signedIn = true;
                         $scope.$root.alertStatus = 'success';
                         $scope.$root.rootMessages = 'Logged in with ' + resp.email;
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+""" async_latency.py
+
+Per-endpoint latency of ConferenceApi with serial vs. overlapped RPCs.
+
+Every datastore/memcache/taskqueue RPC is given a simulated latency. In
+"serial" mode each RPC runs when it is waited for, which is what the
+handlers cost when their RPCs are issued one after another; in "overlap"
+mode RPCs run from the moment they are issued, so the get_async /
+fetch_async / get_multi_async calls in the handlers overlap.
+
+  python tools/async_latency.py --latency 20 --runs 10
+
+"""
+
+import argparse
+import time
+
+from devstubs import activateTestbed, setLatency, login, message
+
+
+
+def seed(api, conference):
+  """ Create a conference with some sessions and a registered user. """
+  from models import ConferenceForm, SessionForm, SessionType
+  api.createConference(ConferenceForm(
+    name="Bench Conference", city="London", topics=["Web"],
+    startDate="2030-06-01", endDate="2030-06-03", maxAttendees=100))
+  api.getProfile(None)
+  wsck = conference.Conference.query().get().key.urlsafe()
+  wssks = []
+  for i in range(20):
+    sf = api.createSession(message(conference.SESSION_CREATE_REQUEST,
+      websafeConferenceKey=wsck, name="Session %d" % i,
+      speaker="speaker-%d" % (i % 3), typeOfSession=SessionType.PAPER,
+      date="2030-06-02", startTime="%02d:00:00" % (8 + i % 10), duration=45))
+    wssks.append(sf.wssk)
+  api.registerForConference(message(conference.CONF_GET_REQUEST,
+                                    websafeConferenceKey=wsck))
+  for wssk in wssks[:5]:
+    api.addSessionToWishlist(message(conference.SESSION_POST_REQUEST,
+                                     websafeSessionKey=wssk))
+  return wsck
+
+
+
+def endpoints(conference, wsck):
+  """ Return (name, callable) pairs for the read endpoints. """
+  from models import ConferenceQueryForm, ConferenceQueryForms
+  api = conference.ConferenceApi()
+  conf_req = message(conference.CONF_GET_REQUEST, websafeConferenceKey=wsck)
+  return [
+    ("getConference", lambda: api.getConference(conf_req)),
+    ("getConferenceSessions", lambda: api.getConferenceSessions(
+      message(conference.SESSION_GET_REQUEST, websafeConferenceKey=wsck))),
+    ("getConferenceSessionsByType", lambda: api.getConferenceSessionsByType(
+      message(conference.SESSION_TYPE_GET_REQUEST,
+              websafeConferenceKey=wsck, typeOfSession="PAPER"))),
+    ("getConferenceSessionsByDate", lambda: api.getConferenceSessionsByDate(
+      message(conference.SESSION_DATE_GET_REQUEST,
+              websafeConferenceKey=wsck, date="2030-06-02"))),
+    ("getSessionsInWishlist", lambda: api.getSessionsInWishlist(conf_req)),
+    ("getConferencesToAttend", lambda: api.getConferencesToAttend(None)),
+    ("getConferencesCreated", lambda: api.getConferencesCreated(None)),
+    ("queryConferences", lambda: api.queryConferences(ConferenceQueryForms(
+      filters=[ConferenceQueryForm(field="CITY", operator="EQ",
+                                   value="London")]))),
+    ("getAttenderByConference", lambda: api.getAttenderByConference(conf_req)),
+    ("getFeaturedSpeaker", lambda: api.getFeaturedSpeaker(conf_req)),
+  ]
+
+
+
+def measure(latency_ms, overlap, runs):
+  """ Return {endpoint name: mean latency in ms} for one mode. """
+  tb = activateTestbed()
+  try:
+    import conference
+    login("bench@example.com", "bench-user")
+    wsck = seed(conference.ConferenceApi(), conference)
+
+    # only the measured calls get the simulated latency
+    setLatency(latency_ms, overlap)
+
+    timings = {}
+    for name, call in endpoints(conference, wsck):
+      call() # warm up
+      start = time.time()
+      for _ in range(runs):
+        call()
+      timings[name] = (time.time() - start) * 1000.0 / runs
+    return timings
+  finally:
+    tb.deactivate()
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+  parser.add_argument("--latency", type=float, default=20,
+                      help="simulated latency of every RPC, in ms")
+  parser.add_argument("--runs", type=int, default=10,
+                      help="calls per endpoint")
+  args = parser.parse_args()
+
+  serial = measure(args.latency, False, args.runs)
+  overlap = measure(args.latency, True, args.runs)
+
+  print "%-30s %10s %10s %8s" % ("endpoint", "serial ms", "overlap ms", "saved")
+  for name in sorted(serial):
+    saved = 100.0 * (serial[name] - overlap[name]) / serial[name]
+    print "%-30s %10.1f %10.1f %7.0f%%" % (name, serial[name], overlap[name], saved)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+""" benchmark.py
+
+Reproducible ConferenceApi benchmark on the local testbed stubs.
+
+The datastore stub is seeded with a configurable volume of profiles,
+conferences and sessions (with a fixed random seed), then every endpoint
+is called directly a number of times. For each endpoint the latency
+percentiles and the mean number of RPCs per call (by category, see
+instrumentation.py) are reported. The result is written as JSON, so that
+runs can be compared with --compare.
+
+  python tools/benchmark.py --conferences 10000 --sessions 200000 \\
+      --profiles 100000 --output bench-$(git rev-parse --short HEAD).json
+  python tools/benchmark.py --compare bench-old.json --output bench-new.json
+
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+from datetime import time as dtime
+
+from devstubs import activateTestbed, setLatency, login, message, APP_DIR
+
+CITIES = ["London", "Paris", "Tokyo", "Chicago", "Berlin", "San Francisco",
+          "Toronto", "Sydney", "Madrid", "Seoul", "Mumbai", "Sao Paulo"]
+TOPICS = ["Medical Innovations", "Programming Languages", "Web Technologies",
+          "Movie Making", "Health and Nutrition", "Cloud", "Mobile",
+          "Security", "Data", "Design"]
+SESSION_TYPES = ["NOT_SPECIFIED", "PAPER", "PANEL", "POSTER", "WORKSHOP",
+                 "LECURE", "KEYNOTE"]
+PUT_BATCH = 500
+
+# queryConferences filter shapes: (label, [(field, operator, value)])
+QUERY_SHAPES = [
+  ("none", []),
+  ("city", [("CITY", "EQ", "London")]),
+  ("topic", [("TOPIC", "EQ", "Cloud")]),
+  ("month", [("MONTH", "EQ", "6")]),
+  ("maxAttendees_gt", [("MAX_ATTENDEES", "GT", "500")]),
+  ("city_topic", [("CITY", "EQ", "London"), ("TOPIC", "EQ", "Cloud")]),
+  ("city_month_topic", [("CITY", "EQ", "London"), ("MONTH", "EQ", "6"),
+                        ("TOPIC", "EQ", "Cloud")]),
+  ("city_maxAttendees_gt", [("CITY", "EQ", "Paris"),
+                            ("MAX_ATTENDEES", "GT", "100")]),
+]
+
+
+
+def putAll(entities):
+  """ Write entities in put_multi batches. """
+  from google.appengine.ext import ndb
+  for i in range(0, len(entities), PUT_BATCH):
+    ndb.put_multi(entities[i:i + PUT_BATCH])
+
+
+
+def seed(rnd, profiles, conferences, sessions):
+  """ Seed the datastore; return (websafe conference keys, session keys). """
+  from google.appengine.ext import ndb
+  from models import Profile, Conference, Session
+
+  user_ids = ["user-%d" % i for i in range(profiles)]
+  putAll([Profile(key=ndb.Key(Profile, user_id), displayName=user_id,
+                  mainEmail="%s@example.com" % user_id,
+                  teeShirtSize="NOT_SPECIFIED")
+          for user_id in user_ids])
+
+  # a few percent of the users organize conferences
+  organizers = user_ids[:max(1, profiles // 20)]
+  confs = []
+  for i in range(conferences):
+    start = date(2030, 1, 1) + timedelta(days=rnd.randint(0, 364))
+    max_attendees = rnd.choice([10, 50, 100, 500, 1000, 5000])
+    organizer = rnd.choice(organizers)
+    confs.append(Conference(
+      key=ndb.Key(Conference, i + 1, parent=ndb.Key(Profile, organizer)),
+      name="Conference %d" % i,
+      description="Description of conference %d" % i,
+      organizerUserId=organizer,
+      topics=rnd.sample(TOPICS, rnd.randint(1, 3)),
+      city=rnd.choice(CITIES),
+      startDate=start,
+      month=start.month,
+      endDate=start + timedelta(days=rnd.randint(0, 3)),
+      maxAttendees=max_attendees,
+      seatsAvailable=rnd.randint(1, max_attendees)))
+  putAll(confs)
+
+  sess = []
+  for i in range(sessions):
+    conf = rnd.choice(confs)
+    days = (conf.endDate - conf.startDate).days
+    start = dtime(rnd.randint(8, 18), rnd.choice([0, 30]))
+    sess.append(Session(
+      key=ndb.Key(Session, i + 1, parent=conf.key),
+      name="Session %d" % i,
+      highlights="Highlights of session %d" % i,
+      speaker=rnd.choice(user_ids),
+      typeOfSession=rnd.choice(SESSION_TYPES),
+      date=conf.startDate + timedelta(days=rnd.randint(0, days)),
+      startTime=start,
+      endTime=dtime(start.hour + 1, start.minute)))
+  putAll(sess)
+  return ([conf.key.urlsafe() for conf in confs],
+          [session.key.urlsafe() for session in sess])
+
+
+
+def cases(conference, rnd, wscks, wssks):
+  """ Return (name, callable) pairs, one per benchmarked operation. Each
+      callable picks its own random arguments.
+  """
+  from models import ConferenceQueryForm, ConferenceQueryForms
+  api = conference.ConferenceApi()
+  Api = conference.ConferenceApi
+  conf_req = lambda: message(conference.CONF_GET_REQUEST,
+                             websafeConferenceKey=rnd.choice(wscks))
+
+  # a conference (and two of its sessions) the benchmark user registers
+  # for, so that the wishlist calls succeed
+  reg_wsck = conference.ndb.Key(urlsafe=wssks[0]).parent().urlsafe()
+  wish_wssk = wssks[0]
+
+  others = [wsck for wsck in wscks if wsck != reg_wsck] or wscks
+
+  def register():
+    req = message(conference.CONF_GET_REQUEST,
+                  websafeConferenceKey=rnd.choice(others))
+    api.registerForConference(req)
+    api.unregisterFromConference(req)
+
+  def wishlist():
+    req = message(conference.SESSION_POST_REQUEST,
+                  websafeSessionKey=wish_wssk)
+    api.addSessionToWishlist(req)
+    api.deleteSessionInWishlist(req)
+
+  result = [
+    ("getProfile", lambda: api.getProfile(None)),
+    ("getConference", lambda: api.getConference(conf_req())),
+    ("getConferenceSessions", lambda: api.getConferenceSessions(
+      message(conference.SESSION_GET_REQUEST,
+              websafeConferenceKey=rnd.choice(wscks)))),
+    ("getConferenceSessionsByType", lambda: api.getConferenceSessionsByType(
+      message(conference.SESSION_TYPE_GET_REQUEST,
+              websafeConferenceKey=rnd.choice(wscks),
+              typeOfSession=rnd.choice(SESSION_TYPES)))),
+    ("getConferencesToAttend", lambda: api.getConferencesToAttend(None)),
+    ("getConferencesCreated", lambda: api.getConferencesCreated(None)),
+    ("getSessionsInWishlist", lambda: api.getSessionsInWishlist(
+      message(conference.CONF_GET_REQUEST, websafeConferenceKey=reg_wsck))),
+    ("getFeaturedSpeaker", lambda: api.getFeaturedSpeaker(conf_req())),
+    ("getAnnouncement", lambda: api.getAnnouncement(None)),
+    ("register+unregister", register),
+    ("wishlist add+delete", wishlist),
+    ("_cacheFeaturedSpeaker", lambda: Api._cacheFeaturedSpeaker(
+      rnd.choice(wscks))),
+    ("_cacheAnnouncement", lambda: Api._cacheAnnouncement()),
+  ]
+  for label, shape in QUERY_SHAPES:
+    form = ConferenceQueryForms(filters=[
+      ConferenceQueryForm(field=field, operator=operator, value=value)
+      for field, operator, value in shape])
+    result.append(("queryConferences[%s]" % label,
+                   lambda form=form: api.queryConferences(form)))
+  return result, reg_wsck
+
+
+
+def percentile(values, p):
+  values = sorted(values)
+  index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+  return values[index]
+
+
+
+def run(args):
+  """ Seed the stubs, run all cases and return the result dict. """
+  import instrumentation
+  tb = activateTestbed()
+  try:
+    import conference
+    rnd = random.Random(args.seed)
+
+    start = time.time()
+    wscks, wssks = seed(rnd, args.profiles, args.conferences, args.sessions)
+    seed_s = time.time() - start
+    sys.stderr.write("seeded in %.1f s\n" % seed_s)
+
+    login("user-0@example.com", "user-0")
+    calls, reg_wsck = cases(conference, rnd, wscks, wssks)
+    conference.ConferenceApi().registerForConference(
+      message(conference.CONF_GET_REQUEST, websafeConferenceKey=reg_wsck))
+    if args.latency:
+      setLatency(args.latency)
+
+    endpoints = {}
+    for name, call in calls:
+      if args.only and args.only not in name:
+        continue
+      timings = []
+      rpcs = dict((category, 0) for category in instrumentation.CATEGORIES)
+      errors = 0
+      for _ in range(args.warmup):
+        call()
+      for _ in range(args.runs):
+        with instrumentation.recording(name) as stats:
+          start = time.time()
+          try:
+            call()
+          except Exception as e:
+            errors += 1
+            sys.stderr.write("%s: %r\n" % (name, e))
+          timings.append((time.time() - start) * 1000.0)
+        for category, count in stats.calls.items():
+          rpcs[category] += count
+      endpoints[name] = {
+        "runs": args.runs,
+        "errors": errors,
+        "mean_ms": round(sum(timings) / len(timings), 3),
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p90_ms": round(percentile(timings, 90), 3),
+        "p99_ms": round(percentile(timings, 99), 3),
+        "max_ms": round(max(timings), 3),
+        "rpcs_per_call": dict((category, round(float(count) / args.runs, 2))
+                              for category, count in rpcs.items() if count),
+      }
+      sys.stderr.write("%-40s p50 %8.2f ms\n"
+                       % (name, endpoints[name]["p50_ms"]))
+  finally:
+    tb.deactivate()
+
+  try:
+    revision = subprocess.check_output(
+      ["git", "rev-parse", "HEAD"], cwd=APP_DIR).strip()
+  except (OSError, subprocess.CalledProcessError):
+    revision = None
+  return {
+    "revision": revision,
+    "timestamp": int(time.time()),
+    "config": {
+      "profiles": args.profiles,
+      "conferences": args.conferences,
+      "sessions": args.sessions,
+      "runs": args.runs,
+      "seed": args.seed,
+      "latency_ms": args.latency,
+    },
+    "seed_s": round(seed_s, 1),
+    "endpoints": endpoints,
+  }
+
+
+
+def compare(old, new):
+  """ Print the p50 and RPC count changes between two results. """
+  print "%-40s %10s %10s %8s %10s" % (
+    "endpoint", "old p50", "new p50", "change", "rpcs")
+  for name in sorted(new["endpoints"]):
+    cur = new["endpoints"][name]
+    prev = old["endpoints"].get(name)
+    rpcs = sum(cur["rpcs_per_call"].values())
+    if not prev:
+      print "%-40s %10s %10.2f %8s %10.1f" % (name, "-", cur["p50_ms"], "new", rpcs)
+      continue
+    change = 100.0 * (cur["p50_ms"] - prev["p50_ms"]) / (prev["p50_ms"] or 1)
+    old_rpcs = sum(prev["rpcs_per_call"].values())
+    print "%-40s %10.2f %10.2f %+7.0f%% %4.1f->%4.1f" % (
+      name, prev["p50_ms"], cur["p50_ms"], change, old_rpcs, rpcs)
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+  parser.add_argument("--profiles", type=int, default=1000)
+  parser.add_argument("--conferences", type=int, default=1000)
+  parser.add_argument("--sessions", type=int, default=10000)
+  parser.add_argument("--runs", type=int, default=50,
+                      help="measured calls per endpoint")
+  parser.add_argument("--warmup", type=int, default=3)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--latency", type=float, default=0,
+                      help="simulated latency of every RPC, in ms")
+  parser.add_argument("--only", help="run the endpoints matching this")
+  parser.add_argument("--output", help="write the JSON result to this file")
+  parser.add_argument("--compare", help="JSON result of an earlier run")
+  args = parser.parse_args()
+
+  result = run(args)
+  out = json.dumps(result, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(out)
+  elif not args.compare:
+    print out
+  if args.compare:
+    with open(args.compare) as f:
+      compare(json.load(f), result)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+""" build_assets.py
+
+Build the fingerprinted static assets served from /build.
+
+templates/index.html marks the local stylesheets and scripts with
+<!-- build:css NAME --> / <!-- build:js NAME --> ... <!-- endbuild -->
+blocks. For each block the referenced files are concatenated and
+minified; the Angular partials are added to the script bundle as a
+$templateCache run block, so that routes do not fetch them, and the CSS
+rules whose classes appear nowhere in the templates, partials or scripts
+are dropped (the only Bootstrap build used is bootstrap-cosmo.css; the
+local bootstrap.css and bootstrap-responsive.css are not referenced and
+not built). The output files are named after a hash of their content and
+static/build/index.html is written with the blocks pointing at them;
+app.yaml serves / from it and /build with a far-future expiration.
+
+Every script bundle is checked with "node --check" before it is written,
+so a minification that broke the code fails the build; the check is
+skipped, with a warning, when node is not installed.
+
+  python tools/build_assets.py
+
+"""
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from distutils.spawn import find_executable
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE = os.path.join(APP_DIR, "templates", "index.html")
+PARTIALS_DIR = os.path.join(APP_DIR, "static", "partials")
+BUILD_DIR = os.path.join(APP_DIR, "static", "build")
+BUILD_URL = "/build/"
+
+# URL prefix -> directory, as in app.yaml
+STATIC_DIRS = {
+  "/js/": os.path.join(APP_DIR, "static", "js"),
+  "/css/": os.path.join(APP_DIR, "static", "bootstrap", "css"),
+  "/partials/": PARTIALS_DIR,
+}
+
+# classes used by the ui-bootstrap templates (loaded from a CDN) and by
+# Bootstrap's own scripts, which are not in our files
+KEEP_CLASSES = set("""
+  modal modal-backdrop modal-dialog modal-content modal-header modal-body
+  modal-footer modal-title modal-open fade in out collapse collapsing
+  dropdown dropdown-menu dropdown-toggle open pagination pager previous
+  next disabled active tooltip tooltip-inner tooltip-arrow top bottom
+  left right popover popover-title popover-content arrow alert close
+  btn btn-default btn-primary btn-sm btn-xs btn-info btn-success
+  btn-danger btn-group input-group input-group-btn form-control
+  table table-condensed text-center text-muted text-info glyphicon
+  glyphicon-chevron-left glyphicon-chevron-right glyphicon-calendar
+  pull-left pull-right progress progress-bar sr-only caret
+""".split())
+
+BLOCK_RE = re.compile(
+  r"<!--\s*build:(css|js)\s+(\S+)\s*-->(.*?)<!--\s*endbuild\s*-->", re.S)
+HREF_RE = re.compile(r"""(?:href|src)=["']([^"']+)["']""")
+CLASS_RE = re.compile(r"\.(-?[_a-zA-Z][\w-]*)")
+
+# a "/" after one of these characters or keywords (or at the start) begins
+# a regular expression literal; anywhere else it is a division
+REGEX_AFTER_CHARS = "(,=:[!&|?{};"
+REGEX_AFTER_KEYWORDS = set("""
+  return typeof instanceof in new delete void throw case do else
+""".split())
+
+
+
+def read(path):
+  with open(path) as f:
+    return f.read()
+
+
+
+def localPath(url):
+  for prefix, directory in STATIC_DIRS.items():
+    if url.startswith(prefix):
+      return os.path.join(directory, url[len(prefix):])
+  raise ValueError("%s is not a local static file" % url)
+
+
+
+def _regexAllowed(out):
+  """ Whether a "/" following the output so far begins a regular
+      expression literal.
+  """
+  i = len(out)
+  while i and out[i - 1].isspace():
+    i -= 1
+  if not i:
+    return True
+  if out[i - 1] in REGEX_AFTER_CHARS:
+    return True
+  # out holds single characters, except for the string and regular
+  # expression literals, which never end a keyword
+  j = i
+  while j and re.match(r"[\w$]$", out[j - 1]):
+    j -= 1
+  return "".join(out[j:i]) in REGEX_AFTER_KEYWORDS
+
+
+
+def minifyJs(source):
+  """ Conservative minifier: drops comments, indentation and blank lines
+      but keeps line breaks, so automatic semicolon insertion is unchanged.
+  """
+  out = []
+  i = 0
+  n = len(source)
+  while i < n:
+    c = source[i]
+    if c in "'\"`":
+      # string literal
+      j = i + 1
+      while j < n and source[j] != c:
+        j += 2 if source[j] == "\\" else 1
+      out.append(source[i:j + 1])
+      i = j + 1
+    elif source.startswith("//", i):
+      while i < n and source[i] != "\n":
+        i += 1
+    elif source.startswith("/*", i):
+      end = source.find("*/", i + 2)
+      i = n if end < 0 else end + 2
+    elif c == "/" and _regexAllowed(out):
+      # regular expression literal; a "/" in a class such as [/] does not
+      # end it
+      j = i + 1
+      in_class = False
+      while j < n and (in_class or source[j] != "/"):
+        if source[j] == "\\":
+          j += 1
+        elif source[j] == "[":
+          in_class = True
+        elif source[j] == "]":
+          in_class = False
+        j += 1
+      out.append(source[i:j + 1])
+      i = j + 1
+    else:
+      out.append(c)
+      i += 1
+  lines = [line.strip() for line in "".join(out).split("\n")]
+  return "\n".join(line for line in lines if line) + "\n"
+
+
+
+def checkJs(name, content):
+  """ Exit with node's error when a script bundle does not parse. """
+  node = find_executable("node") or find_executable("nodejs")
+  if not node:
+    sys.stderr.write("warning: node not found, %s was not checked\n" % name)
+    return
+  fd, path = tempfile.mkstemp(suffix=".js")
+  try:
+    with os.fdopen(fd, "w") as f:
+      f.write(content)
+    proc = subprocess.Popen([node, "--check", path], stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+  finally:
+    os.remove(path)
+  if proc.returncode:
+    sys.exit("%s does not parse once minified:\n%s" % (name, output))
+
+
+
+def templateCache(module):
+  """ Return a run block putting the partials in Angular's $templateCache. """
+  puts = []
+  for name in sorted(os.listdir(PARTIALS_DIR)):
+    if name.endswith(".html"):
+      html = "\n".join(line.strip() for line in
+                       read(os.path.join(PARTIALS_DIR, name)).split("\n"))
+      puts.append("$templateCache.put(%s,%s);" % (
+        json.dumps("/partials/" + name), json.dumps(html)))
+  return ("angular.module(%s).run(['$templateCache',function($templateCache){\n"
+          "%s\n}]);\n" % (json.dumps(module), "\n".join(puts)))
+
+
+
+def usedWords():
+  """ Every word of the template, partials and scripts (a superset of the
+      classes in use), plus the prefixes of interpolated classes such as
+      alert-{{alertStatus}}.
+  """
+  text = read(TEMPLATE)
+  for directory in (PARTIALS_DIR, STATIC_DIRS["/js/"]):
+    for name in os.listdir(directory):
+      text += read(os.path.join(directory, name))
+  words = set(re.findall(r"[\w-]+", text)) | KEEP_CLASSES
+  prefixes = set(re.findall(r"([\w-]+-)\{\{", text))
+  return words, tuple(prefixes)
+
+
+
+def _splitRules(css):
+  """ Yield (prelude, body) of the top-level rules/at-rules of a stylesheet
+      (statements such as @import come with a None body).
+  """
+  i = 0
+  n = len(css)
+  while i < n:
+    brace = css.find("{", i)
+    semi = css.find(";", i)
+    if brace < 0:
+      return
+    if 0 <= semi < brace and css[i:semi].strip().startswith("@"):
+      yield css[i:semi].strip(), None
+      i = semi + 1
+      continue
+    depth = 0
+    j = brace
+    while j < n:
+      if css[j] == "{":
+        depth += 1
+      elif css[j] == "}":
+        depth -= 1
+        if depth == 0:
+          break
+      j += 1
+    yield css[i:brace].strip(), css[brace + 1:j]
+    i = j + 1
+
+
+
+def pruneCss(css, words, prefixes):
+  """ Drop the selectors with classes that are not used; minify the rest. """
+  css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+  out = []
+  for prelude, body in _splitRules(css):
+    if body is None:
+      out.append(prelude + ";")
+    elif prelude.startswith("@media") or prelude.startswith("@supports"):
+      inner = pruneCss(body, words, prefixes)
+      if inner:
+        out.append("%s{%s}" % (prelude, inner))
+    elif prelude.startswith("@"):
+      # @font-face, @keyframes, ...
+      out.append("%s{%s}" % (prelude, re.sub(r"\s+", " ", body).strip()))
+    else:
+      selectors = []
+      for selector in prelude.split(","):
+        classes = CLASS_RE.findall(selector)
+        if all(cls in words or cls.startswith(prefixes) for cls in classes):
+          selectors.append(" ".join(selector.split()))
+      if selectors:
+        declarations = ";".join(d.strip() for d in body.split(";") if d.strip())
+        out.append("%s{%s}" % (",".join(selectors), declarations))
+  return "\n".join(out)
+
+
+
+def writeHashed(name, content):
+  """ Write content to static/build as name.<hash>.ext; return its URL. """
+  base, ext = os.path.splitext(name)
+  digest = hashlib.md5(content).hexdigest()[:10]
+  filename = "%s.%s%s" % (base, digest, ext)
+  with open(os.path.join(BUILD_DIR, filename), "w") as f:
+    f.write(content)
+  return BUILD_URL + filename
+
+
+
+def main():
+  if not os.path.isdir(BUILD_DIR):
+    os.makedirs(BUILD_DIR)
+  for name in os.listdir(BUILD_DIR):
+    os.remove(os.path.join(BUILD_DIR, name))
+
+  template = read(TEMPLATE)
+  words, prefixes = usedWords()
+
+  def build(match):
+    kind, name, block = match.groups()
+    urls = HREF_RE.findall(block)
+    if kind == "css":
+      content = pruneCss("\n".join(read(localPath(url)) for url in urls),
+                         words, prefixes)
+      return '<link rel="stylesheet" href="%s">' % writeHashed(name, content)
+    content = "".join(minifyJs(read(localPath(url))) for url in urls)
+    content += minifyJs(templateCache("conferenceApp"))
+    checkJs(name, content)
+    return '<script src="%s"></script>' % writeHashed(name, content)
+
+  html = BLOCK_RE.sub(build, template)
+  with open(os.path.join(BUILD_DIR, "index.html"), "w") as f:
+    f.write(html)
+
+  for name in sorted(os.listdir(BUILD_DIR)):
+    sys.stdout.write("%8d  static/build/%s\n" % (
+      os.path.getsize(os.path.join(BUILD_DIR, name)), name))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+""" devstubs.py
+
+Helpers shared by the development tools in this directory: they put the
+App Engine SDK and the app on sys.path, activate the testbed stubs
+(optionally with a simulated RPC latency) and call ConferenceApi methods
+directly, with a stubbed user identity.
+
+The SDK is located through the APPENGINE_SDK environment variable (the
+directory holding dev_appserver.py); it defaults to the one on the PATH.
+
+"""
+
+import os
+import sys
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+
+def setupPath():
+  """ Make the SDK, its bundled libraries and the app importable. """
+  sdk = os.environ.get("APPENGINE_SDK")
+  if not sdk:
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+      if os.path.exists(os.path.join(path, "dev_appserver.py")):
+        sdk = os.path.dirname(os.path.realpath(
+          os.path.join(path, "dev_appserver.py")))
+        break
+  if sdk:
+    sys.path.insert(0, sdk)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+setupPath()
+
+from google.appengine.api import apiproxy_rpc
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+
+class LatencyRPC(apiproxy_rpc.RPC):
+  """ RPC that waits `latency` seconds before running on the stub.
+      With overlap=True the call runs in a background thread started by
+      MakeCall(), so concurrent RPCs overlap like they do in production;
+      otherwise it runs when the caller waits for it, one after the other.
+  """
+  latency = 0.0
+  overlap = True
+
+  def _MakeCallImpl(self):
+    self._state = apiproxy_rpc.RPC.RUNNING
+    self._thread = None
+    if self.overlap:
+      self._thread = threading.Thread(target=self._run)
+      self._thread.start()
+
+  def _run(self):
+    time.sleep(self.latency)
+    try:
+      self.stub.MakeSyncCall(self.package, self.call,
+                             self.request, self.response)
+    except Exception:
+      self.SetException(sys.exc_info()[1])
+
+  def _WaitImpl(self):
+    if self._thread is None:
+      self._run()
+    else:
+      self._thread.join()
+    self._state = apiproxy_rpc.RPC.FINISHING
+    return True
+
+
+
+def activateTestbed(latency_ms=0, overlap=True,
+                    services=("datastore_v3", "memcache", "taskqueue")):
+  """ Activate the testbed stubs and return the Testbed. When latency_ms
+      is set, every RPC to the given services takes that long.
+  """
+  tb = testbed.Testbed()
+  tb.activate()
+  tb.setup_env(app_id="dev~conference-tools", overwrite=True)
+  policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+  tb.init_datastore_v3_stub(consistency_policy=policy)
+  tb.init_memcache_stub()
+  tb.init_taskqueue_stub(root_path=APP_DIR)
+  tb.init_urlfetch_stub()
+  tb.init_mail_stub()
+  tb.init_user_stub()
+  ndb.get_context().set_cache_policy(False)
+
+  # the testbed has its own apiproxy; hook the RPC counters into it
+  import instrumentation
+  instrumentation.installHooks()
+
+  if latency_ms:
+    setLatency(latency_ms, overlap, services)
+  return tb
+
+
+
+def setLatency(latency_ms, overlap=True,
+               services=("datastore_v3", "memcache", "taskqueue")):
+  """ Give every RPC to the given (active) stubs a simulated latency. """
+  LatencyRPC.latency = latency_ms / 1000.0
+  LatencyRPC.overlap = overlap
+  for service in services:
+    stub = apiproxy_stub_map.apiproxy.GetStub(service)
+    stub.CreateRPC = lambda stub=stub: LatencyRPC(stub=stub)
+
+
+
+def login(email, user_id=None):
+  """ Stub out the endpoints identity so that API methods run as a user,
+      and lift the rate limits, which the tools' loops would run into.
+  """
+  import conference
+  import ratelimit
+  user = users.User(email)
+  conference.endpoints.get_current_user = lambda: user
+  conference.getUserId = lambda user, id_type="email": user_id or email
+  ratelimit.getUserId = conference.getUserId
+  # the methods keep a reference to the dict: calls of methods not in it
+  # take no token and make no memcache call
+  conference.RATE_LIMITS.clear()
+  return user
+
+
+
+def message(container, **fields):
+  """ Build a request message of an endpoints ResourceContainer. """
+  if hasattr(container, "combined_message_class"):
+    return container.combined_message_class(**fields)
+  return container(**fields)
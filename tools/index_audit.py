@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+""" index_audit.py
+
+Index write-amplification audit of the datastore models.
+
+The benchmark cases of benchmark.py, then every other API method and
+each filter, sort and option combination of queryConferences (see
+apiCalls()), are run once on a small seeded datastore stub while every
+datastore query is captured, which gives the properties the app actually
+filters, sorts and projects on. These are compared with the indexed
+properties of the models in models.py and the composite indexes in
+index.yaml:
+
+  - properties that are indexed but never queried (candidates for
+    indexed=False),
+  - properties that are queried but not indexed (bugs),
+  - composite indexes that no captured query uses.
+
+The API methods that no call ran to completion are listed, since their
+queries are missing from the audit. It then reports the index rows written per put of the seeded entities,
+with every property indexed (the ndb default) and with the current
+models, and with --generate prints model definitions in which the unused
+properties are unindexed.
+
+  python tools/index_audit.py
+  python tools/index_audit.py --generate > slim_models.txt
+
+"""
+
+import argparse
+import collections
+import os
+import random
+
+from devstubs import activateTestbed, login, message, APP_DIR
+
+import yaml
+
+from google.appengine.api import apiproxy_stub_map
+
+
+
+class QueryCapture(object):
+  """ Pre-call hook recording the shape of every datastore query. """
+  def __init__(self):
+    self.shapes = collections.Counter()
+
+  def __call__(self, service, call, request, response):
+    if service != "datastore_v3" or call != "RunQuery":
+      return
+    filters = tuple(sorted(set(
+      f.property(0).name() for f in request.filter_list())))
+    orders = tuple(o.property() for o in request.order_list())
+    projection = tuple(sorted(request.property_name_list()))
+    self.shapes[(request.kind(), request.has_ancestor(),
+                 filters, orders, projection)] += 1
+
+  def used(self):
+    """ Return {kind: set of queried property names}. """
+    used = collections.defaultdict(set)
+    for kind, ancestor, filters, orders, projection in self.shapes:
+      used[kind].update(filters)
+      used[kind].update(name for name in orders if name != "__key__")
+      used[kind].update(projection)
+    return used
+
+
+
+def compositeIndexes():
+  """ Return the composite indexes of index.yaml as (kind, ancestor,
+      [property names]).
+  """
+  with open(os.path.join(APP_DIR, "index.yaml")) as f:
+    config = yaml.safe_load(f) or {}
+  return [(index["kind"], bool(index.get("ancestor")),
+           [prop["name"] for prop in index.get("properties", [])])
+          for index in config.get("indexes") or []]
+
+
+
+def compositeUsed(index, shapes):
+  """ Whether a captured query can be served by a composite index. """
+  kind, ancestor, names = index
+  for q_kind, q_ancestor, filters, orders, projection in shapes:
+    if q_kind == kind and q_ancestor == ancestor \
+        and set(names) == set(filters) | set(orders) - set(["__key__"]):
+      return True
+  return False
+
+
+
+def indexedProperties(model, all_indexed=False):
+  return [name for name, prop in model._properties.items()
+          if all_indexed or prop._indexed]
+
+
+
+def indexRows(entity, indexed, composites):
+  """ Index rows written by the first put of an entity: the entity and
+      its kind index row, an ascending and a descending row per indexed
+      value, and one row per combination of values per composite index
+      (times the ancestors, for ancestor indexes).
+  """
+  def values(name):
+    value = getattr(entity, name, None)
+    if value is None:
+      return 0
+    return len(value) if isinstance(value, list) else 1
+
+  rows = 2 + 2 * sum(values(name) for name in indexed)
+  depth = len(entity.key.pairs())
+  for kind, ancestor, names in composites:
+    if kind != entity._get_kind():
+      continue
+    combinations = 1
+    for name in names:
+      combinations *= values(name)
+    rows += combinations * (depth if ancestor else 1)
+  return rows
+
+
+
+def slimModel(model, used):
+  """ Return the source of a model with its unused properties unindexed. """
+  lines = ["class %s(ndb.Model):" % model.__name__,
+           '  """%s"""' % (model.__doc__ or model.__name__).strip()]
+  for name, prop in sorted(model._properties.items(),
+                           key=lambda item: item[1]._creation_counter):
+    args = []
+    if prop._required:
+      args.append("required=True")
+    if prop._repeated:
+      args.append("repeated=True")
+    if prop._default is not None:
+      args.append("default=%r" % prop._default)
+    if name not in used:
+      args.append("indexed=False")
+    lines.append("  %-15s = ndb.%s(%s)" % (name, type(prop).__name__,
+                                          ", ".join(args)))
+  return "\n".join(lines)
+
+
+
+# API methods run by the benchmark cases that are not named after one
+BENCHMARK_METHODS = {
+  "register+unregister": ["registerForConference",
+                          "unregisterFromConference"],
+  "wishlist add+delete": ["addSessionToWishlist", "deleteSessionInWishlist"],
+}
+
+# a value of each queryConferences field, for the filter combinations
+FIELD_VALUES = {
+  "CITY": "London",
+  "TOPIC": "Cloud",
+  "MONTH": "6",
+  "MAX_ATTENDEES": "100",
+  "START_DATE": "2030-06-01",
+  "END_DATE": "2030-06-01",
+}
+
+
+
+def apiCalls(conference, wscks, as_user):
+  """ Return (method name, callable) pairs calling the API methods that
+      the benchmark leaves out, the internal functions behind the cached
+      and scheduled responses, and queryConferences with each field and
+      operator, sort order and upcoming option, so that every query the
+      API issues is captured. The organizer-only calls are made as the
+      organizer, the others as as_user.
+  """
+  from models import ConferenceForm, ConferenceQueryForm
+  from models import ConferenceQueryForms, ProfileMiniForm, SessionType
+  from models import BatchCallForm, BatchCallForms
+  import ical
+  api = conference.ConferenceApi()
+  Api = conference.ConferenceApi
+  wsck = wscks[0]
+  c_key = conference.ndb.Key(urlsafe=wsck)
+  conf = c_key.get()
+  day = str(conf.startDate)
+  organizer = c_key.parent().id()
+  conf_req = lambda: message(conference.CONF_GET_REQUEST,
+                             websafeConferenceKey=wsck)
+
+  def asOrganizer(call):
+    def run():
+      login("%s@example.com" % organizer, organizer)
+      try:
+        return call()
+      finally:
+        login("%s@example.com" % as_user, as_user)
+    return run
+
+  result = [
+    ("saveProfile", lambda: api.saveProfile(
+      ProfileMiniForm(displayName=as_user))),
+    ("getWishlistCalendar", lambda: api.getWishlistCalendar(None)),
+    ("getConferenceDetail", lambda: api.getConferenceDetail(conf_req())),
+    ("getSessionsBySpeaker", lambda: api.getSessionsBySpeaker(
+      message(conference.SPEAKER_GET_REQUEST, speaker="user-1"))),
+    ("getConferenceSessionsByDate", lambda: api.getConferenceSessionsByDate(
+      message(conference.SESSION_DATE_GET_REQUEST,
+              websafeConferenceKey=wsck, date=day))),
+    ("recommendConferences", lambda: api.recommendConferences(None)),
+    ("getTrendingConferences", lambda: api.getTrendingConferences(None)),
+    ("getFeaturedSpeakers", lambda: api.getFeaturedSpeakers(
+      message(conference.FEATURED_SPEAKERS_GET_REQUEST,
+              websafeConferenceKeys=wscks[:5]))),
+    ("watchConferenceSeats", lambda: api.watchConferenceSeats(
+      message(conference.SEATS_GET_REQUEST, websafeConferenceKey=wsck))),
+    ("cacheFeaturedSpeaker", lambda: api.cacheFeaturedSpeaker(conf_req())),
+    ("createConference", lambda: api.createConference(ConferenceForm(
+      name="Audit conference", city="London", topics=["Cloud"],
+      startDate="2030-06-01", endDate="2030-06-02", maxAttendees=100))),
+    ("_cacheTrending", lambda: Api._cacheTrending()),
+    ("_cacheUpcoming", lambda: Api._cacheUpcoming()),
+    ("_recountConference", lambda: Api._recountConference(c_key)),
+    ("ical.conferenceFeed", lambda: ical.conferenceFeed(wsck)),
+    ("getAttenderByConference", asOrganizer(
+      lambda: api.getAttenderByConference(conf_req()))),
+    ("getConferenceCounts", asOrganizer(
+      lambda: api.getConferenceCounts(conf_req()))),
+    ("createSession", asOrganizer(lambda: api.createSession(message(
+      conference.SESSION_CREATE_REQUEST, websafeConferenceKey=wsck,
+      name="Audit session", speaker="user-1",
+      typeOfSession=SessionType.PAPER, date=day, startTime="10:00")))),
+    ("updateConference", asOrganizer(lambda: api.updateConference(message(
+      conference.CONF_POST_REQUEST, websafeConferenceKey=wsck,
+      maxAttendees=conf.maxAttendees)))),
+  ]
+
+  shapes = [[]] + [[(field, operator, value)]
+                   for field, value in sorted(FIELD_VALUES.items())
+                   for operator in ("EQ", "GT")]
+  for filters in shapes:
+    for sort in [None] + sorted(conference.SORT_FIELDS):
+      for upcoming in (False, True):
+        form = ConferenceQueryForms(filters=[
+          ConferenceQueryForm(field=field, operator=operator, value=value)
+          for field, operator, value in filters],
+          sortBy=sort, upcoming=upcoming, pageSize=20)
+        result.append(("queryConferences",
+                       lambda form=form: api.queryConferences(form)))
+  for upcoming in (False, True):
+    form = ConferenceQueryForms(nearCity="London", upcoming=upcoming)
+    result.append(("queryConferences",
+                   lambda form=form: api.queryConferences(form)))
+
+  # the batch, with a read-only call and another one
+  calls = [("getConference", '{"websafeConferenceKey": "%s"}' % wsck),
+           ("getProfile", "{}")]
+  result.append(("batch", lambda: api.batch(BatchCallForms(calls=[
+    BatchCallForm(method=method, params=params)
+    for method, params in calls]))))
+  return result
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+  parser.add_argument("--conferences", type=int, default=200)
+  parser.add_argument("--sessions", type=int, default=2000)
+  parser.add_argument("--profiles", type=int, default=200)
+  parser.add_argument("--generate", action="store_true",
+                      help="print slimmer model definitions")
+  args = parser.parse_args()
+
+  tb = activateTestbed()
+  try:
+    import conference
+    import benchmark
+    from models import Conference, Session, Profile
+    models = [Conference, Session, Profile]
+
+    rnd = random.Random(1)
+    wscks, wssks = benchmark.seed(rnd, args.profiles, args.conferences,
+                                  args.sessions)
+    login("user-0@example.com", "user-0")
+    calls, reg_wsck = benchmark.cases(conference, rnd, wscks, wssks)
+    conference.ConferenceApi().registerForConference(
+      message(conference.CONF_GET_REQUEST, websafeConferenceKey=reg_wsck))
+
+    capture = QueryCapture()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("audit", capture)
+    audited = set()
+    for name, call in calls:
+      call()
+      audited.update(BENCHMARK_METHODS.get(name, [name.split("[")[0]]))
+    rejected = 0
+    for name, call in apiCalls(conference, wscks, "user-0"):
+      try:
+        call()
+      except conference.endpoints.ServiceException:
+        # e.g. a filter on one property sorted by another; the API
+        # rejects it before querying
+        rejected += 1
+        continue
+      audited.add(name)
+    used = capture.used()
+    unaudited = sorted(set(conference.ConferenceApi.all_remote_methods())
+                       - audited)
+
+    composites = compositeIndexes()
+    if args.generate:
+      print "\n\n".join(slimModel(model, used[model._get_kind()])
+                        for model in models)
+      return
+
+    print "Calls rejected by the API: %d" % rejected
+    print "API methods not audited: %s" % (", ".join(unaudited) or "none")
+
+    print "\nQueries captured:"
+    for shape, count in sorted(capture.shapes.items()):
+      print "  %5d  %s ancestor=%s filters=%s orders=%s projection=%s" % (
+        (count,) + shape)
+
+    print "\nProperties:"
+    for model in models:
+      kind = model._get_kind()
+      for name in sorted(model._properties):
+        indexed = model._properties[name]._indexed
+        if indexed and name not in used[kind]:
+          note = "indexed, never queried -> indexed=False"
+        elif not indexed and name in used[kind]:
+          note = "QUERIED BUT NOT INDEXED"
+        else:
+          note = "ok (%s)" % ("indexed" if indexed else "unindexed")
+        print "  %-10s %-24s %s" % (kind, name, note)
+
+    print "\nComposite indexes in index.yaml:"
+    for index in composites:
+      print "  %-10s ancestor=%-5s %-40s %s" % (
+        index[0], index[1], ", ".join(index[2]),
+        "used" if compositeUsed(index, capture.shapes) else "UNUSED")
+
+    print "\nIndex rows written per put (seeded entities):"
+    print "  %-10s %10s %10s %8s" % ("kind", "all", "current", "saved")
+    for model in models:
+      entities = model.query().fetch(500)
+      if not entities:
+        continue
+      if model is Profile:
+        # the seeded profiles are bare; give them a typical attendee's
+        # registrations and wishlist
+        for prof in entities:
+          prof.conferenceKeysToAttend = rnd.sample(wscks, min(3, len(wscks)))
+          prof.wishlist = rnd.sample(wssks, min(10, len(wssks)))
+      before = sum(indexRows(e, indexedProperties(model, True), composites)
+                   for e in entities) / float(len(entities))
+      after = sum(indexRows(e, indexedProperties(model), composites)
+                  for e in entities) / float(len(entities))
+      print "  %-10s %10.1f %10.1f %7.0f%%" % (
+        model._get_kind(), before, after, 100 * (before - after) / before)
+  finally:
+    tb.deactivate()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+
+""" loadgen.py
+
+Concurrent load generator and traffic replay for the Conference API.
+
+Requests are sent to the Endpoints REST front end of a development server
+(dev_appserver.py), by a number of concurrent virtual users with a random
+think time between requests. The request mix is either synthesized from
+a named scenario or replayed from a file recorded with the "record"
+command, which runs a small proxy in front of the dev server.
+
+Every virtual user sends an "Authorization: Bearer" header (accepted by
+the dev server) and an X-Loadtest-User header, which getUserId() in
+utils.py uses as the user id on the dev server only.
+
+  python tools/loadgen.py run --scenario registration_rush \\
+      --concurrency 50 --duration 60 --think 0.2
+  python tools/loadgen.py record --listen 8090 --output mix.jsonl
+  python tools/loadgen.py replay mix.jsonl --concurrency 20 --duration 60
+
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import random
+import sys
+import threading
+import time
+import urllib2
+
+API_PATH = "/_ah/api/conference/v1/"
+
+# first word of the error message of a registration whose transaction
+# still collided after ndb's retries (CONTENTION in conference.py); the
+# API answers it with a 409, like the other conflicts
+CONTENTION = "CONTENTION"
+
+# scenario -> [(weight, operation)]; operations are defined in OPERATIONS
+SCENARIOS = {
+  "browse": [
+    (40, "queryConferences"),
+    (20, "getConference"),
+    (20, "getConferenceSessions"),
+    (10, "getFeaturedSpeaker"),
+    (10, "getAnnouncement"),
+  ],
+  "registration_rush": [
+    (45, "registerForConference"),
+    (30, "getConference"),
+    (10, "unregisterFromConference"),
+    (10, "getConferencesToAttend"),
+    (5, "getProfile"),
+  ],
+  "mixed": [
+    (30, "queryConferences"),
+    (20, "getConference"),
+    (15, "getConferenceSessions"),
+    (15, "registerForConference"),
+    (5, "unregisterFromConference"),
+    (5, "getConferencesToAttend"),
+    (5, "getProfile"),
+    (5, "getAnnouncement"),
+  ],
+}
+
+QUERY_FILTERS = [
+  [],
+  [{"field": "CITY", "operator": "EQ", "value": "London"}],
+  [{"field": "TOPIC", "operator": "EQ", "value": "Cloud"}],
+  [{"field": "MONTH", "operator": "EQ", "value": "6"}],
+  [{"field": "MAX_ATTENDEES", "operator": "GT", "value": "100"}],
+]
+
+# operation -> function(rnd, wscks) returning (http method, path, body)
+OPERATIONS = {
+  "queryConferences": lambda rnd, wscks: (
+    "POST", "queryConferences", {"filters": rnd.choice(QUERY_FILTERS)}),
+  "getConference": lambda rnd, wscks: (
+    "GET", "conference/%s" % rnd.choice(wscks), None),
+  "getConferenceSessions": lambda rnd, wscks: (
+    "POST", "conference/%s/all_sessions" % rnd.choice(wscks), None),
+  "getFeaturedSpeaker": lambda rnd, wscks: (
+    "GET", "conference/%s/featured_speaker" % rnd.choice(wscks), None),
+  "getAnnouncement": lambda rnd, wscks: (
+    "GET", "conference/announcement/get", None),
+  "registerForConference": lambda rnd, wscks: (
+    "POST", "conference/%s" % rnd.choice(wscks), None),
+  "unregisterFromConference": lambda rnd, wscks: (
+    "DELETE", "conference/%s" % rnd.choice(wscks), None),
+  "getConferencesToAttend": lambda rnd, wscks: (
+    "GET", "conferences/attending", None),
+  "getProfile": lambda rnd, wscks: ("GET", "profile", None),
+}
+
+
+
+def errorCode(body):
+  """ Return the first word of the message of an Endpoints error response,
+      or None.
+  """
+  try:
+    message = json.loads(body)["error"]["message"]
+  except (ValueError, KeyError, TypeError):
+    return None
+  words = message.replace(":", " ").split()
+  return words[0] if words else None
+
+
+
+class Stats(object):
+  """ Thread-safe counters of the responses. """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = collections.defaultdict(list)
+    self.statuses = collections.defaultdict(collections.Counter)
+    self.collisions = collections.Counter()
+
+  def add(self, name, status, ms, body):
+    with self.lock:
+      self.latencies[name].append(ms)
+      self.statuses[name][status] += 1
+      if status == 409 and errorCode(body) == CONTENTION:
+        self.collisions[name] += 1
+
+
+
+class Client(object):
+  """ Sends API requests as one virtual user. """
+  def __init__(self, host, user_id):
+    self.host = host.rstrip("/")
+    self.user_id = user_id
+
+  def send(self, method, path, body=None):
+    """ Return (status, response body). """
+    data = json.dumps(body) if body is not None else None
+    if data is None and method in ("POST", "PUT"):
+      data = "{}"
+    req = urllib2.Request(self.host + API_PATH + path, data)
+    req.get_method = lambda: method
+    req.add_header("Content-Type", "application/json")
+    req.add_header("Authorization", "Bearer loadtest")
+    req.add_header("X-Loadtest-User", self.user_id)
+    try:
+      resp = urllib2.urlopen(req, timeout=60)
+      return resp.getcode(), resp.read()
+    except urllib2.HTTPError as e:
+      return e.code, e.read()
+    except Exception as e:
+      return 599, repr(e)
+
+
+
+def loadConferenceKeys(host, limit):
+  """ Fetch the websafe keys of up to limit conferences. """
+  status, body = Client(host, "loadgen-setup").send(
+    "POST", "queryConferences", {"filters": []})
+  if status != 200:
+    sys.exit("queryConferences failed with %d: %s" % (status, body[:200]))
+  wscks = [item["websafeKey"] for item in json.loads(body).get("items", [])]
+  if not wscks:
+    sys.exit("no conferences found; seed the dev server first")
+  return wscks[:limit]
+
+
+
+def synthesize(scenario, wscks, seed):
+  """ Return an endless generator of (name, method, path, body). """
+  rnd = random.Random(seed)
+  mix = SCENARIOS[scenario]
+  total = sum(weight for weight, name in mix)
+  while True:
+    pick = rnd.uniform(0, total)
+    for weight, name in mix:
+      pick -= weight
+      if pick <= 0:
+        break
+    method, path, body = OPERATIONS[name](rnd, wscks)
+    yield (name, method, path, body)
+
+
+
+def replayed(records):
+  """ Return an endless generator over recorded requests. """
+  while True:
+    for record in records:
+      yield (record["name"], record["method"], record["path"],
+             record.get("body"))
+
+
+
+def drive(host, requests, args):
+  """ Run the virtual users until the duration or request count is
+      reached; return (Stats, elapsed seconds).
+  """
+  stats = Stats()
+  lock = threading.Lock()
+  deadline = time.time() + args.duration
+  remaining = [args.requests or float("inf")]
+
+  def user(index):
+    rnd = random.Random(args.seed + index)
+    client = Client(host, "loadtest-user-%d" % (index % args.users))
+    while time.time() < deadline:
+      with lock:
+        if remaining[0] <= 0:
+          return
+        remaining[0] -= 1
+        name, method, path, body = next(requests)
+      start = time.time()
+      status, text = client.send(method, path, body)
+      stats.add(name, status, (time.time() - start) * 1000.0, text)
+      if args.think:
+        time.sleep(rnd.expovariate(1.0 / args.think))
+
+  start = time.time()
+  threads = [threading.Thread(target=user, args=(i,))
+             for i in range(args.concurrency)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return stats, time.time() - start
+
+
+
+def report(stats, elapsed, as_json):
+  """ Print throughput, latency, error rate and collisions per operation. """
+  result = {"elapsed_s": round(elapsed, 2), "operations": {}}
+  total = errors = 0
+  for name in sorted(stats.latencies):
+    latencies = sorted(stats.latencies[name])
+    count = len(latencies)
+    failed = sum(n for status, n in stats.statuses[name].items()
+                 if status >= 400)
+    total += count
+    errors += failed
+    result["operations"][name] = {
+      "requests": count,
+      "rps": round(count / elapsed, 2),
+      "error_rate": round(float(failed) / count, 4),
+      "statuses": dict((str(k), v) for k, v in stats.statuses[name].items()),
+      "collisions": stats.collisions[name],
+      "p50_ms": round(latencies[count // 2], 1),
+      "p99_ms": round(latencies[min(count - 1, int(count * 0.99))], 1),
+    }
+  result["requests"] = total
+  result["rps"] = round(total / elapsed, 2) if elapsed else 0
+  result["error_rate"] = round(float(errors) / total, 4) if total else 0
+  result["collisions"] = sum(stats.collisions.values())
+
+  if as_json:
+    print json.dumps(result, indent=2, sort_keys=True)
+    return
+  print "%-28s %8s %8s %8s %8s %8s %6s" % (
+    "operation", "requests", "rps", "errors", "p50 ms", "p99 ms", "coll")
+  for name, op in sorted(result["operations"].items()):
+    print "%-28s %8d %8.1f %7.1f%% %8.1f %8.1f %6d" % (
+      name, op["requests"], op["rps"], 100 * op["error_rate"],
+      op["p50_ms"], op["p99_ms"], op["collisions"])
+  print "total: %d requests in %.1f s, %.1f rps, %.1f%% errors, %d collisions" % (
+    total, elapsed, result["rps"], 100 * result["error_rate"],
+    result["collisions"])
+
+
+
+class RecordingProxy(BaseHTTPServer.BaseHTTPRequestHandler):
+  """ Forwards requests to the dev server and records the API calls. """
+  target = None
+  output = None
+  lock = threading.Lock()
+
+  def _forward(self):
+    length = int(self.headers.getheader("content-length") or 0)
+    data = self.rfile.read(length) if length else None
+    req = urllib2.Request(self.target + self.path, data,
+                          dict(self.headers.items()))
+    req.get_method = lambda: self.command
+    try:
+      resp = urllib2.urlopen(req)
+      status, headers, body = resp.getcode(), resp.info().items(), resp.read()
+    except urllib2.HTTPError as e:
+      status, headers, body = e.code, e.info().items(), e.read()
+
+    path = self.path.split("?", 1)[0]
+    if path.startswith(API_PATH):
+      record = {
+        "name": self.headers.getheader("x-loadtest-name") or
+                path[len(API_PATH):].split("/", 1)[0],
+        "method": self.command,
+        "path": path[len(API_PATH):],
+        "body": json.loads(data) if data else None,
+      }
+      with self.lock:
+        self.output.write(json.dumps(record) + "\n")
+        self.output.flush()
+
+    self.send_response(status)
+    for name, value in headers:
+      if name.lower() not in ("transfer-encoding", "connection"):
+        self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  do_GET = do_POST = do_PUT = do_DELETE = _forward
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+  sub = parser.add_subparsers(dest="command")
+
+  def loadOptions(p):
+    p.add_argument("--host", default="http://localhost:8080")
+    p.add_argument("--concurrency", type=int, default=10)
+    p.add_argument("--users", type=int, default=1000,
+                   help="distinct user ids used by the virtual users")
+    p.add_argument("--duration", type=float, default=30, help="seconds")
+    p.add_argument("--requests", type=int, default=0,
+                   help="stop after this many requests (0: no limit)")
+    p.add_argument("--think", type=float, default=0.5,
+                   help="mean think time between requests, in seconds")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", action="store_true",
+                   help="print the report as JSON")
+
+  run = sub.add_parser("run", help="drive a synthesized request mix")
+  loadOptions(run)
+  run.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+  run.add_argument("--conferences", type=int, default=100,
+                   help="number of conferences the mix is spread over")
+
+  replay = sub.add_parser("replay", help="replay a recorded request mix")
+  loadOptions(replay)
+  replay.add_argument("file")
+
+  record = sub.add_parser("record", help="record requests through a proxy")
+  record.add_argument("--host", default="http://localhost:8080")
+  record.add_argument("--listen", type=int, default=8090)
+  record.add_argument("--output", required=True)
+
+  args = parser.parse_args()
+  if args.command == "record":
+    RecordingProxy.target = args.host.rstrip("/")
+    RecordingProxy.output = open(args.output, "a")
+    server = BaseHTTPServer.HTTPServer(("localhost", args.listen),
+                                       RecordingProxy)
+    sys.stderr.write("recording to %s; point the client at port %d\n"
+                     % (args.output, args.listen))
+    server.serve_forever()
+    return
+
+  if args.command == "run":
+    wscks = loadConferenceKeys(args.host, args.conferences)
+    requests = synthesize(args.scenario, wscks, args.seed)
+  else:
+    with open(args.file) as f:
+      requests = replayed([json.loads(line) for line in f if line.strip()])
+  stats, elapsed = drive(args.host, requests, args)
+  report(stats, elapsed, args.json)
+
+if __name__ == "__main__":
+  main()